@@ -0,0 +1,186 @@
+"""
+Micro-benchmarks for the bouncing ball pipeline.
+
+Usage:
+    python bench.py render [--frames N]
+    python bench.py detect [--frames N]
+    python bench.py pool [--frames N] [--max-workers N]
+    python bench.py scene [--frames N]
+    python bench.py cache [--frames N] [--cache-mb MB]
+"""
+import argparse
+import time
+
+RESOLUTIONS = {
+    "480p": (640, 480),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+}
+
+
+def _time_per_call(func, count: int) -> float:
+    """
+    Returns the mean wall time of func() in microseconds over count calls.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def bench_render(args) -> None:
+    from server import BouncingBallTrack, RENDER_MODES
+
+    print("%-8s %12s %12s %9s" % ("size", *("%s (us)" % m for m in RENDER_MODES), "speedup"))
+    for name, (width, height) in RESOLUTIONS.items():
+        results = []
+        for mode in RENDER_MODES:
+            track = BouncingBallTrack(
+                render_mode=mode, canvas_width=width, canvas_height=height)
+            results.append(_time_per_call(track.generate_moving_ball, args.frames))
+        print("%-8s %12.1f %12.1f %8.1fx" %
+              (name, results[0], results[1], results[0] / results[1]))
+
+
+def bench_detect(args) -> None:
+    from detection import DETECTORS, create_detector
+    from server import BouncingBallTrack
+
+    variants = [(name, tracking) for name in DETECTORS for tracking in (False, True)]
+    print("%-8s %-18s %10s %12s" % ("size", "detector", "time (us)", "error (px)"))
+    for size, (width, height) in RESOLUTIONS.items():
+        track = BouncingBallTrack(canvas_width=width, canvas_height=height)
+        frames, positions = [], []
+        for _ in range(args.frames):
+            frames.append(track.generate_moving_ball())
+            positions.append((track.ball_x, track.ball_y))
+
+        for name, tracking in variants:
+            detector = create_detector(name, tracking)
+            detections = []
+            it = iter(frames)
+            elapsed = _time_per_call(
+                lambda: detections.append(detector.detect(next(it))), len(frames))
+            errors = [abs(d.x - x) + abs(d.y - y)
+                      for d, (x, y) in zip(detections, positions) if d is not None]
+            error = sum(errors) / len(errors) if errors else float("nan")
+            label = name + ("+tracking" if tracking else "")
+            print("%-8s %-18s %10.1f %12.2f" % (size, label, elapsed, error))
+
+
+def bench_pool(args) -> None:
+    import os
+    import threading
+    from detection import ContourDetector
+    from detection_pool import DetectionPool
+    from server import BouncingBallTrack
+
+    width, height = RESOLUTIONS["1080p"]
+    track = BouncingBallTrack(canvas_width=width, canvas_height=height)
+    frames = [track.generate_moving_ball() for _ in range(args.frames)]
+
+    print("%-8s %10s %9s" % ("workers", "fps", "scaling"))
+    baseline = None
+    for workers in range(1, (args.max_workers or os.cpu_count() or 1) + 1):
+        done = threading.Event()
+
+        def on_result(seq, detection):
+            if seq == len(frames):
+                done.set()
+
+        pool = DetectionPool((height, width, 3), on_result, ContourDetector(),
+                             workers=workers)
+        pool.start()
+        start = time.perf_counter()
+        for frame in frames:
+            pool.put(frame)
+        done.wait()
+        fps = len(frames) / (time.perf_counter() - start)
+        pool.close()
+
+        baseline = baseline or fps
+        print("%-8d %10.1f %8.2fx" % (workers, fps, fps / baseline))
+
+
+def bench_scene(args) -> None:
+    from detection import create_detector
+    from server import BouncingBallTrack
+
+    print("%-6s %14s %14s %14s" % ("balls", "render (us)", "detect (us)", "us per ball"))
+    for balls in (1, 2, 8, 32, 128):
+        track = BouncingBallTrack(balls=balls)
+        render = _time_per_call(track.generate_moving_ball, args.frames)
+        frames = [track.generate_moving_ball().copy() for _ in range(args.frames)]
+
+        detector = create_detector(balls=balls)
+        detect = detector.detect_all if balls > 1 else detector.detect
+        it = iter(frames)
+        elapsed = _time_per_call(lambda: detect(next(it)), len(frames))
+        print("%-6d %14.1f %14.1f %14.1f" %
+              (balls, render, elapsed, (render + elapsed) / balls))
+
+
+def bench_cache(args) -> None:
+    from server import BouncingBallTrack
+
+    print("%-8s %12s %12s %9s %9s %10s %8s" % (
+        "size", "render (us)", "cached (us)", "speedup", "period", "resident", "hits"))
+    for name, (width, height) in RESOLUTIONS.items():
+        cached = BouncingBallTrack(canvas_width=width, canvas_height=height,
+                                   frame_cache=int(args.cache_mb * 1e6))
+        cache = cached.frame_cache
+        # Fill the cache over one cycle before timing
+        while cache.period is None or cached.frame_seq < 2 * cache.period:
+            cached._render_frame()
+        warmup = cached.frame_seq + 1
+        hits, misses = cache.hits, cache.misses
+        elapsed = _time_per_call(cached._render_frame, args.frames)
+        hits, misses = cache.hits - hits, cache.misses - misses
+
+        # Render as many frames without the cache first, so that both tracks
+        # are timed warm
+        track = BouncingBallTrack(canvas_width=width, canvas_height=height)
+        for _ in range(warmup):
+            track._render_frame()
+        render = _time_per_call(track._render_frame, args.frames)
+
+        # Without hits, a difference in time is noise, not the cache
+        speedup = "%8.1fx" % (render / elapsed) if hits else "%9s" % "-"
+        print("%-8s %12.1f %12.1f %s %9d %7.0f MB %7.1f%%" % (
+            name, render, elapsed, speedup, cache.period, cache.resident_bytes / 1e6,
+            hits / (hits + misses) * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bouncing ball benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render_parser = subparsers.add_parser(
+        "render", help="Compare frame rendering modes")
+    render_parser.add_argument("--frames", type=int, default=300)
+    render_parser.set_defaults(func=bench_render)
+
+    detect_parser = subparsers.add_parser(
+        "detect", help="Compare ball detection backends")
+    detect_parser.add_argument("--frames", type=int, default=300)
+    detect_parser.set_defaults(func=bench_detect)
+
+    pool_parser = subparsers.add_parser(
+        "pool", help="Detection pool throughput by number of workers (1080p)")
+    pool_parser.add_argument("--frames", type=int, default=300)
+    pool_parser.add_argument("--max-workers", type=int, default=None)
+    pool_parser.set_defaults(func=bench_pool)
+
+    scene_parser = subparsers.add_parser(
+        "scene", help="Render and detection cost by number of balls (480p)")
+    scene_parser.add_argument("--frames", type=int, default=300)
+    scene_parser.set_defaults(func=bench_scene)
+
+    cache_parser = subparsers.add_parser(
+        "cache", help="Rendering cost with and without the frame cache")
+    cache_parser.add_argument("--frames", type=int, default=300)
+    cache_parser.add_argument("--cache-mb", type=float, default=1024)
+    cache_parser.set_defaults(func=bench_cache)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,25 +1,300 @@
+import argparse
 import asyncio
 import cv2 as cv
+import numpy as np
 from aiortc import (
     RTCPeerConnection,
     RTCSessionDescription,
     RTCIceCandidate,
     MediaStreamTrack,
 )
+import functools
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from aiortc.contrib.media import MediaBlackhole
 from aiortc.contrib.signaling import TcpSocketSignaling, BYE
-from multiprocessing import Process, Queue, Value
+from aiortc.mediastreams import MediaStreamError
+from multiprocessing import Pipe, Process, Queue
+from detection import DETECTORS, ContourDetector, TaggedDetector, create_detector
+from detection_pool import RESULT_ORDERINGS, DetectionPool
+from frame_ring import SharedFrameRing
+from frame_tags import TAG_ROWS, read_tag, strip_tag
 from logger import app_log
+from metrics import MetricsServer, Registry
+from pipeline import Pipeline, Stage, parse_spec
+from position_record import SharedPosition
+from protocol import (
+    REPORT_FORMATS,
+    REPORT_MODES,
+    REPORT_SEQ_LIMIT,
+    PositionReport,
+    encode_message,
+    encode_text,
+)
+from recording import FrameRecorder
 
 
 HOST_IP = os.environ.get('SERVER_HOST', '127.0.0.1')
-PORT_NO = 8080
+PORT_NO = int(os.environ.get('SERVER_PORT', 8080))
 
 WIDTH = 640
 HEIGHT = 480
 
+FRAME_TRANSPORTS = ("shm", "queue")
+# What the receiver hands to detection: the decoded frame converted to BGR,
+# or its luma plane as is
+FRAME_FORMATS = ("bgr24", "gray")
+BACKPRESSURE_POLICIES = ("block", "drop-newest", "drop-oldest", "keep-latest")
+# Log dropped frames once every DROP_LOG_INTERVAL drops
+DROP_LOG_INTERVAL = 100
+# Most positions a rate-limited PositionStreamer holds for its next message
+STREAM_BATCH = 64
+# Default refresh rate of the display window in Hz
+DISPLAY_RATE = 30
+# Tagged frames whose decoding time is remembered by a ReceiptLog
+RECEIPT_CAPACITY = 256
+# Stages --pipeline can assemble after receive, in the order they must
+# appear in: each one takes what the previous one returns
+PIPELINE_STAGES = ("convert", "display", "detect", "report")
+
 frame_queue = Queue(20)
 
+# Metrics served by --metrics-port. Detection runs in other processes, so its
+# histogram lives in shared memory.
+metrics_registry = Registry()
+frames_received = metrics_registry.counter(
+    "client_frames_received_total", "Decoded video frames received")
+frames_dropped = metrics_registry.counter(
+    "client_frames_dropped_total", "Frames dropped by the backpressure policy")
+frame_queue_depth = metrics_registry.gauge(
+    "client_frame_queue_depth", "Frames waiting for detection")
+convert_time = metrics_registry.histogram(
+    "client_convert_seconds", "Time to convert a decoded frame for detection")
+detection_time = metrics_registry.histogram(
+    "client_detection_seconds", "Time to detect the ball in a frame", shared=True)
+channel_messages = metrics_registry.counter(
+    "client_channel_messages_total", "Data channel messages", ["direction"])
+stage_time = metrics_registry.histogram(
+    "client_stage_seconds", "Time spent on a frame by each --pipeline stage", ["stage"])
+stage_dropped = metrics_registry.counter(
+    "client_stage_dropped_total", "Items dropped by the queue of each --pipeline stage",
+    ["stage"])
+stage_queue_depth = metrics_registry.gauge(
+    "client_stage_queue_depth", "Items waiting for each --pipeline stage", ["stage"])
+stage_utilization = metrics_registry.gauge(
+    "client_stage_utilization", "Fraction of the time each --pipeline stage was busy",
+    ["stage"])
+
+
+class FrameHandoff:
+    """
+    Hands decoded frames to the detection process according to a backpressure
+    policy, without ever blocking the event loop:
+
+    - "block": wait for room in the queue (in an executor thread);
+    - "drop-newest": discard the incoming frame if the queue is full;
+    - "drop-oldest": discard the oldest queued frame to make room;
+    - "keep-latest": discard every queued frame so only the newest one waits.
+
+    A SharedFrameRing drops frames on the reader's side instead: it skips to
+    the newest frame with "keep-latest" and past overwritten frames with
+    "drop-oldest". Those drops are counted here as they are made known
+    through the ring.
+    """
+
+    def __init__(self, queue, policy="drop-oldest"):
+        """
+        Args:
+            queue: A multiprocessing.Queue, SharedFrameRing or DetectionPool.
+            policy (str): One of BACKPRESSURE_POLICIES.
+        """
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy: %s" % policy)
+        self.queue = queue
+        self.policy = policy
+        self.dropped = 0
+        # Reader-side drops of a SharedFrameRing counted so far
+        self._ring_skipped = 0
+
+    def _drop(self, count=1) -> None:
+        if count <= 0:
+            return
+        previous = self.dropped
+        self.dropped += count
+        frames_dropped.inc(count)
+        if previous == 0 or previous // DROP_LOG_INTERVAL != self.dropped // DROP_LOG_INTERVAL:
+            app_log.warning('%d frames dropped by the "%s" policy' %
+                            (self.dropped, self.policy))
+
+    def collect_ring_drops(self) -> None:
+        """
+        Counts the frames the reader of a SharedFrameRing skipped since the
+        last call.
+        """
+        if isinstance(self.queue, SharedFrameRing):
+            skipped = self.queue.skipped
+            self._drop(skipped - self._ring_skipped)
+            self._ring_skipped = skipped
+
+    async def put(self, image) -> bool:
+        """
+        Queues a frame for detection.
+
+        Returns:
+            bool: False if the frame itself was dropped.
+        """
+        self.collect_ring_drops()
+        if self.policy == "block":
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.queue.put, image)
+            return True
+
+        if isinstance(self.queue, SharedFrameRing) and self.policy != "drop-newest":
+            # The ring overwrites its oldest slot natively; the reader counts
+            # the unread frames that become unreachable.
+            self.queue.publish(image)
+            return True
+
+        if self.policy == "keep-latest":
+            self._drop(self._drain())
+
+        while True:
+            try:
+                self.queue.put_nowait(image)
+                return True
+            except queue.Full:
+                if self.policy != "drop-oldest":
+                    self._drop()
+                    return False
+                self._drop(self._drain(limit=1))
+
+    def _drain(self, limit=None) -> int:
+        """
+        Discards up to limit queued frames and returns how many were removed.
+        """
+        removed = 0
+        while limit is None or removed < limit:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+            removed += 1
+        return removed
+
+
+def luma_plane(frame):
+    """
+    Returns the Y plane of a decoded yuv420p frame as a (height, width) array,
+    without a colour conversion. Frames in other formats are converted to
+    gray.
+    """
+    if frame.format.name not in ("yuv420p", "yuvj420p"):
+        return frame.to_ndarray(format="gray")
+    plane = frame.planes[0]
+    rows = np.frombuffer(plane, dtype=np.uint8).reshape(frame.height, plane.line_size)
+    return rows[:, :frame.width]
+
+
+class ReceiptLog:
+    """
+    Remembers the time.monotonic() at which the most recent tagged frames
+    were decoded, by the server's frame sequence number.
+    """
+
+    def __init__(self, capacity=RECEIPT_CAPACITY):
+        self.capacity = capacity
+        self._times = OrderedDict()
+
+    def record(self, seq, timestamp: float) -> None:
+        if seq is None:
+            return
+        self._times[seq] = timestamp
+        if len(self._times) > self.capacity:
+            self._times.popitem(last=False)
+
+    def get(self, seq):
+        return self._times.get(seq)
+
+
+class FrameDisplay:
+    """
+    Shows received frames in a window from a dedicated thread, so that
+    HighGUI calls never run on the event loop.
+
+    Only the newest frame is kept: frames arriving faster than the refresh
+    rate replace each other and are never drawn. Pressing 'q' in the window
+    sets quit_requested.
+    """
+
+    def __init__(self, rate=DISPLAY_RATE, title="Bouncing Ball", width=WIDTH, height=HEIGHT):
+        """
+        Args:
+            rate (float): Most window refreshes per second, 0 for no limit.
+            title (str): Window title.
+            width (int): Initial window width.
+            height (int): Initial window height.
+        """
+        self.interval = 1 / rate if rate else 0
+        self.title = title
+        self.size = (width, height)
+        self.quit_requested = False
+        self.shown = 0
+        self.replaced = 0
+
+        self._latest = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def show(self, image) -> None:
+        """
+        Hands a frame to the display thread. Never blocks.
+        """
+        with self._lock:
+            if self._latest is not None:
+                self.replaced += 1
+            self._latest = image
+        self._ready.set()
+
+    def _take(self):
+        with self._lock:
+            image, self._latest = self._latest, None
+            self._ready.clear()
+        return image
+
+    def _run(self) -> None:
+        cv.namedWindow(self.title, cv.WINDOW_NORMAL)
+        cv.resizeWindow(self.title, *self.size)
+        while not self._stopped:
+            started = time.monotonic()
+            if self._ready.wait(0.1):
+                image = self._take()
+                if image is not None:
+                    cv.imshow(self.title, image)
+                    self.shown += 1
+
+            # Exit if 'q' is pressed
+            if cv.waitKey(1) & 0xFF == ord('q'):
+                self.quit_requested = True
+
+            remaining = self.interval - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+        cv.destroyWindow(self.title)
+
+    def close(self) -> None:
+        self._stopped = True
+        self._ready.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
 
 class ImageDisplayReceiver(MediaStreamTrack):
     """
@@ -28,9 +303,36 @@ class ImageDisplayReceiver(MediaStreamTrack):
 
     kind = "video"
 
-    def __init__(self, track):
+    def __init__(self, track, queue=None, policy="drop-oldest", frame_format="bgr24",
+                 display=None, receipts=None, recorder=None):
+        """
+        Args:
+            track (MediaStreamTrack): The remote video track.
+            queue: Destination for decoded frames, either a multiprocessing.Queue
+                or a SharedFrameRing. Defaults to the module's frame_queue.
+            policy (str): Backpressure policy used when the queue is full,
+                see FrameHandoff.
+            frame_format (str): One of FRAME_FORMATS. "gray" hands over and
+                displays the luma plane of the decoded frame, skipping the
+                conversion to BGR.
+            display (FrameDisplay): Window the frames are shown in; None
+                for headless operation.
+            receipts (ReceiptLog): Where the decoding time of every frame is
+                recorded, for frames carrying a frame tag; None if the frames
+                are not tagged.
+            recorder (FrameRecorder): Records every frame handed to detection,
+                see recording.py. Its positions are unknown, so the recording
+                is scored against the server's recording of the same frames.
+        """
         super().__init__()
         self.track = track
+        self.frame_format = frame_format
+        self.display = display
+        self.receipts = receipts
+        self.recorder = recorder
+        self.received = 0
+        self.handoff = FrameHandoff(
+            frame_queue if queue is None else queue, policy)
 
     async def recv(self):
         """
@@ -38,32 +340,73 @@ class ImageDisplayReceiver(MediaStreamTrack):
         """
         while True:
             frame = await self.track.recv()
-            image = frame.to_ndarray(format="bgr24")
-            frame_queue.put(image)
-
-            # Display ball
-            cv.namedWindow("Bouncing Ball", cv.WINDOW_NORMAL)
-            cv.resizeWindow("Bouncing Ball", WIDTH, HEIGHT)
+            received_at = time.monotonic()
+            frames_received.inc()
+            if self.frame_format == "gray":
+                image = luma_plane(frame)
+            else:
+                image = frame.to_ndarray(format="bgr24")
+            convert_time.observe(time.monotonic() - received_at)
+            seq = self.received
+            self.received += 1
+            if self.receipts is not None:
+                seq = read_tag(image)
+                self.receipts.record(seq, received_at)
+            if self.recorder is not None and not self.recorder.full and seq is not None:
+                self.recorder.write(image, seq, timestamp=received_at)
+            await self.handoff.put(image)
+
+            if self.display is not None:
+                self.display.show(image if self.receipts is None else strip_tag(image))
+                if self.display.quit_requested:
+                    break
+
+
+def detect_timed(detections, started: float, finished: float) -> list:
+    """
+    Returns the detections that were made, with the time.monotonic() at which
+    detection started and finished as their timing, unless TaggedDetector
+    already set it.
+    """
+    return [detection if detection.timing is not None
+            else detection._replace(timing=(started, finished))
+            for detection in detections if detection is not None]
 
-            cv.imshow("Bouncing Ball", image)
 
-            # Exit if 'q' is pressed
-            if cv.waitKey(1) & 0xFF == ord('q'):
-                break
+def publish_position(ball_location, detection) -> None:
+    """
+    Publishes a detection to the shared position record, with the time
+    detection finished.
+    """
+    timestamp = None if detection.timing is None else detection.timing[1]
+    ball_location.publish(detection.x, detection.y, detection.seq, timestamp,
+                          detection.confidence)
 
 
-def process_frame(queue, ball_location_x, ball_location_y) -> None:
+def process_frame(queue, ball_location, detector=None, results=None,
+                  balls=1, detect_time=None) -> None:
     """
     Processes frames, performs ball detection, and stores the ball location coordinates.
 
     Args:
-        queue (Queue): A queue to receive frames.
-        ball_location_x (Value): Shared value for ball x-coordinate.
-        ball_location_y (Value): Shared value for ball y-coordinate.
+        queue (Queue): A queue to receive frames. Detections in a frame of a
+            SharedFrameRing that was overwritten during detection are
+            discarded and the frame counted as skipped.
+        ball_location (SharedPosition): Shared record of the latest position
+            of ball 0.
+        detector (Detector): Ball detector to run on every frame. Defaults to
+            ContourDetector.
+        results (Connection): Optional pipe end on which every detection is
+            sent as soon as it is made, for PositionStreamer.
+        balls (int): Number of balls in the scene. With more than one, every
+            ball found is sent on results and the shared record holds ball 0.
+        detect_time (Histogram): Optional shared histogram of detection times.
     Returns:
         None
     """
     app_log.info('Processing frames...')
+    if detector is None:
+        detector = ContourDetector()
     while True:
 
         try:
@@ -72,43 +415,271 @@ def process_frame(queue, ball_location_x, ball_location_y) -> None:
         except queue.Empty:
             print('Empty queue')
 
-        # Convert the image to grayscale for easier ball detection
-        gray_image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        started = time.monotonic()
+        detections = detector.detect_all(image) if balls > 1 else [detector.detect(image)]
+        finished = time.monotonic()
+        if detect_time is not None:
+            detect_time.observe(finished - started)
+        if isinstance(queue, SharedFrameRing) and not queue.is_current(queue.last_read):
+            # The receiver wrapped around onto the frame while detection was
+            # reading it, so the detections may come from a torn frame
+            queue.discard()
+            continue
+
+        for detection in detect_timed(detections, started, finished):
+            # Store the ball center coordinates in shared memory
+            if detection.ball == 0:
+                publish_position(ball_location, detection)
+            if results is not None:
+                results.send(detection)
+
+
+def convert_frame(item, frame_format="bgr24", receipts=None):
+    """
+    Convert stage of a pipeline: turns a received (frame, received_at) pair
+    into the image handed to detection, as ImageDisplayReceiver does.
+    """
+    frame, received_at = item
+    image = luma_plane(frame) if frame_format == "gray" else frame.to_ndarray(format="bgr24")
+    if receipts is not None:
+        receipts.record(read_tag(image), received_at)
+    return image
 
-        # Perform ball detection using and apply thresholding to separate the ball from the background
-        _, binary_image = cv.threshold(
-            gray_image, 0, 255, cv.THRESH_BINARY_INV+cv.THRESH_OTSU)
 
-        # Find contours in the binary image
-        contours, _ = cv.findContours(
-            binary_image, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+def show_frame(image, display, tagged=False):
+    """
+    Display stage of a pipeline: hands the image to the display thread and
+    passes it on.
+    """
+    display.show(strip_tag(image) if tagged else image)
+    return image
 
-        # Initialize placeholder for ball coordinates
-        ball_x = None
-        ball_y = None
-        # Process each contour
-        for contour in contours:
-            # Compute the center of each contour
-            (x, y, w, h) = cv.boundingRect(contour)
-            center_x = x + w // 2
-            center_y = y + h // 2
 
-            # Store the ball center coordinates
-            ball_x = center_x
-            ball_y = center_y
+def detect_frame(image, detector, balls=1):
+    """
+    Detect stage of a pipeline: returns the detections in an image, or None
+    if no ball was found. Picklable, so that it can run in a process stage.
+    """
+    started = time.monotonic()
+    detections = detector.detect_all(image) if balls > 1 else [detector.detect(image)]
+    return detect_timed(detections, started, time.monotonic()) or None
 
-        # Store the ball coordinates as a multiprocessing.Value
-        if ball_x is not None and ball_y is not None:
-            ball_location_x.value, ball_location_y.value = ball_x, ball_y
 
-        print("Current ball location to be dispatched to server\n",
-              (ball_location_x.value, ball_location_y.value))
+def report_detections(detections, ball_location, streamer=None) -> None:
+    """
+    Report stage of a pipeline: publishes the position of ball 0 for the
+    server's prompts and pushes every detection to streamer.
+    """
+    for detection in detections:
+        if detection.ball == 0:
+            publish_position(ball_location, detection)
+        if streamer is not None:
+            streamer.publish(detection)
 
-        # Exit if 'q' is pressed
-        if cv.waitKey(1) & 0xFF == ord('q'):
-            break
 
-    cv.destroyAllWindows()
+def build_pipeline(spec: str, ball_location, frame_format="bgr24", detector=None, balls=1,
+                   streamer=None, display=None, receipts=None) -> Pipeline:
+    """
+    Assembles the client's frame path from a pipeline spec, see
+    pipeline.parse_spec(), e.g. "convert,display:thread,detect:process,report".
+
+    Args:
+        spec (str): Stages from PIPELINE_STAGES with their settings. Every
+            stage takes what the previous one returns, so they keep the order
+            of PIPELINE_STAGES; convert is needed by the others and detect by
+            report. Leaving out display runs headless, leaving out report
+            only measures the stages.
+        ball_location (SharedPosition): Where the report stage publishes the
+            position of ball 0.
+        frame_format (str): One of FRAME_FORMATS.
+        detector (Detector): Ball detector. Defaults to ContourDetector.
+        balls (int): Number of balls in the scene.
+        streamer (PositionStreamer): Pushes detections in push mode; it lives
+            on the event loop, so report must then be inline.
+        display (FrameDisplay): Window for the display stage.
+        receipts (ReceiptLog): Decoding times of tagged frames; None if the
+            frames are not tagged.
+    Returns:
+        Pipeline: The pipeline, to run with PipelineReceiver.
+    """
+    if detector is None:
+        detector = ContourDetector()
+    functions = {
+        "convert": functools.partial(
+            convert_frame, frame_format=frame_format, receipts=receipts),
+        "display": functools.partial(
+            show_frame, display=display, tagged=receipts is not None),
+        "detect": functools.partial(detect_frame, detector=detector, balls=balls),
+        "report": functools.partial(
+            report_detections, ball_location=ball_location, streamer=streamer),
+    }
+
+    configs = parse_spec(spec)
+    names = [config["name"] for config in configs]
+    unknown = set(names) - set(PIPELINE_STAGES)
+    if unknown:
+        raise ValueError("Unknown pipeline stages: %s" % ", ".join(sorted(unknown)))
+    if names != sorted(names, key=PIPELINE_STAGES.index) or len(set(names)) != len(names):
+        raise ValueError("Pipeline stages must appear once, in the order %s" %
+                         ", ".join(PIPELINE_STAGES))
+    if names[0] != "convert":
+        raise ValueError("The pipeline needs a convert stage")
+    if "report" in names and "detect" not in names:
+        raise ValueError("The report stage needs a detect stage")
+    if "display" in names and display is None:
+        raise ValueError("The display stage needs a display; drop it to run headless")
+
+    stages = []
+    for config in configs:
+        if config["name"] == "report" and streamer is not None and \
+                config["concurrency"] != "inline":
+            raise ValueError("The report stage must be inline in push mode")
+        stages.append(Stage(config["name"], functions[config["name"]], config["concurrency"],
+                            config["queue_size"], config["policy"]))
+    return Pipeline(stages, stage_time, stage_dropped)
+
+
+class PipelineReceiver(MediaStreamTrack):
+    """
+    Media Stream Track running a client Pipeline on the frames of the remote
+    track, instead of the fixed path of ImageDisplayReceiver and
+    process_frame.
+
+    The pipeline runs in a task of its own. recv() hands every frame to its
+    receive stage and returns the frame unchanged, like any other track. The
+    track ends, and the pipeline finishes the frames it holds, when the
+    remote track ends or the display window is quit.
+    """
+
+    kind = "video"
+
+    def __init__(self, track, pipeline, display=None):
+        super().__init__()
+        self.track = track
+        self.pipeline = pipeline
+        self.display = display
+        # (frame, received_at) pairs for the receive stage, None at the end
+        self._frames = asyncio.Queue(1)
+        self._task = None
+
+    async def _received(self):
+        while True:
+            item = await self._frames.get()
+            if item is None:
+                return
+            yield item
+
+    async def _finish(self) -> None:
+        if self._task is not None and not self._task.done():
+            await self._frames.put(None)
+            await self._task
+
+    async def recv(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.pipeline.run(self._received()))
+        if self.display is not None and self.display.quit_requested:
+            await self._finish()
+            raise MediaStreamError
+        try:
+            frame = await self.track.recv()
+        except MediaStreamError:
+            await self._finish()
+            raise
+        frames_received.inc()
+        await self._frames.put((frame, time.monotonic()))
+        return frame
+
+    def stop(self) -> None:
+        super().stop()
+        if self._task is not None:
+            self._task.cancel()
+
+
+class PositionStreamer:
+    """
+    Pushes ball positions to the server as soon as they are detected, instead
+    of waiting for the server's prompt.
+
+    Positions are sent on every detection, or at most rate times per second.
+    When rate limited, the binary format sends every position detected since
+    the last message as one batch; the text format sends the newest one.
+
+    Positions detected in untagged frames are numbered in the order they are
+    published, as report_seq, so that the server can discard reports that
+    arrive out of order on an unordered channel.
+    """
+
+    def __init__(self, report_format="text", rate=0, receipts=None):
+        """
+        Args:
+            report_format (str): Wire format of position reports.
+            rate (float): Maximum messages per second, 0 for no limit.
+            receipts (ReceiptLog): Decoding times of tagged frames. With it,
+                binary reports carry the queue, detect and report stage
+                durations of detections made by TaggedDetector.
+        """
+        self.report_format = report_format
+        self.receipts = receipts
+        self.interval = 1 / rate if rate else 0
+        self.channel = None
+        # (detection, report_seq) pairs waiting for the next message
+        self.pending = deque(maxlen=STREAM_BATCH)
+        self.sent = 0
+        self.report_seq = 0
+        self._last_sent = None
+
+    def publish(self, detection) -> None:
+        """
+        Queues a detection and sends it if the rate limit allows. Must be
+        called from the event loop thread.
+        """
+        report_seq = None
+        if detection.seq is None:
+            report_seq = self.report_seq
+            self.report_seq = (self.report_seq + 1) % REPORT_SEQ_LIMIT
+        self.pending.append((detection, report_seq))
+        self.flush()
+
+    def _report(self, detection, report_seq, now: float) -> PositionReport:
+        stages = None
+        received_at = None if self.receipts is None else self.receipts.get(detection.seq)
+        if received_at is not None and detection.timing is not None:
+            started, finished = detection.timing
+            stages = (started - received_at, finished - started, now - finished)
+        detected_at = None if detection.timing is None else detection.timing[1]
+        return PositionReport(detection.seq, detected_at, detection.x, detection.y,
+                              detection.confidence, detection.ball, stages, report_seq)
+
+    def flush(self) -> None:
+        if not self.pending or self.channel is None or self.channel.readyState != "open":
+            return
+        now = time.monotonic()
+        if self._last_sent is not None and now - self._last_sent < self.interval:
+            return
+        reports = [self._report(detection, report_seq, now)
+                   for detection, report_seq in self.pending]
+        self.channel.send(encode_message(reports, self.report_format))
+        channel_messages.labels("sent").inc()
+        self.pending.clear()
+        self._last_sent = now
+        self.sent += 1
+
+    def follow(self, connection, loop) -> threading.Thread:
+        """
+        Starts a thread that forwards detections received on a pipe, as sent
+        by process_frame, to publish() on the event loop.
+        """
+        def forward():
+            while True:
+                try:
+                    detection = connection.recv()
+                except EOFError:
+                    break
+                loop.call_soon_threadsafe(self.publish, detection)
+
+        thread = threading.Thread(target=forward, daemon=True)
+        thread.start()
+        return thread
 
 
 async def consume_signaling(pc, signaling) -> None:
@@ -134,18 +705,22 @@ async def consume_signaling(pc, signaling) -> None:
                 await signaling.send(pc.localDescription)
         elif isinstance(obj, RTCIceCandidate):
             await pc.addIceCandidate(obj)
-        elif obj is BYE:
+        elif obj is BYE or obj is None:
+            # None means the signaling connection was closed
             app_log.warning('Exiting...')
             break
 
 
-async def run_answer(pc, signaling) -> None:
+async def run_answer(pc, signaling, report_format="text", streamer=None) -> None:
     """
     Runs the answer path for handling data channels and sending responses.
 
     Args:
         pc (RTCPeerConnection): Peer connection object.
         signaling: Signaling object for communication.
+        report_format (str): Wire format of position reports, see protocol.py.
+        streamer (PositionStreamer): Pushes positions on the data channel as
+            they are detected, in addition to answering the server's prompts.
     Returns:
         None
     """
@@ -154,27 +729,47 @@ async def run_answer(pc, signaling) -> None:
     @pc.on("datachannel")
     def on_datachannel(channel):
         print("current channel is", channel.label)
+        if streamer is not None:
+            streamer.channel = channel
 
         @channel.on("message")
         def on_message(message):
+            channel_messages.labels("received").inc()
             print(f"channel({channel.label}): {message}")
 
             if isinstance(message, str) and message.startswith("Server"):
-                # reply
-                message = f"({ball_location_x.value}, {ball_location_y.value})"
-                print("Client sending current ball location\n", message)
-                channel.send(message)
+                # reply with the latest position, once there is one
+                report = ball_location.read()
+                if report is None:
+                    return
+                print("Client sending current ball location\n", encode_text(report))
+                channel.send(encode_message([report], report_format))
+                channel_messages.labels("sent").inc()
 
     await consume_signaling(pc, signaling)
 
 
-async def run_signaling(pc, signaling) -> None:
+async def run_signaling(pc, signaling, queue=None, policy="drop-oldest",
+                        report_format="text", streamer=None, frame_format="bgr24",
+                        display=None, receipts=None, pipeline=None,
+                        recorder=None) -> None:
     """
     Runs the signaling path on the client side.
 
     Args:
         pc (RTCPeerConnection): Peer connection object.
         signaling: Signaling object for communication.
+        queue: Destination for decoded frames, see ImageDisplayReceiver.
+        policy (str): Backpressure policy for the frame queue.
+        report_format (str): Wire format of position reports.
+        streamer (PositionStreamer): Pushes positions as they are detected.
+        frame_format (str): Format of the frames handed to detection.
+        display (FrameDisplay): Window showing the frames; None for headless.
+        receipts (ReceiptLog): Decoding times of tagged frames; None if the
+            frames are not tagged.
+        pipeline (Pipeline): Runs the frames through this pipeline instead
+            of handing them to queue.
+        recorder (FrameRecorder): Records the frames handed to queue.
     Returns:
         None
     """
@@ -183,37 +778,182 @@ async def run_signaling(pc, signaling) -> None:
     @pc.on("track")
     def on_track(track):
         app_log.info("Receiving %s" % track.kind)
-        if track.kind == "video":
-            pc.addTrack(ImageDisplayReceiver(track))
+        if track.kind == "video" and pipeline is not None:
+            # Pull the frames through without sending them back to the server
+            sink = MediaBlackhole()
+            sink.addTrack(PipelineReceiver(track, pipeline, display))
+            asyncio.ensure_future(sink.start())
+        elif track.kind == "video":
+            pc.addTrack(ImageDisplayReceiver(
+                track, queue, policy, frame_format, display, receipts, recorder))
 
     # connect signaling
     await signaling.connect()
 
-    await run_answer(pc, signaling)
+    await run_answer(pc, signaling, report_format, streamer)
 
 
 if __name__ == "__main__":
-    signaling = TcpSocketSignaling(HOST_IP, PORT_NO)
+    parser = argparse.ArgumentParser(
+        description="Bouncing ball client")
+    parser.add_argument("--frame-transport", choices=FRAME_TRANSPORTS, default="shm",
+                        help="How decoded frames reach the detection process: "
+                        "a shared-memory ring or a pickling queue (default: shm)")
+    parser.add_argument("--backpressure", choices=BACKPRESSURE_POLICIES, default="drop-oldest",
+                        help="What to do with new frames when detection falls behind "
+                        "(default: drop-oldest)")
+    parser.add_argument("--frame-format", choices=FRAME_FORMATS, default="bgr24",
+                        help="Detect on decoded frames converted to BGR, or directly on "
+                        "their luma plane (default: bgr24)")
+    parser.add_argument("--headless", action="store_true",
+                        help="Do not open a window; no HighGUI call is made")
+    parser.add_argument("--display-rate", type=float, default=DISPLAY_RATE,
+                        help="Most window refreshes per second; only the newest frame "
+                        "is drawn (default: %d, 0 for no limit)" % DISPLAY_RATE)
+    parser.add_argument("--detector", choices=DETECTORS, default="contour",
+                        help="Ball detection backend (default: contour)")
+    parser.add_argument("--tracking", action="store_true",
+                        help="Search for the ball near its last known position "
+                        "before scanning the whole frame")
+    parser.add_argument("--balls", type=int, default=1,
+                        help="Number of balls in the server's scene; with more than one, "
+                        "push mode reports every ball (default: 1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of detection processes (default: 1)")
+    parser.add_argument("--ordering", choices=RESULT_ORDERINGS, default="ordered",
+                        help="With several workers, publish positions in frame order "
+                        "or only keep the newest (default: ordered)")
+    parser.add_argument("--frame-tags", action="store_true",
+                        help="Read the frame sequence numbers the server embeds with "
+                        "--frame-tags, and report per-stage latencies in push mode")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics "
+                        "(default: disabled)")
+    parser.add_argument("--pipeline", default=None,
+                        help="Run the frames through stages assembled from SPEC, e.g. "
+                        "convert,display:thread,detect:process:2:keep-latest,report; "
+                        "each stage is name[:inline|thread|process[:queue size[:policy]]] "
+                        "(default: the fixed frame path)")
+    parser.add_argument("--record", default=None, metavar="PATH",
+                        help="Record the frames handed to detection to PATH, for "
+                        "recording.py replay; use --frame-tags to match them with the "
+                        "server's recording (default: disabled)")
+    parser.add_argument("--record-frames", type=int, default=1000,
+                        help="Most frames recorded with --record (default: 1000)")
+    parser.add_argument("--report-format", choices=REPORT_FORMATS, default="text",
+                        help="Wire format of position reports (default: text)")
+    parser.add_argument("--report-mode", choices=REPORT_MODES, default="poll",
+                        help="Answer the server's prompts, or push a position for every "
+                        "detection (default: poll)")
+    parser.add_argument("--report-rate", type=float, default=0,
+                        help="Maximum position messages per second in push mode "
+                        "(default: 0, no limit)")
+    args = parser.parse_args()
 
-    peer_connection = RTCPeerConnection()
     loop = asyncio.get_event_loop()
+    if args.frame_format == "gray" and args.balls > 1:
+        parser.error("--frame-format gray cannot tell several balls apart")
+    if args.workers > 1 and args.balls > 1:
+        parser.error("--workers reports one ball per frame; drop --workers or --balls")
+    if args.pipeline and args.workers > 1:
+        parser.error("--pipeline runs detection in its detect stage; drop --workers")
+    if args.pipeline and args.record:
+        parser.error("--record records the fixed frame path; drop --pipeline")
+    detector = create_detector(args.detector, args.tracking, args.balls)
+    receipts = None
+    frame_height = HEIGHT
+    if args.frame_tags:
+        detector = TaggedDetector(detector)
+        receipts = ReceiptLog()
+        frame_height += TAG_ROWS
+    frame_shape = (frame_height, WIDTH)
+    if args.frame_format == "bgr24":
+        frame_shape += (3,)
+    ball_location = SharedPosition()
+    recorder = None
+    if args.record:
+        recorder = FrameRecorder(args.record, frame_shape, args.record_frames, args.balls,
+                                 tagged=args.frame_tags)
+
+    streamer = None
+    results_recv = results_send = None
+    if args.report_mode == "push":
+        streamer = PositionStreamer(args.report_format, args.report_rate, receipts)
+        if not args.pipeline:
+            results_recv, results_send = Pipe(duplex=False)
+            streamer.follow(results_recv, loop)
+
+    display = None
+    if not args.headless:
+        display = FrameDisplay(args.display_rate)
+
+    pipeline = None
+    if args.pipeline:
+        try:
+            pipeline = build_pipeline(args.pipeline, ball_location, args.frame_format,
+                                      detector, args.balls, streamer, display, receipts)
+        except ValueError as exc:
+            ball_location.close()
+            parser.error(str(exc))
+        for stage in pipeline.stages:
+            stage_queue_depth.labels(stage.name).set_function(stage.qsize)
+            stage_utilization.labels(stage.name).set_function(stage.stats.utilization)
+
+    def store_ball_location(seq, detection):
+        if detection is not None:
+            publish_position(ball_location, detection)
+            if streamer is not None:
+                loop.call_soon_threadsafe(streamer.publish, detection)
+
+    if args.workers > 1:
+        # The pool always reads frames from its own shared-memory ring
+        frame_queue = DetectionPool(frame_shape, store_ball_location, detector,
+                                    workers=args.workers, ordering=args.ordering,
+                                    detect_time=detection_time)
+    elif args.frame_transport == "shm" and pipeline is None:
+        # Only keep-latest lets detection skip queued frames
+        frame_queue = SharedFrameRing(frame_shape, latest=args.backpressure == "keep-latest")
 
-    ball_location_x = Value('i', 0)
-    ball_location_y = Value('i', 0)
-    process_a = Process(target=process_frame,
-                        args=(frame_queue, ball_location_x, ball_location_y))
+    signaling = TcpSocketSignaling(HOST_IP, PORT_NO)
 
-    print(
-        f"Initial ball location before processing frames \n x: {ball_location_x.value} \n y: {ball_location_y.value}")
+    peer_connection = RTCPeerConnection()
 
-    process_a.start()
+    if display is not None:
+        display.start()
 
-    app_log.info('PID of process_a: %s' % process_a.pid)
+    frame_queue_depth.set_function(frame_queue.qsize)
+    if args.metrics_port is not None:
+        loop.run_until_complete(
+            MetricsServer(metrics_registry, port=args.metrics_port).start())
+
+    process_a = None
+    if isinstance(frame_queue, DetectionPool):
+        frame_queue.start()
+    elif pipeline is None:
+        process_a = Process(target=process_frame,
+                            args=(frame_queue, ball_location, detector,
+                                  results_send, args.balls, detection_time))
+        process_a.start()
+        app_log.info('PID of process_a: %s' % process_a.pid)
     try:
         loop.run_until_complete(
-            run_signaling(peer_connection, signaling))
+            run_signaling(peer_connection, signaling, frame_queue,
+                          args.backpressure, args.report_format, streamer,
+                          args.frame_format, display, receipts, pipeline, recorder))
     except KeyboardInterrupt:
         pass
     finally:
         loop.run_until_complete(signaling.close())
         loop.run_until_complete(peer_connection.close())
+        if process_a is not None:
+            process_a.terminate()
+        if isinstance(frame_queue, (SharedFrameRing, DetectionPool)):
+            frame_queue.close()
+        if display is not None:
+            display.close()
+        if pipeline is not None:
+            app_log.info("Pipeline:\n%s" % pipeline.summary())
+        if recorder is not None:
+            recorder.close()
+            app_log.info("Recorded %d frames to %s" % (recorder.count, recorder.path))
+        ball_location.close()
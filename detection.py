@@ -0,0 +1,460 @@
+import time
+from collections import namedtuple
+
+import cv2 as cv
+import numpy as np
+
+from frame_tags import read_tag, strip_tag
+from scene import SCENE_PALETTE
+
+# Extra pixels searched around the predicted ball box by BallTracker
+ROI_MARGIN = 8
+# Grayscale level below which MomentsDetector counts a pixel as ball
+MOMENTS_THRESHOLD = 128
+# Subsampling step of the coarse search in PyramidDetector
+PYRAMID_FACTOR = 4
+
+# Integer BGR to gray weights summing to 256, as in ITU-R BT.601
+_GRAY_WEIGHTS = np.array([29, 150, 77], dtype=np.uint16)
+
+Detection = namedtuple(
+    "Detection", ["x", "y", "box", "ball", "seq", "timing", "confidence"],
+    defaults=[0, None, None, None])
+Detection.__doc__ = """
+Ball position reported by a detector: the centre (x, y) in pixels, the
+bounding box (x, y, w, h) of the pixels it was computed from and the ball id,
+which is 0 unless assigned by BallMatcher. For tagged frames, TaggedDetector
+adds the server's frame sequence number and the time.monotonic() at which
+detection started and finished, as timing. confidence, from 0 to 1, is how
+ball-like the detected blob is, see ball_confidence().
+"""
+
+
+def ball_confidence(box, area) -> float:
+    """
+    Scores how ball-like a blob is, from 0 to 1: its area relative to the
+    disc inscribed in its bounding box, times the box's aspect ratio. A whole
+    ball scores close to 1; a ball cut off by the frame edge, merged with
+    another ball or smeared by the codec scores lower.
+
+    Args:
+        box (tuple): Bounding box (x, y, w, h) of the blob.
+        area (float): Area of the blob in pixels.
+    """
+    _, _, w, h = box
+    if not w or not h:
+        return 0.0
+    fill = area / (np.pi * w * h / 4)
+    return float(min(fill, 1.0) * min(w, h) / max(w, h))
+
+
+def find_ball_blobs(image) -> list:
+    """
+    Finds the balls with an Otsu threshold and contour search over the image.
+
+    Args:
+        image (ndarray): BGR image, or a single grayscale or luma plane.
+
+    Returns:
+        list: (box, area) of every contour found: its bounding box
+        (x, y, w, h) and the number of pixels it encloses.
+    """
+    # Convert the image to grayscale for easier ball detection
+    if image.ndim == 2:
+        gray_image = image
+    else:
+        gray_image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+
+    # Apply thresholding to separate the ball from the background
+    _, binary_image = cv.threshold(
+        gray_image, 0, 255, cv.THRESH_BINARY_INV+cv.THRESH_OTSU)
+
+    # Find contours in the binary image
+    contours, _ = cv.findContours(
+        binary_image, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+
+    # The contour runs through the centres of the boundary pixels, so its
+    # area misses half a pixel along the whole boundary
+    return [(cv.boundingRect(contour),
+             cv.contourArea(contour) + cv.arcLength(contour, True) / 2 + 1)
+            for contour in contours]
+
+
+def find_ball_boxes(image) -> list:
+    """
+    Returns the bounding boxes (x, y, w, h) of the contours found by
+    find_ball_blobs().
+    """
+    return [box for box, _ in find_ball_blobs(image)]
+
+
+def find_ball_box(image):
+    """
+    Returns the bounding box (x, y, w, h) of the last contour found by
+    find_ball_boxes(), or None.
+    """
+    boxes = find_ball_boxes(image)
+    return boxes[-1] if boxes else None
+
+
+def box_center(box) -> tuple:
+    """
+    Returns the center of a bounding box (x, y, w, h) in integer pixels.
+    """
+    x, y, w, h = box
+    return x + w // 2, y + h // 2
+
+
+def _offset(detection, dx, dy):
+    """
+    Translates a detection made in a crop back to frame coordinates.
+    """
+    x, y, w, h = detection.box
+    return detection._replace(x=detection.x + dx, y=detection.y + dy,
+                              box=(x + dx, y + dy, w, h))
+
+
+class Detector:
+    """
+    Base class for ball detectors.
+
+    Subclasses implement detect(), which takes a BGR image, or a grayscale
+    image such as the Y plane of a decoded frame, and returns a Detection, or
+    None when there is no ball in the image. Detectors that can
+    tell several balls apart set multi and override detect_all().
+    """
+
+    name = None
+    multi = False
+
+    def detect(self, image):
+        raise NotImplementedError
+
+    def detect_all(self, image) -> list:
+        """
+        Returns a Detection for every ball in the image.
+        """
+        detection = self.detect(image)
+        return [] if detection is None else [detection]
+
+    def __call__(self, image):
+        return self.detect(image)
+
+
+class ContourDetector(Detector):
+    """
+    Otsu threshold and contour search; reports the bounding-box centre of the
+    last contour found.
+    """
+
+    name = "contour"
+    multi = True
+
+    def detect(self, image):
+        blobs = find_ball_blobs(image)
+        if not blobs:
+            return None
+        box, area = blobs[-1]
+        return Detection(*box_center(box), box, confidence=ball_confidence(box, area))
+
+    def detect_all(self, image) -> list:
+        return [Detection(*box_center(box), box, confidence=ball_confidence(box, area))
+                for box, area in find_ball_blobs(image)]
+
+
+class MomentsDetector(Detector):
+    """
+    Fixed threshold and centroid from image moments, in NumPy only.
+
+    The moments are computed from the row and column projections of the
+    thresholded image, so the cost is one pass over the frame plus two
+    reductions.
+    """
+
+    name = "moments"
+
+    def __init__(self, threshold=MOMENTS_THRESHOLD):
+        """
+        Args:
+            threshold (int): Grayscale level below which a pixel is ball.
+        """
+        self.threshold = threshold
+
+    def detect(self, image):
+        if image.ndim == 2:
+            mask = image < self.threshold
+        else:
+            # Gray level scaled by 256, without leaving 16-bit integers
+            gray = np.multiply(image[..., 0], _GRAY_WEIGHTS[0], dtype=np.uint16)
+            gray += np.multiply(image[..., 1], _GRAY_WEIGHTS[1], dtype=np.uint16)
+            gray += np.multiply(image[..., 2], _GRAY_WEIGHTS[2], dtype=np.uint16)
+            mask = gray < (self.threshold << 8)
+
+        columns = mask.sum(axis=0, dtype=np.int32)
+        m00 = columns.sum()
+        if m00 == 0:
+            return None
+        rows = mask.sum(axis=1, dtype=np.int32)
+
+        xs = np.flatnonzero(columns)
+        ys = np.flatnonzero(rows)
+        x0, y0 = int(xs[0]), int(ys[0])
+        box = (x0, y0, int(xs[-1]) - x0 + 1, int(ys[-1]) - y0 + 1)
+
+        # First order moments over the projections give the centroid
+        m10 = columns @ np.arange(columns.size)
+        m01 = rows @ np.arange(rows.size)
+        return Detection(int(round(m10 / m00)), int(round(m01 / m00)), box,
+                         confidence=ball_confidence(box, int(m00)))
+
+
+class PyramidDetector(Detector):
+    """
+    Coarse-to-fine search: finds the ball in a subsampled copy of the frame,
+    then refines its position at full resolution around the coarse box.
+    """
+
+    name = "pyramid"
+
+    def __init__(self, factor=PYRAMID_FACTOR, refine=None):
+        """
+        Args:
+            factor (int): Subsampling step of the coarse search.
+            refine (Detector): Detector used at both levels. Defaults to
+                MomentsDetector.
+        """
+        self.factor = factor
+        self.refine = MomentsDetector() if refine is None else refine
+
+    def detect(self, image):
+        f = self.factor
+        coarse = self.refine.detect(image[::f, ::f])
+        if coarse is None:
+            # The ball may fall between sampled pixels at coarse resolution
+            return self.refine.detect(image)
+
+        height, width = image.shape[:2]
+        x, y, w, h = coarse.box
+        x0, y0 = max((x - 1) * f, 0), max((y - 1) * f, 0)
+        x1, y1 = min((x + w + 1) * f, width), min((y + h + 1) * f, height)
+
+        fine = self.refine.detect(image[y0:y1, x0:x1])
+        if fine is None:
+            return None
+        return _offset(fine, x0, y0)
+
+
+DETECTORS = {
+    detector.name: detector
+    for detector in (ContourDetector, MomentsDetector, PyramidDetector)
+}
+
+
+class BallTracker(Detector):
+    """
+    Tracks the ball by searching a window around its predicted position.
+
+    The window is centred on the last position advanced by the last observed
+    velocity, and is wide enough to also contain the ball right after a
+    bounce. When the ball is not found, or touches the edge of the window and
+    may be cut off, the whole frame is searched instead, so the result is the
+    same as running the wrapped detector on the full frame.
+    """
+
+    def __init__(self, detector=None, margin=ROI_MARGIN):
+        """
+        Args:
+            detector (Detector): Detector run on the window and on full
+                frames. Defaults to ContourDetector.
+            margin (int): Extra pixels searched around the predicted ball box.
+        """
+        self.detector = ContourDetector() if detector is None else detector
+        self.name = "%s+tracking" % self.detector.name
+        self.margin = margin
+        self.box = None
+        self.velocity = (0, 0)
+        self.full_scans = 0
+        self.roi_scans = 0
+
+    def reset(self) -> None:
+        self.box = None
+        self.velocity = (0, 0)
+
+    def _search_window(self, height, width):
+        x, y, w, h = self.box
+        vx, vy = self.velocity
+        # A bounce flips the velocity, so the ball may land 2 * |v| away from
+        # the prediction.
+        pad_x = 2 * abs(vx) + self.margin
+        pad_y = 2 * abs(vy) + self.margin
+        x0 = max(x + vx - pad_x, 0)
+        y0 = max(y + vy - pad_y, 0)
+        x1 = min(x + vx + w + pad_x, width)
+        y1 = min(y + vy + h + pad_y, height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def _detect_in_window(self, image):
+        height, width = image.shape[:2]
+        window = self._search_window(height, width)
+        if window is None:
+            return None
+        x0, y0, x1, y1 = window
+
+        detection = self.detector.detect(image[y0:y1, x0:x1])
+        if detection is None:
+            return None
+        x, y, w, h = detection.box
+
+        # A box touching an inner edge of the window may be truncated
+        if (x == 0 and x0 > 0) or (y == 0 and y0 > 0) or \
+                (x + w == x1 - x0 and x1 < width) or (y + h == y1 - y0 and y1 < height):
+            return None
+        return _offset(detection, x0, y0)
+
+    def detect(self, image):
+        detection = None
+        if self.box is not None:
+            detection = self._detect_in_window(image)
+            self.roi_scans += 1
+        if detection is None:
+            detection = self.detector.detect(image)
+            self.full_scans += 1
+
+        if detection is None:
+            self.reset()
+            return None
+
+        if self.box is not None:
+            (last_x, last_y), (x, y) = box_center(self.box), box_center(detection.box)
+            self.velocity = (x - last_x, y - last_y)
+        self.box = detection.box
+        return detection
+
+
+class BallMatcher(Detector):
+    """
+    Detects several balls and assigns them the ids of the server's scene.
+
+    Each detection gets the id whose SCENE_PALETTE colour is nearest to the
+    colour at its centre. Balls sharing a colour, when there are more balls
+    than palette entries, are told apart by their distance to the positions
+    matched in the previous frame.
+    """
+
+    def __init__(self, balls, detector=None, palette=SCENE_PALETTE):
+        """
+        Args:
+            balls (int): Number of balls in the scene.
+            detector (Detector): Multi-ball detector. Defaults to
+                ContourDetector.
+            palette (sequence): BGR colour of each ball id, repeating.
+        """
+        self.detector = ContourDetector() if detector is None else detector
+        if not self.detector.multi:
+            raise ValueError("Detector %s cannot tell balls apart" % self.detector.name)
+        self.name = "%s+matching" % self.detector.name
+        self.multi = True
+        self.balls = balls
+        self.palette = np.array(palette, dtype=np.int32)
+        # Last matched position by ball id
+        self.positions = {}
+
+    def _candidates(self, color_index):
+        return range(color_index, self.balls, len(self.palette))
+
+    def detect_all(self, image) -> list:
+        if image.ndim == 2:
+            raise ValueError("Balls are matched by colour and need BGR frames")
+        detections = self.detector.detect_all(image)
+        if not detections:
+            return []
+        height, width = image.shape[:2]
+        centers = np.array([(d.x, d.y) for d in detections])
+        colors = image[np.clip(centers[:, 1], 0, height - 1),
+                       np.clip(centers[:, 0], 0, width - 1)].astype(np.int32)
+        distances = ((colors[:, None, :] - self.palette[None, :, :]) ** 2).sum(axis=2)
+        color_indices = distances.argmin(axis=1)
+
+        matched = []
+        taken = set()
+        for detection, color_index in zip(detections, color_indices):
+            free = [ball for ball in self._candidates(int(color_index)) if ball not in taken]
+            if not free:
+                continue
+            ball = min(free, key=lambda ball: self._distance(ball, detection))
+            taken.add(ball)
+            matched.append(detection._replace(ball=ball))
+
+        self.positions = {d.ball: (d.x, d.y) for d in matched}
+        return matched
+
+    def _distance(self, ball, detection):
+        if ball not in self.positions:
+            # Unseen balls come after every seen one, lowest id first
+            return (1, ball)
+        x, y = self.positions[ball]
+        return (0, (x - detection.x) ** 2 + (y - detection.y) ** 2)
+
+    def detect(self, image):
+        for detection in self.detect_all(image):
+            if detection.ball == 0:
+                return detection
+        return None
+
+
+class TaggedDetector(Detector):
+    """
+    Runs a detector on frames carrying a frame tag (see frame_tags.py): reads
+    the server's frame sequence number from the tag band, detects on the
+    picture above it, and records when detection started and finished.
+    """
+
+    def __init__(self, detector):
+        """
+        Args:
+            detector (Detector): Detector run on the picture.
+        """
+        self.detector = detector
+        self.name = "%s+tags" % detector.name
+        self.multi = detector.multi
+
+    def _tagged(self, image, detect):
+        seq = read_tag(image)
+        started = time.monotonic()
+        result = detect(strip_tag(image))
+        timing = (started, time.monotonic())
+        return result, seq, timing
+
+    def detect(self, image):
+        detection, seq, timing = self._tagged(image, self.detector.detect)
+        if detection is None:
+            return None
+        return detection._replace(seq=seq, timing=timing)
+
+    def detect_all(self, image) -> list:
+        detections, seq, timing = self._tagged(image, self.detector.detect_all)
+        return [detection._replace(seq=seq, timing=timing) for detection in detections]
+
+
+def create_detector(name="contour", tracking=False, balls=1) -> Detector:
+    """
+    Builds a detector by backend name, optionally wrapped in a BallTracker,
+    or in a BallMatcher for scenes with several balls.
+
+    Args:
+        name (str): One of the keys of DETECTORS.
+        tracking (bool): Search near the last known position first.
+        balls (int): Number of balls in the scene.
+    Returns:
+        Detector: The detector.
+    """
+    if name not in DETECTORS:
+        raise ValueError("Unknown detector: %s" % name)
+    detector = DETECTORS[name]()
+    if balls > 1:
+        if tracking:
+            raise ValueError("Tracking follows a single ball")
+        return BallMatcher(balls, detector)
+    return BallTracker(detector) if tracking else detector
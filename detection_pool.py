@@ -0,0 +1,206 @@
+import os
+import queue
+import threading
+import time
+from multiprocessing import Process, Queue
+
+from detection import ContourDetector
+from frame_ring import SharedFrameRing
+from logger import app_log
+
+RESULT_ORDERINGS = ("ordered", "latest")
+# Frames that may wait for a free worker before put() reports the pool full
+POOL_BACKLOG = 4
+
+
+def detection_worker(ring, tasks, results, detector, detect_time=None) -> None:
+    """
+    Runs in a pool process: takes frame sequence numbers from tasks, detects
+    the ball in the matching ring slot and posts (seq, detection) to results.
+    The detection is None if there was no ball or the frame was overwritten
+    before detection finished.
+
+    Args:
+        ring (SharedFrameRing): Frames shared by all workers.
+        tasks (Queue): Sequence numbers of frames to process; None stops the
+            worker.
+        results (Queue): Destination of (seq, detection) pairs.
+        detector (Detector): Ball detector.
+        detect_time (Histogram): Optional shared histogram of detection times.
+    """
+    while True:
+        seq = tasks.get()
+        if seq is None:
+            break
+        frame = ring.frame(seq)
+        started = time.monotonic()
+        detection = None if frame is None else detector.detect(frame)
+        finished = time.monotonic()
+        if detect_time is not None and frame is not None:
+            detect_time.observe(finished - started)
+        if not ring.is_current(seq):
+            detection = None
+        elif detection is not None and detection.timing is None:
+            detection = detection._replace(timing=(started, finished))
+        results.put((seq, detection))
+
+
+class DetectionPool:
+    """
+    Pool of detection processes fed through a shared-memory frame ring.
+
+    Frames are published into the ring and only their sequence numbers go
+    through the task queue, so every idle worker can pick up the next frame.
+    A collector thread gathers the results and passes them to on_result
+    either in sequence order ("ordered") or as soon as they are newer than the
+    last one delivered ("latest").
+
+    The pool exposes the put/get_nowait interface of multiprocessing.Queue,
+    so it can be fed by FrameHandoff like a single detection process.
+    """
+
+    def __init__(self, shape, on_result, detector=None, workers=None,
+                 ordering="ordered", backlog=POOL_BACKLOG, detect_time=None):
+        """
+        Args:
+            shape (tuple): Shape of the frames, e.g. (480, 640, 3).
+            on_result (callable): Called with (seq, detection) from the
+                collector thread; detection is None if no ball was found.
+            detector (Detector): Ball detector, copied into every worker.
+                Defaults to ContourDetector.
+            workers (int): Number of processes. Defaults to the CPU count.
+            ordering (str): One of RESULT_ORDERINGS.
+            backlog (int): Frames that may wait for a free worker.
+            detect_time (Histogram): Optional shared histogram, see
+                metrics.py, updated by the workers with detection times.
+        """
+        if ordering not in RESULT_ORDERINGS:
+            raise ValueError("Unknown result ordering: %s" % ordering)
+        self.workers = workers or os.cpu_count() or 1
+        self.ordering = ordering
+        self.on_result = on_result
+        self.maxsize = backlog
+
+        # Every queued or in-flight frame needs its own slot, plus one for the
+        # frame being written.
+        self.ring = SharedFrameRing(shape, slots=backlog + self.workers + 2)
+        self.tasks = Queue(backlog)
+        self.results = Queue()
+        self._processes = [
+            Process(target=detection_worker, daemon=True,
+                    args=(self.ring, self.tasks, self.results,
+                          ContourDetector() if detector is None else detector,
+                          detect_time))
+            for _ in range(self.workers)
+        ]
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._started = False
+
+        self._lock = threading.Lock()
+        # Published frames that will never produce a result
+        self._skipped = set()
+        self.next_seq = 1
+        self.delivered = 0
+        self.missed = 0
+
+    def start(self) -> None:
+        for process in self._processes:
+            process.start()
+        self._collector.start()
+        self._started = True
+        app_log.info('Started %d detection workers' % self.workers)
+
+    def put(self, image, block=True, timeout=None) -> int:
+        """
+        Publishes a frame and queues it for detection.
+
+        Raises:
+            queue.Full: If the backlog is full and block is False, or no
+                worker freed up within timeout seconds.
+        """
+        if not block and self.tasks.full():
+            raise queue.Full
+        seq = self.ring.publish(image)
+        try:
+            self.tasks.put(seq, block, timeout)
+        except queue.Full:
+            self._skip(seq)
+            raise
+        return seq
+
+    def put_nowait(self, image) -> int:
+        return self.put(image, block=False)
+
+    def get_nowait(self) -> int:
+        """
+        Removes the oldest queued frame, which will then never be detected.
+
+        Returns:
+            int: Sequence number of the removed frame.
+        """
+        seq = self.tasks.get_nowait()
+        self._skip(seq)
+        return seq
+
+    def qsize(self) -> int:
+        return self.tasks.qsize()
+
+    def full(self) -> bool:
+        return self.tasks.full()
+
+    def empty(self) -> bool:
+        return self.tasks.empty()
+
+    def _skip(self, seq: int) -> None:
+        if self.ordering == "latest":
+            # The collector never waits for a frame in this mode
+            return
+        with self._lock:
+            self._skipped.add(seq)
+
+    def _collect(self) -> None:
+        pending = {}
+        while True:
+            item = self.results.get()
+            if item is None:
+                break
+            seq, detection = item
+
+            if self.ordering == "latest":
+                if seq >= self.next_seq:
+                    self.missed += seq - self.next_seq
+                    self.next_seq = seq + 1
+                    self._deliver(seq, detection)
+                continue
+
+            pending[seq] = detection
+            with self._lock:
+                while True:
+                    if self.next_seq in pending:
+                        self._deliver(self.next_seq, pending.pop(self.next_seq))
+                    elif self.next_seq in self._skipped:
+                        self._skipped.discard(self.next_seq)
+                        self.missed += 1
+                    elif len(pending) > self.maxsize + self.workers:
+                        # A result went missing; stop waiting for it
+                        self.missed += 1
+                    else:
+                        break
+                    self.next_seq += 1
+
+    def _deliver(self, seq, detection) -> None:
+        self.delivered += 1
+        self.on_result(seq, detection)
+
+    def close(self) -> None:
+        """
+        Stops the workers and the collector, then releases the frame ring.
+        """
+        if self._started:
+            for _ in self._processes:
+                self.tasks.put(None)
+            for process in self._processes:
+                process.join()
+            self.results.put(None)
+            self._collector.join()
+        self.ring.close()
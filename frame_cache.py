@@ -0,0 +1,102 @@
+from collections import OrderedDict
+
+
+class FrameCache:
+    """
+    Rendered frames keyed by the picture they show, within a memory cap,
+    evicting the least recently used frame when full.
+
+    The bouncing ball scene is deterministic and bounded, so its state comes
+    back to an earlier state after a finite number of frames and from then on
+    repeats with a fixed period. observe() is given the scene state after
+    every step and finds that period with Brent's cycle detection, in
+    constant memory. Once the period is known, a cache that already had to
+    evict cannot hold a whole cycle: under LRU every frame would then be
+    evicted just before it comes back, so the cache stops admitting frames
+    and keeps hitting the ones it holds.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes (int): Most bytes of frames kept.
+        """
+        if max_bytes <= 0:
+            raise ValueError("Frame cache size must be positive: %s" % max_bytes)
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.admitting = True
+
+        # Period of the scene state in frames, once detected
+        self.period = None
+        self._saved_state = None
+        self._power = 1
+        self._distance = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def observe(self, state) -> None:
+        """
+        Feeds the scene state after a step to the period detection.
+        """
+        if self.period is not None:
+            return
+        if self._saved_state is None:
+            self._saved_state = state
+            return
+        self._distance += 1
+        if state == self._saved_state:
+            self.period = self._distance
+            if self.evictions:
+                self.admitting = False
+            return
+        if self._distance == self._power:
+            self._saved_state = state
+            self._power *= 2
+            self._distance = 0
+
+    def get(self, key):
+        """
+        Returns the frame stored under key, or None.
+        """
+        frame = self._frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._frames.move_to_end(key)
+        return frame[0]
+
+    def put(self, key, frame, size: int) -> bool:
+        """
+        Stores a frame of size bytes under key, evicting the least recently
+        used frames to make room.
+
+        Returns:
+            bool: False if the frame was not stored, because it is larger than
+            the cache or the cache no longer admits frames.
+        """
+        if not self.admitting or size > self.max_bytes or key in self._frames:
+            return False
+        while self.resident_bytes + size > self.max_bytes:
+            _, (_, evicted_size) = self._frames.popitem(last=False)
+            self.resident_bytes -= evicted_size
+            self.evictions += 1
+        self._frames[key] = (frame, size)
+        self.resident_bytes += size
+        return True
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self) -> str:
+        return ("%d frames, %.1f MB resident, hit rate %.1f%%, %d evictions, period %s" % (
+            len(self._frames), self.resident_bytes / 1e6, self.hit_rate * 100,
+            self.evictions, "unknown" if self.period is None else "%d frames" % self.period))
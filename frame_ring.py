@@ -0,0 +1,281 @@
+import queue
+import time
+from multiprocessing import Event, resource_tracker, shared_memory
+
+import numpy as np
+
+# Slot sequence marker for a slot that is being written
+_WRITING = -1
+# Seconds between checks for a free slot in a blocking put()
+_PUT_POLL_INTERVAL = 0.001
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to an existing segment without letting this process's resource
+    tracker unlink it on exit; only the creating process owns the segment.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedFrameRing:
+    """
+    Fixed-slot ring of frames in shared memory for handing decoded frames to
+    another process without pickling them.
+
+    The segment starts with an int64 header: the sequence number of the last
+    published frame, the sequence number of the last frame read, the number
+    of frames the reader skipped, then one sequence number per slot. Frame
+    data follows the header. Sequence numbers start at 1; frame ``seq`` lives
+    in slot ``seq % slots``.
+
+    ``publish`` always succeeds and overwrites the oldest slot. The ring also
+    exposes the ``put``/``get`` interface of multiprocessing.Queue, with a
+    capacity of ``slots - 1`` unread frames, so it can stand in for the queue
+    used by the client. ``get`` returns a view into
+    shared memory that stays valid until the writer wraps around to the same
+    slot; use ``is_current`` to check a frame after processing it, or pass
+    ``copy=True``. The ring supports one writer and one reader.
+
+    Frames the reader never gets, because it skipped to the newest frame or
+    the writer overwrote them, are counted in shared memory, so the writer
+    sees them in ``skipped`` too.
+    """
+
+    def __init__(self, shape, slots=8, dtype=np.uint8, name=None, latest=True):
+        """
+        Args:
+            shape (tuple): Shape of every frame, e.g. (480, 640, 3).
+            slots (int): Number of frames held by the ring.
+            dtype: NumPy dtype of the frames.
+            name (str): Name of an existing segment to attach to. A new segment
+                is created when omitted.
+            latest (bool): Whether get() skips straight to the newest frame
+                by default, rather than returning frames in order.
+        """
+        if slots < 2:
+            raise ValueError("A frame ring needs at least two slots")
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        self.maxsize = slots - 1
+        self.latest = latest
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        header_bytes = (slots + 3) * 8
+
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=header_bytes + slots * self.frame_bytes)
+            self._event = Event()
+        else:
+            self._shm = _attach(name)
+            self._event = None
+
+        self._header = np.ndarray(
+            (slots + 3,), dtype=np.int64, buffer=self._shm.buf)
+        self._slot_seqs = self._header[3:]
+        self._frames = np.ndarray(
+            (slots,) + self.shape, dtype=self.dtype,
+            buffer=self._shm.buf, offset=header_bytes)
+        if self._owner:
+            self._header[:] = 0
+
+    def __getstate__(self):
+        return {
+            "name": self._shm.name,
+            "shape": self.shape,
+            "slots": self.slots,
+            "dtype": self.dtype.str,
+            "latest": self.latest,
+            "event": self._event,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], slots=state["slots"],
+                      dtype=state["dtype"], name=state["name"], latest=state["latest"])
+        self._event = state["event"]
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def last_read(self) -> int:
+        """
+        Sequence number of the last frame returned to the reader (0 if none).
+        """
+        return int(self._header[1])
+
+    @property
+    def skipped(self) -> int:
+        """
+        Number of published frames the reader skipped or discarded.
+        """
+        return int(self._header[2])
+
+    def discard(self, count=1) -> None:
+        """
+        Counts frames returned by get() as skipped, e.g. because they were
+        overwritten while being processed. Called by the reader.
+        """
+        self._header[2] += count
+
+    @property
+    def write_seq(self) -> int:
+        """
+        Sequence number of the most recently published frame (0 if none).
+        """
+        return int(self._header[0])
+
+    def publish(self, frame: np.ndarray) -> int:
+        """
+        Copies a frame into the next slot and publishes it, overwriting the
+        oldest slot even if it has not been read.
+
+        Returns:
+            int: The sequence number assigned to the frame.
+        """
+        if frame.shape != self.shape:
+            raise ValueError("Frame shape %s does not match ring shape %s" %
+                             (frame.shape, self.shape))
+        seq = self.write_seq + 1
+        slot = seq % self.slots
+
+        self._slot_seqs[slot] = _WRITING
+        self._frames[slot] = frame
+        self._slot_seqs[slot] = seq
+        self._header[0] = seq
+
+        if self._event is not None:
+            self._event.set()
+        return seq
+
+    def put(self, frame: np.ndarray, block=True, timeout=None) -> int:
+        """
+        Publishes a frame without overwriting unread frames.
+
+        Raises:
+            queue.Full: If the ring holds maxsize unread frames and block is
+                False, or the reader did not catch up within timeout seconds.
+        """
+        if self.full():
+            if not block:
+                raise queue.Full
+            deadline = None if timeout is None else time.monotonic() + timeout
+            # The reader has no way to signal across processes cheaply, so
+            # poll until a slot frees up.
+            while self.full():
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise queue.Full
+                time.sleep(_PUT_POLL_INTERVAL)
+        return self.publish(frame)
+
+    def put_nowait(self, frame: np.ndarray) -> int:
+        return self.put(frame, block=False)
+
+    def read(self, latest=True):
+        """
+        Returns the next unread frame without waiting.
+
+        Args:
+            latest (bool): Skip straight to the newest frame. Otherwise return
+                frames in order, skipping any that were already overwritten.
+
+        Returns:
+            tuple: (seq, frame view), or None when there is no unread frame.
+        """
+        write_seq = self.write_seq
+        if write_seq <= self.last_read:
+            return None
+
+        if latest:
+            seq = write_seq
+        else:
+            # The writer may be filling the slot of write_seq + 1, so the
+            # oldest frame that is still intact is write_seq - slots + 2.
+            seq = max(self.last_read + 1, write_seq - self.slots + 2)
+
+        slot = seq % self.slots
+        if self._slot_seqs[slot] != seq:
+            # Overwritten between reading the header and the slot
+            seq = self.write_seq
+            slot = seq % self.slots
+            if self._slot_seqs[slot] != seq:
+                return None
+
+        self.discard(seq - self.last_read - 1)
+        self._header[1] = seq
+        return seq, self._frames[slot]
+
+    def get(self, block=True, timeout=None, latest=None, copy=False):
+        """
+        Returns the next unread frame, waiting for one if necessary. latest
+        defaults to the ring's setting, see read().
+
+        Raises:
+            queue.Empty: If no frame is available and block is False, or no
+                frame arrived within timeout seconds.
+        """
+        if latest is None:
+            latest = self.latest
+        while True:
+            item = self.read(latest=latest)
+            if item is not None:
+                frame = item[1]
+                return frame.copy() if copy else frame
+            if not block:
+                raise queue.Empty
+            self._event.clear()
+            # A frame may have been published before the event was cleared
+            if self.write_seq > self.last_read:
+                continue
+            if not self._event.wait(timeout):
+                raise queue.Empty
+
+    def frame(self, seq: int):
+        """
+        Returns a view of frame seq, or None if it has been overwritten or was
+        never published. Unlike read(), this does not move the read position,
+        so several processes may look up frames by sequence number.
+        """
+        slot = seq % self.slots
+        if int(self._slot_seqs[slot]) != seq:
+            return None
+        return self._frames[slot]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def is_current(self, seq: int) -> bool:
+        """
+        Returns True if frame seq has not been overwritten yet.
+        """
+        return int(self._slot_seqs[seq % self.slots]) == seq
+
+    def qsize(self) -> int:
+        """
+        Returns the number of published frames that have not been read yet,
+        capped at the number of slots.
+        """
+        return min(self.write_seq - self.last_read, self.slots)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return self.qsize() >= self.maxsize
+
+    def close(self) -> None:
+        """
+        Detaches from the segment and, in the creating process, removes it.
+        """
+        self._header = self._slot_seqs = self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
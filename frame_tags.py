@@ -0,0 +1,104 @@
+"""
+Frame sequence numbers embedded in the pixels of video frames.
+
+A tagged frame carries a band of TAG_ROWS rows below the picture. The band
+is split into TAG_BITS blocks, black for a set bit and white otherwise: 32
+bits of frame sequence number followed by an 8-bit check. The blocks are
+large and high-contrast so that the tag survives lossy video coding, and the
+band sits in its own row of 16x16 macroblocks so that it does not blur into
+the picture.
+"""
+import numpy as np
+
+TAG_ROWS = 16
+TAG_BITS = 40
+_SEQ_BITS = 32
+# Pixels ignored at the edges of a block when reading it
+_INSET = 3
+
+
+def _check(seq: int) -> int:
+    return (seq ^ (seq >> 8) ^ (seq >> 16) ^ (seq >> 24) ^ 0xA5) & 0xFF
+
+
+def _bits(seq: int) -> np.ndarray:
+    value = (seq & 0xFFFFFFFF) | (_check(seq & 0xFFFFFFFF) << _SEQ_BITS)
+    return (value >> np.arange(TAG_BITS)) & 1
+
+
+def _block_width(width: int) -> int:
+    block = width // TAG_BITS
+    if block <= 2 * _INSET:
+        raise ValueError("Frames of width %d are too narrow for a tag" % width)
+    return block
+
+
+def tag_band(seq: int, width: int, on=0, off=255) -> np.ndarray:
+    """
+    Returns a (TAG_ROWS, width) band encoding seq with the levels on and off.
+    """
+    block = _block_width(width)
+    levels = np.where(_bits(seq), on, off).astype(np.uint8)
+    band = np.full((TAG_ROWS, width), off, dtype=np.uint8)
+    band[:, :block * TAG_BITS] = np.repeat(levels, block)
+    return band
+
+
+def add_tag(image: np.ndarray, seq: int) -> np.ndarray:
+    """
+    Returns a copy of a BGR or grayscale image with a tag band appended below.
+    """
+    band = tag_band(seq, image.shape[1])
+    if image.ndim == 3:
+        band = np.repeat(band[..., None], image.shape[2], axis=2)
+    return np.concatenate([image, band])
+
+
+def add_tag_i420(buffer: np.ndarray, seq: int) -> np.ndarray:
+    """
+    Returns a copy of an I420 buffer of shape (height * 3 / 2, width), as
+    taken by VideoFrame.from_ndarray(), with a tag band appended below the
+    picture. The band is drawn in limited range luma with neutral chroma.
+    """
+    rows, width = buffer.shape
+    height = rows * 2 // 3
+    tagged = np.empty(((height + TAG_ROWS) * 3 // 2, width), dtype=np.uint8)
+    tagged[:height] = buffer[:height]
+    tagged[height:height + TAG_ROWS] = tag_band(seq, width, on=16, off=235)
+
+    # The chroma planes are stored back to back, each (height / 2, width / 2)
+    planes = buffer[height:].reshape(2, -1)
+    tagged_planes = tagged[height + TAG_ROWS:].reshape(2, -1)
+    tagged_planes[:, :planes.shape[1]] = planes
+    tagged_planes[:, planes.shape[1]:] = 128
+    return tagged
+
+
+def read_tag(image: np.ndarray):
+    """
+    Reads the tag band of a BGR or grayscale tagged image, or the Y plane of
+    a tagged frame.
+
+    Returns:
+        int: The frame sequence number, or None if the band holds no valid tag.
+    """
+    band = image[-TAG_ROWS:]
+    if band.ndim == 3:
+        band = band[..., 1]
+    block = _block_width(band.shape[1])
+    blocks = band[_INSET:-_INSET, :block * TAG_BITS].reshape(
+        TAG_ROWS - 2 * _INSET, TAG_BITS, block)[:, :, _INSET:-_INSET]
+    bits = blocks.mean(axis=(0, 2)) < 128
+
+    value = int((bits.astype(np.uint64) << np.arange(TAG_BITS, dtype=np.uint64)).sum())
+    seq = value & 0xFFFFFFFF
+    if value >> _SEQ_BITS != _check(seq):
+        return None
+    return seq
+
+
+def strip_tag(image: np.ndarray) -> np.ndarray:
+    """
+    Returns the picture of a tagged image, without its tag band.
+    """
+    return image[:-TAG_ROWS]
@@ -0,0 +1,28 @@
+from stats import LogHistogram
+
+# Stages of the path from the server drawing a frame to the position detected
+# in it arriving back at the server:
+# - transport: encoding, network, jitter buffer and decoding of the frame,
+#   plus the position report's trip back;
+# - queue: waiting between decoding and the start of detection on the client;
+# - detect: ball detection;
+# - report: waiting between detection and sending the report;
+# - total: the whole path, on the server's clock.
+LATENCY_STAGES = ("transport", "queue", "detect", "report", "total")
+# Stages measured by the client and carried in position reports
+CLIENT_STAGES = ("queue", "detect", "report")
+
+
+class LatencyHistogram(LogHistogram):
+    """
+    Histogram of durations in seconds, from 100 us to 100 s, with buckets 5%
+    wide.
+    """
+
+    def __init__(self):
+        super().__init__(1e-4, 100)
+
+    def summary(self) -> str:
+        return "p50 %.1f ms, p95 %.1f ms, p99 %.1f ms (%d samples)" % (
+            self.percentile(50) * 1e3, self.percentile(95) * 1e3,
+            self.percentile(99) * 1e3, self.count)
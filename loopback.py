@@ -0,0 +1,264 @@
+"""
+End-to-end throughput of the server and client running side by side in one
+process, over real peer connections on localhost.
+
+The server side is a BouncingBallTrack sent by run_offer(). The client side
+runs its frame path as a client Pipeline, see client.py --pipeline, and
+pushes the detected positions back on the data channel. The two sides
+exchange their offer and answer through LoopbackSignaling.
+
+A run counts, after a warm-up, the frames that reach detection over a fixed
+window. A combination of resolution, frame rate and codec is sustained when
+detection gets at least SUSTAIN_RATIO of the frames the track should have
+sent in the window; frames lost to pacer skips, the network path, the
+decoder or full stage queues all count against it. sweep() raises the frame
+rate until a combination is no longer sustained.
+
+Usage:
+    python loopback.py [--resolutions 640x480,1280x720] [--fps 15,30,60]
+                       [--codecs VP8,H264] [--duration S]
+                       [--baseline PATH | --write-baseline PATH]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from aiortc import RTCPeerConnection, RTCRtpSender
+from client import PositionStreamer, build_pipeline, run_signaling
+from detection import create_detector
+from logger import app_log
+from position_record import SharedPosition
+from server import BouncingBallTrack, Session, run_offer
+from signaling_server import LoopbackSignaling
+
+CODECS = ("VP8", "H264")
+DEFAULT_PIPELINE = "convert:thread,detect:thread:4:drop-oldest,report"
+# Fraction of the nominal frames that detection must get for a sustained rate
+SUSTAIN_RATIO = 0.95
+# Seconds allowed for the peers to connect and the first frame to be detected
+CONNECT_TIMEOUT = 20
+
+
+class LoopbackResult:
+    """
+    Frames counted at each step of the path during the measurement window
+    of one loopback run.
+    """
+
+    def __init__(self, width: int, height: int, fps: float, codec: str, duration: float):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.codec = codec
+        self.duration = duration
+        # Frames sent by the track and frame slots its pacer skipped
+        self.sent = 0
+        self.skipped = 0
+        # Frames received by the client, detected, and dropped by stage queues
+        self.received = 0
+        self.detected = 0
+        self.dropped = 0
+        # Position reports accepted by the server
+        self.reports = 0
+        self.bottleneck = None
+
+    @property
+    def detected_fps(self) -> float:
+        return self.detected / self.duration
+
+    @property
+    def sustained(self) -> bool:
+        return self.detected >= SUSTAIN_RATIO * self.fps * self.duration
+
+    def summary(self) -> str:
+        return ("%dx%d %s at %g fps: sent %d, skipped %d, received %d, detected %d "
+                "(%.1f fps), dropped %d, %d reports, bottleneck %s: %s" % (
+                    self.width, self.height, self.codec, self.fps, self.sent, self.skipped,
+                    self.received, self.detected, self.detected_fps, self.dropped,
+                    self.reports, self.bottleneck,
+                    "sustained" if self.sustained else "not sustained"))
+
+
+def prefer_codec(pc, track, codec: str) -> None:
+    """
+    Restricts the video codecs offered for track to codec.
+    """
+    mime_type = "video/%s" % codec
+    codecs = [capability for capability in RTCRtpSender.getCapabilities("video").codecs
+              if capability.mimeType == mime_type]
+    if not codecs:
+        raise ValueError("Unsupported codec: %s" % codec)
+    for transceiver in pc.getTransceivers():
+        if transceiver.sender.track is track:
+            transceiver.setCodecPreferences(codecs)
+
+
+def _counts(track, pipeline, session) -> dict:
+    stats = pipeline.stats
+    return {
+        "sent": track.pacer.stats.frames,
+        "skipped": track.pacer.stats.skipped_frames,
+        "received": stats["receive"].items,
+        "detected": stats["detect"].items,
+        "dropped": sum(stage.stats.dropped for stage in pipeline.stages),
+        "reports": session.reports,
+    }
+
+
+async def run_loopback(width=640, height=480, fps=30, codec="VP8", duration=3.0,
+                       warmup=1.0, pipeline_spec=DEFAULT_PIPELINE,
+                       detector="contour") -> LoopbackResult:
+    """
+    Streams the bouncing ball from a server peer to a client peer in this
+    process and counts the frames that make it through.
+
+    Args:
+        width (int): Frame width in pixels.
+        height (int): Frame height in pixels.
+        fps (float): Frame rate of the track.
+        codec (str): One of CODECS.
+        duration (float): Seconds of the measurement window.
+        warmup (float): Seconds between the first detection and the window,
+            for the encoder's bitrate to settle.
+        pipeline_spec (str): Client pipeline, see client.build_pipeline(); it
+            needs a detect stage.
+        detector (str): Detection backend, see detection.DETECTORS.
+    Returns:
+        LoopbackResult: The frame counts of the window.
+    """
+    track = BouncingBallTrack(canvas_width=width, canvas_height=height, fps=fps)
+    server_pc, client_pc = RTCPeerConnection(), RTCPeerConnection()
+    server_signaling, client_signaling = LoopbackSignaling.pair()
+    session = Session("loopback", report_mode="push")
+    position = SharedPosition()
+    streamer = PositionStreamer("binary")
+    pipeline = build_pipeline(pipeline_spec, position, detector=create_detector(detector),
+                              streamer=streamer)
+    if "detect" not in pipeline.stats:
+        raise ValueError("The loopback pipeline needs a detect stage")
+
+    server_pc.addTrack(track)
+    prefer_codec(server_pc, track, codec)
+    peers = [
+        asyncio.ensure_future(run_offer(server_pc, server_signaling, session)),
+        asyncio.ensure_future(run_signaling(client_pc, client_signaling,
+                                            streamer=streamer, pipeline=pipeline)),
+    ]
+    result = LoopbackResult(width, height, fps, codec, duration)
+    try:
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while not pipeline.stats["detect"].items:
+            if time.monotonic() > deadline or any(peer.done() for peer in peers):
+                raise RuntimeError("No frame was detected within %d s" % CONNECT_TIMEOUT)
+            await asyncio.sleep(0.05)
+
+        await asyncio.sleep(warmup)
+        before = _counts(track, pipeline, session)
+        await asyncio.sleep(duration)
+        after = _counts(track, pipeline, session)
+        for name, count in after.items():
+            setattr(result, name, count - before[name])
+        result.bottleneck = pipeline.bottleneck()
+    finally:
+        await server_signaling.close()
+        await client_signaling.close()
+        await server_pc.close()
+        await client_pc.close()
+        track.stop()
+        await asyncio.wait(peers, timeout=5)
+        for peer in peers:
+            peer.cancel()
+        position.close()
+    return result
+
+
+async def sweep(resolutions, fps_values, codecs, measure=run_loopback, **options) -> dict:
+    """
+    Finds the highest sustained frame rate of every resolution and codec.
+
+    Args:
+        resolutions (list): (width, height) pairs.
+        fps_values (list): Frame rates to try, in increasing order; a
+            combination stops at its first rate that is not sustained.
+        codecs (list): Codecs from CODECS.
+        measure (callable): Coroutine function running one combination, with
+            the arguments of run_loopback().
+        **options: Passed to measure.
+    Returns:
+        dict: Highest sustained frame rate, 0 if none, by "WIDTHxHEIGHT/CODEC".
+    """
+    results = {}
+    for width, height in resolutions:
+        for codec in codecs:
+            key = "%dx%d/%s" % (width, height, codec)
+            results[key] = 0
+            for fps in fps_values:
+                result = await measure(width=width, height=height, fps=fps, codec=codec,
+                                       **options)
+                app_log.info(result.summary())
+                if not result.sustained:
+                    break
+                results[key] = fps
+    return results
+
+
+def regressions(results: dict, baseline: dict) -> list:
+    """
+    Returns the combinations whose sustained frame rate fell below the
+    baseline's, as (key, baseline fps, fps) tuples.
+    """
+    return [(key, expected, results[key]) for key, expected in baseline.items()
+            if key in results and results[key] < expected]
+
+
+def _resolution(text: str) -> tuple:
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Highest frame rate the server and client sustain end to end")
+    parser.add_argument("--resolutions", default="640x480,1280x720",
+                        help="Comma-separated WIDTHxHEIGHT (default: 640x480,1280x720)")
+    parser.add_argument("--fps", default="15,30,60,90,120",
+                        help="Comma-separated frame rates to try, increasing "
+                        "(default: 15,30,60,90,120)")
+    parser.add_argument("--codecs", default="VP8,H264",
+                        help="Comma-separated codecs from %s (default: VP8,H264)" %
+                        ", ".join(CODECS))
+    parser.add_argument("--duration", type=float, default=3.0,
+                        help="Seconds measured per combination (default: 3)")
+    parser.add_argument("--pipeline", default=DEFAULT_PIPELINE,
+                        help="Client pipeline spec (default: %s)" % DEFAULT_PIPELINE)
+    parser.add_argument("--detector", default="contour",
+                        help="Detection backend (default: contour)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--baseline", default=None, metavar="PATH",
+                       help="Exit with status 1 if a combination sustains a lower frame "
+                       "rate than in this JSON file")
+    group.add_argument("--write-baseline", default=None, metavar="PATH",
+                       help="Save the results as a baseline JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(sweep(
+        [_resolution(text) for text in args.resolutions.split(",")],
+        [float(text) for text in args.fps.split(",")],
+        args.codecs.split(","), duration=args.duration,
+        pipeline_spec=args.pipeline, detector=args.detector))
+
+    print("%-16s %14s" % ("combination", "sustained fps"))
+    for key, fps in results.items():
+        print("%-16s %14g" % (key, fps))
+
+    if args.write_baseline:
+        with open(args.write_baseline, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            failed = regressions(results, json.load(file))
+        for key, expected, fps in failed:
+            print("Regression: %s sustains %g fps, baseline %g fps" % (key, fps, expected))
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,285 @@
+"""
+Counters, gauges and histograms exposed over HTTP in the Prometheus text
+format.
+
+Metrics created with shared=True keep their values in multiprocessing shared
+memory, so that processes started after their creation, such as the client's
+detection processes, can update them.
+"""
+import bisect
+import math
+import multiprocessing
+
+from aiohttp import web
+from logger import app_log
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Default histogram buckets in seconds, from 100 us to 10 s
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+             for name, value in labels.items())
+    return "{%s}" % ",".join(pairs)
+
+
+class _Values:
+    """
+    Float cells, either private to the process or in shared memory.
+    """
+
+    def __init__(self, size: int, shared: bool):
+        if shared:
+            self._cells = multiprocessing.Array("d", size)
+            self._lock = self._cells.get_lock()
+        else:
+            self._cells = [0.0] * size
+            self._lock = None
+
+    def add(self, *increments) -> None:
+        """
+        Adds amounts to cells, given as (index, amount) pairs, atomically.
+        """
+        if self._lock is None:
+            for index, amount in increments:
+                self._cells[index] += amount
+            return
+        with self._lock:
+            for index, amount in increments:
+                self._cells[index] += amount
+
+    def set(self, index: int, value: float) -> None:
+        self._cells[index] = value
+
+    def snapshot(self) -> list:
+        if self._lock is None:
+            return list(self._cells)
+        with self._lock:
+            return list(self._cells)
+
+
+class Metric:
+    """
+    Base class of metrics. A metric created with labelnames is a family:
+    labels() returns the child metric holding the values of one combination
+    of label values.
+    """
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(), shared=False):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.shared = shared
+        self._children = {}
+        self._labels = {}
+        if not self.labelnames:
+            self._values = self._new_values()
+
+    def _new_values(self) -> _Values:
+        raise NotImplementedError
+
+    def labels(self, *values) -> "Metric":
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s takes labels %s" % (self.name, self.labelnames))
+        values = tuple(str(value) for value in values)
+        if values not in self._children:
+            child = type(self).__new__(type(self))
+            child.__dict__.update(self.__dict__)
+            child.labelnames = ()
+            child._children = {}
+            child._labels = dict(zip(self.labelnames, values))
+            child._values = child._new_values()
+            self._children[values] = child
+        return self._children[values]
+
+    def _samples(self):
+        """
+        Yields (suffix, labels, value) for every sample of this metric.
+        """
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        metrics = self._children.values() if self.labelnames else [self]
+        for metric in metrics:
+            for suffix, labels, value in metric._samples():
+                lines.append("%s%s%s %s" % (self.name, suffix, _format_labels(labels),
+                                            _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count.
+    """
+
+    type = "counter"
+
+    def _new_values(self) -> _Values:
+        return _Values(1, self.shared)
+
+    def inc(self, amount=1) -> None:
+        self._values.add((0, amount))
+
+    @property
+    def value(self) -> float:
+        return self._values.snapshot()[0]
+
+    def _samples(self):
+        yield "", self._labels, self.value
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, either set explicitly or read from a
+    function when the metrics are collected.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), shared=False, function=None):
+        super().__init__(name, documentation, labelnames, shared)
+        self.function = function
+
+    def _new_values(self) -> _Values:
+        return _Values(1, self.shared)
+
+    def set(self, value: float) -> None:
+        self._values.set(0, value)
+
+    def inc(self, amount=1) -> None:
+        self._values.add((0, amount))
+
+    def dec(self, amount=1) -> None:
+        self._values.add((0, -amount))
+
+    def set_function(self, function) -> None:
+        self.function = function
+
+    @property
+    def value(self) -> float:
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return float("nan")
+        return self._values.snapshot()[0]
+
+    def _samples(self):
+        yield "", self._labels, self.value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets, with their count
+    and sum.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), shared=False, buckets=TIME_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, shared)
+
+    def _new_values(self) -> _Values:
+        # One cell per bucket, one for +Inf, then the sum
+        return _Values(len(self.buckets) + 2, self.shared)
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        self._values.add((index, 1), (len(self.buckets) + 1, value))
+
+    @property
+    def count(self) -> int:
+        return int(sum(self._values.snapshot()[:-1]))
+
+    def _samples(self):
+        cells = self._values.snapshot()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), cells[:-1]):
+            cumulative += count
+            yield "_bucket", dict(self._labels, le=_format_value(bound)), cumulative
+        yield "_count", self._labels, cumulative
+        yield "_sum", self._labels, cells[-1]
+
+
+class Registry:
+    """
+    Collection of metrics exposed together.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError("Metric %s is already registered" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), shared=False) -> Counter:
+        return self._register(Counter(name, documentation, labelnames, shared))
+
+    def gauge(self, name, documentation, labelnames=(), shared=False, function=None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, shared, function))
+
+    def histogram(self, name, documentation, labelnames=(), shared=False,
+                  buckets=TIME_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, shared, buckets))
+
+    def expose(self) -> str:
+        return "".join(metric.expose() for metric in self.metrics.values())
+
+
+class MetricsServer:
+    """
+    HTTP server answering GET /metrics with the metrics of a registry.
+    """
+
+    def __init__(self, registry: Registry, host="0.0.0.0", port=9100):
+        """
+        Args:
+            registry (Registry): Metrics to expose.
+            host (str): Address to listen on.
+            port (int): Port to listen on; 0 picks a free port.
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request) -> web.Response:
+        return web.Response(body=self.registry.expose().encode("utf8"),
+                            headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        app_log.info("Serving metrics on http://%s:%d/metrics" % (self.host, self.port))
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
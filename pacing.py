@@ -0,0 +1,126 @@
+import asyncio
+import math
+import time
+
+from stats import RunningStats
+
+# What FramePacer does with a frame whose slot has already passed: "skip"
+# drops the missed slots and waits for the next one, "burst" sends late
+# frames back to back until the schedule is caught up
+LATE_POLICIES = ("skip", "burst")
+
+
+class PacingStats:
+    """
+    Lateness and jitter of the frames emitted by a FramePacer.
+
+    Lateness is how long after its scheduled time a frame was released. Jitter
+    is the standard deviation of the interval between consecutive frames.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.late_frames = 0
+        self.skipped_frames = 0
+        self.max_lateness = 0.0
+        self._lateness_sum = 0.0
+        self.intervals = RunningStats()
+
+    def record(self, lateness: float, interval=None) -> None:
+        self.frames += 1
+        self._lateness_sum += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if interval is not None:
+            self.intervals.update(interval)
+
+    @property
+    def mean_lateness(self) -> float:
+        return self._lateness_sum / self.frames if self.frames else 0.0
+
+    @property
+    def mean_interval(self) -> float:
+        return self.intervals.mean
+
+    @property
+    def jitter(self) -> float:
+        return self.intervals.std
+
+    def summary(self) -> str:
+        return ("%d frames, %d late, %d skipped, lateness mean %.2f ms max %.2f ms, "
+                "interval %.2f ms, jitter %.2f ms" % (
+                    self.frames, self.late_frames, self.skipped_frames,
+                    self.mean_lateness * 1e3, self.max_lateness * 1e3,
+                    self.mean_interval * 1e3, self.jitter * 1e3))
+
+
+class FramePacer:
+    """
+    Schedules frames at a fixed rate on the monotonic clock.
+
+    Frame slot n is due at start + n / fps, so errors in individual sleeps do
+    not accumulate into drift, and the presentation timestamp of slot n is
+    computed from n rather than summed frame by frame. A frame produced after
+    its slot has passed is handled according to the late policy.
+    """
+
+    def __init__(self, fps=30, late_policy="skip", clock_rate=90000,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        """
+        Args:
+            fps (float): Frames per second.
+            late_policy (str): One of LATE_POLICIES.
+            clock_rate (int): Ticks per second of the returned timestamps.
+            clock (callable): Monotonic time source in seconds.
+            sleep (callable): Coroutine function sleeping for some seconds.
+        """
+        if fps <= 0:
+            raise ValueError("Frame rate must be positive: %s" % fps)
+        if late_policy not in LATE_POLICIES:
+            raise ValueError("Unknown late frame policy: %s" % late_policy)
+        self.fps = fps
+        self.period = 1 / fps
+        self.late_policy = late_policy
+        self.clock_rate = clock_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = PacingStats()
+
+        self.slot = None
+        self._start = None
+        self._last_emit = None
+
+    def timestamp(self, slot: int) -> int:
+        return int(round(slot * self.clock_rate / self.fps))
+
+    def _due(self, slot: int) -> float:
+        return self._start + slot * self.period
+
+    async def wait(self) -> int:
+        """
+        Waits for the next frame slot.
+
+        Returns:
+            int: Presentation timestamp of the slot in clock_rate ticks.
+        """
+        if self.slot is None:
+            self._start = self.clock()
+            self.slot = 0
+        else:
+            self.slot += 1
+            now = self.clock()
+            if now > self._due(self.slot):
+                self.stats.late_frames += 1
+                if self.late_policy == "skip":
+                    # Resume the cadence at the first slot still ahead
+                    missed = math.ceil((now - self._start) / self.period) - self.slot
+                    self.slot += missed
+                    self.stats.skipped_frames += missed
+            delay = self._due(self.slot) - now
+            if delay > 0:
+                await self.sleep(delay)
+
+        now = self.clock()
+        self.stats.record(max(now - self._due(self.slot), 0.0),
+                          None if self._last_emit is None else now - self._last_emit)
+        self._last_emit = now
+        return self.timestamp(self.slot)
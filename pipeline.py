@@ -0,0 +1,322 @@
+"""
+Frame pipeline built from stages connected by bounded queues.
+
+A pipeline pulls items from an async iterable source, the receive stage, and
+passes them through its stages in order. Every stage runs a function on each
+item from its input queue and hands the result to the next stage; a stage
+returning None ends the item's way through the pipeline. Each stage has:
+
+- a bounded input queue with a policy for when it is full, see QUEUE_POLICIES;
+- a concurrency setting, see CONCURRENCY: the function runs on the event
+  loop, in a thread of its own, or in a process of its own;
+- timing: the number of items, their processing times and the stage's
+  utilization, the fraction of the time it was busy. The busiest stage is the
+  bottleneck.
+
+Pipelines are assembled from a spec such as
+``"convert:thread,detect:process:2:keep-latest,report"``, see parse_spec().
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from logger import app_log
+from stats import LogHistogram
+
+# Where a stage runs its function: on the event loop, in a dedicated thread,
+# or in a dedicated process, which receives the function once and every item
+# pickled
+CONCURRENCY = ("inline", "thread", "process")
+# What a stage does with an item when its queue is full: wait for room, drop
+# the item, drop the oldest queued item, or drop every queued item
+QUEUE_POLICIES = ("block", "drop-newest", "drop-oldest", "keep-latest")
+DEFAULT_QUEUE_SIZE = 4
+
+# Function of the stage run by this worker process
+_installed = None
+
+
+def _install(function) -> None:
+    global _installed
+    _installed = function
+
+
+def _timed_call(function, item):
+    started = time.monotonic()
+    result = function(item)
+    return result, time.monotonic() - started
+
+
+def _call_installed(item):
+    return _timed_call(_installed, item)
+
+
+class StageStats:
+    """
+    Items handled by a stage, the time it spent on them and the items its
+    queue dropped.
+    """
+
+    def __init__(self):
+        self.items = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.durations = LogHistogram(1e-6, 100)
+        self.started_at = time.monotonic()
+
+    def record(self, seconds: float) -> None:
+        self.items += 1
+        self.busy += seconds
+        self.durations.record(seconds)
+
+    def utilization(self, now=None) -> float:
+        """
+        Returns the fraction of the time since the stage started that it spent
+        processing items.
+        """
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.started_at
+        return min(self.busy / elapsed, 1.0) if elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return ("%d items, %d dropped, p50 %.2f ms, p99 %.2f ms, %.0f%% busy" % (
+            self.items, self.dropped, self.durations.percentile(50) * 1e3,
+            self.durations.percentile(99) * 1e3, self.utilization() * 100))
+
+
+class Stage:
+    """
+    Step of a Pipeline: a function applied to every item of its input queue.
+    """
+
+    def __init__(self, name: str, function, concurrency="inline",
+                 queue_size=DEFAULT_QUEUE_SIZE, policy="block"):
+        """
+        Args:
+            name (str): Name of the stage in statistics and metrics.
+            function (callable): Takes an item and returns the item for the
+                next stage, or None. Must be picklable for "process".
+            concurrency (str): One of CONCURRENCY.
+            queue_size (int): Most items waiting for the stage.
+            policy (str): One of QUEUE_POLICIES.
+        """
+        if concurrency not in CONCURRENCY:
+            raise ValueError("Unknown concurrency for stage %s: %s" % (name, concurrency))
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unknown queue policy for stage %s: %s" % (name, policy))
+        if queue_size < 1:
+            raise ValueError("Queue of stage %s needs room for an item: %s" %
+                             (name, queue_size))
+        self.name = name
+        self.function = function
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.policy = policy
+        self.stats = StageStats()
+        # Counter of the items dropped by the queue, set by Pipeline
+        self.dropped_counter = None
+        self.queue = None
+        self._executor = None
+
+    def start(self) -> None:
+        """
+        Creates the stage's queue on the running event loop and its worker
+        thread or process.
+        """
+        self.queue = asyncio.Queue(self.queue_size)
+        self.stats.started_at = time.monotonic()
+        if self.concurrency == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+        elif self.concurrency == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=1, initializer=_install, initargs=(self.function,))
+
+    def qsize(self) -> int:
+        return 0 if self.queue is None else self.queue.qsize()
+
+    def _drop(self) -> None:
+        self.stats.dropped += 1
+        if self.dropped_counter is not None:
+            self.dropped_counter.inc()
+
+    def _discard(self) -> None:
+        self.queue.get_nowait()
+        self.queue.task_done()
+        self._drop()
+
+    async def put(self, item) -> bool:
+        """
+        Queues an item for the stage according to its policy.
+
+        Returns:
+            bool: False if the item was dropped.
+        """
+        if self.policy == "block":
+            await self.queue.put(item)
+            return True
+        if self.policy == "keep-latest":
+            while not self.queue.empty():
+                self._discard()
+        elif self.queue.full():
+            if self.policy == "drop-newest":
+                self._drop()
+                return False
+            self._discard()
+        self.queue.put_nowait(item)
+        return True
+
+    async def process(self, item):
+        """
+        Runs the function on an item where the stage's concurrency says and
+        records its processing time.
+
+        Returns:
+            tuple: The result and the processing time in seconds.
+        """
+        if self.concurrency == "inline":
+            result, elapsed = _timed_call(self.function, item)
+        else:
+            loop = asyncio.get_running_loop()
+            if self.concurrency == "thread":
+                call = loop.run_in_executor(self._executor, _timed_call, self.function, item)
+            else:
+                call = loop.run_in_executor(self._executor, _call_installed, item)
+            result, elapsed = await call
+        self.stats.record(elapsed)
+        return result, elapsed
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class Pipeline:
+    """
+    Stages run concurrently, each in its own task, on items from a source.
+    """
+
+    def __init__(self, stages, stage_time=None, stage_dropped=None):
+        """
+        Args:
+            stages (list): Stage objects, in order. Stage names must be
+                unique and differ from "receive".
+            stage_time (Histogram): Optional metric family with a "stage"
+                label, observing the processing time of every item.
+            stage_dropped (Counter): Optional metric family with a "stage"
+                label, counting the items dropped by stage queues.
+        """
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names) or "receive" in names:
+            raise ValueError("Stage names must be unique and not receive: %s" % names)
+        self.stages = list(stages)
+        self.stage_time = stage_time
+        self.stage_dropped = stage_dropped
+        # Frames received, and the time spent handing them to the first stage
+        self.receive_stats = StageStats()
+
+    @property
+    def stats(self) -> dict:
+        """
+        Statistics of every stage by name, starting with receive.
+        """
+        stats = {"receive": self.receive_stats}
+        stats.update((stage.name, stage.stats) for stage in self.stages)
+        return stats
+
+    def _observe(self, name: str, seconds: float) -> None:
+        if self.stage_time is not None:
+            self.stage_time.labels(name).observe(seconds)
+
+    async def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = await stage.queue.get()
+            try:
+                result, elapsed = await stage.process(item)
+                self._observe(stage.name, elapsed)
+                if result is not None and following is not None:
+                    await following.put(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                stage.stats.errors += 1
+                app_log.exception("Stage %s failed" % stage.name)
+            finally:
+                stage.queue.task_done()
+
+    async def run(self, source) -> None:
+        """
+        Feeds every item of source through the stages and returns once the
+        source is exhausted and the stages have handled every queued item.
+
+        Args:
+            source: Async iterable of items for the first stage.
+        """
+        for stage in self.stages:
+            stage.start()
+            if self.stage_dropped is not None:
+                stage.dropped_counter = self.stage_dropped.labels(stage.name)
+        self.receive_stats.started_at = time.monotonic()
+        workers = [asyncio.ensure_future(self._work(index))
+                   for index in range(len(self.stages))]
+        try:
+            async for item in source:
+                started = time.monotonic()
+                if self.stages:
+                    await self.stages[0].put(item)
+                elapsed = time.monotonic() - started
+                self.receive_stats.record(elapsed)
+                self._observe("receive", elapsed)
+            for stage in self.stages:
+                await stage.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for stage in self.stages:
+                stage.close()
+
+    def bottleneck(self):
+        """
+        Returns the name of the busiest stage, or None without stages. Time
+        the receive stage spends waiting for frames is not work, so it is
+        never the bottleneck.
+        """
+        if not self.stages:
+            return None
+        now = time.monotonic()
+        return max(self.stages, key=lambda stage: stage.stats.utilization(now)).name
+
+    def summary(self) -> str:
+        lines = ["%s: %s" % (name, stats.summary()) for name, stats in self.stats.items()]
+        lines.append("bottleneck: %s" % self.bottleneck())
+        return "\n".join(lines)
+
+
+def parse_spec(spec: str) -> list:
+    """
+    Parses a pipeline spec: comma-separated stages, each written
+    ``name[:concurrency[:queue_size[:policy]]]``.
+
+    Returns:
+        list: One dict per stage with the keys name, concurrency, queue_size
+        and policy, filled with the defaults where omitted.
+    """
+    stages = []
+    for entry in spec.split(","):
+        fields = entry.strip().split(":")
+        if not fields[0] or len(fields) > 4:
+            raise ValueError("Invalid pipeline stage: %r" % entry)
+        stage = {"name": fields[0], "concurrency": "inline",
+                 "queue_size": DEFAULT_QUEUE_SIZE, "policy": "block"}
+        if len(fields) > 1 and fields[1]:
+            stage["concurrency"] = fields[1]
+        if len(fields) > 2 and fields[2]:
+            stage["queue_size"] = int(fields[2])
+        if len(fields) > 3 and fields[3]:
+            stage["policy"] = fields[3]
+        stages.append(stage)
+    return stages
@@ -0,0 +1,147 @@
+import math
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from frame_ring import _attach
+from protocol import PositionReport
+
+# Fields of the record, after an int64 version counter
+_RECORD = np.dtype([
+    ("x", "<i8"),
+    ("y", "<i8"),
+    ("seq", "<i8"),
+    ("timestamp", "<f8"),
+    ("confidence", "<f8"),
+])
+_VERSION_BYTES = 8
+# Stored sequence number of positions not tied to a frame
+_NO_SEQ = -1
+# Seconds a reader retries before giving up on a record whose writer holds
+# the version odd, e.g. because the writer process died mid-write
+READ_TIMEOUT = 0.01
+
+
+class SharedPosition:
+    """
+    Latest ball position in shared memory, published by one process and read
+    by any number of others without locks, with a seqlock.
+
+    The record holds x, y, the frame sequence number, the time.monotonic() at
+    which the position was detected and the detection confidence, behind a
+    version counter. The writer makes the version odd, writes the record and
+    makes the version even again. A reader copies the record between two
+    reads of the version and starts over if the version was odd or changed,
+    so it never sees x from one frame and y from another, and the writer
+    never waits for a reader. A reader that cannot get a consistent copy
+    within READ_TIMEOUT returns the last one it got instead of spinning
+    forever.
+
+    Python has no memory fences: this relies on stores becoming visible to
+    other processes in program order, as they do on x86. The record supports
+    one writer.
+    """
+
+    def __init__(self, name=None):
+        """
+        Args:
+            name (str): Name of an existing record to attach to. A new record
+                is created when omitted.
+        """
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=_VERSION_BYTES + _RECORD.itemsize)
+        else:
+            self._shm = _attach(name)
+
+        self._version = np.ndarray((1,), dtype=np.int64, buffer=self._shm.buf)
+        self._record = np.ndarray(
+            (1,), dtype=_RECORD, buffer=self._shm.buf, offset=_VERSION_BYTES)
+        if self._owner:
+            self._version[0] = 0
+            self._record[0] = (0, 0, _NO_SEQ, math.nan, math.nan)
+
+        # Reads in this process that had to start over, and that gave up
+        self.retries = 0
+        self.timeouts = 0
+        # Last consistent copy read in this process
+        self._last_report = None
+
+    def __getstate__(self):
+        return {"name": self._shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(name=state["name"])
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def published(self) -> int:
+        """
+        Number of positions published so far.
+        """
+        return int(self._version[0]) // 2
+
+    def publish(self, x: int, y: int, seq=None, timestamp=None, confidence=None) -> None:
+        """
+        Replaces the record with a new position.
+
+        Args:
+            x (int): Ball x coordinate.
+            y (int): Ball y coordinate.
+            seq (int): Sequence number of the frame the ball was found in.
+            timestamp (float): time.monotonic() of the detection; now when
+                omitted.
+            confidence (float): Detection confidence.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        version = int(self._version[0])
+        self._version[0] = version + 1
+        self._record[0] = (x, y, _NO_SEQ if seq is None else seq, timestamp,
+                           math.nan if confidence is None else confidence)
+        self._version[0] = version + 2
+
+    def read(self):
+        """
+        Returns a consistent copy of the record.
+
+        Returns:
+            PositionReport: The latest position, or None if nothing was
+            published yet. If the record stays mid-write for READ_TIMEOUT,
+            the last position read in this process, or None.
+        """
+        deadline = None
+        while True:
+            version = int(self._version[0])
+            if not version & 1:
+                fields = self._record[0].item()
+                if int(self._version[0]) == version:
+                    break
+            self.retries += 1
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + READ_TIMEOUT
+            elif now >= deadline:
+                self.timeouts += 1
+                return self._last_report
+
+        if not version:
+            return None
+        x, y, seq, timestamp, confidence = fields
+        self._last_report = PositionReport(
+            None if seq == _NO_SEQ else seq, timestamp, x, y,
+            None if math.isnan(confidence) else confidence)
+        return self._last_report
+
+    def close(self) -> None:
+        """
+        Detaches from the record and, in the creating process, removes it.
+        """
+        self._version = self._record = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
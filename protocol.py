@@ -0,0 +1,197 @@
+"""
+Ball position reports exchanged on the data channel.
+
+Two formats are understood:
+
+- text: ``"(x, y)"``, the original format, sent as a string message;
+- binary, version 1: a ``<BH`` header holding the version and the number of
+  reports, followed by that many ``<Idhhf`` records (frame sequence number,
+  time.monotonic() of the detection on the client in seconds, x, y,
+  detection confidence from 0 to 1), sent as a bytes message;
+- binary, version 2: as version 1 with ``<IdhhfH`` records, whose last field
+  is the ball id, for scenes with several balls. Messages whose reports are
+  all about ball 0 are still encoded as version 1;
+- binary, version 3: as version 2 with ``<IdhhfHfff`` records, which add the
+  durations in seconds of the client's queue, detect and report stages
+  (see latency.py). Used when any report carries them.
+
+Unknown fields are None in a PositionReport; on the wire they are encoded as
+UNKNOWN_SEQ for the sequence number and NaN for the timestamp, confidence and
+stage durations.
+
+Reports of untagged frames have no frame sequence number. The client numbers
+them instead, in the report_seq field, so that they can still be ordered. On
+the wire report_seq takes the place of the frame sequence number, with
+REPORT_SEQ_FLAG set; frame sequence numbers stay below REPORT_SEQ_FLAG.
+"""
+import math
+import struct
+from collections import namedtuple
+
+BINARY_VERSION = 3
+UNKNOWN_SEQ = 0xFFFFFFFF
+REPORT_SEQ_FLAG = 0x80000000
+# report_seq wraps around below this, so that it never encodes as UNKNOWN_SEQ
+REPORT_SEQ_LIMIT = REPORT_SEQ_FLAG - 1
+MAX_BATCH = 0xFFFF
+REPORT_FORMATS = ("text", "binary")
+# "poll": the client answers the server's prompts; "push": the client sends
+# positions as they are detected
+REPORT_MODES = ("poll", "push")
+
+_HEADER = struct.Struct("<BH")
+_REPORTS = {
+    1: struct.Struct("<Idhhf"),
+    2: struct.Struct("<IdhhfH"),
+    3: struct.Struct("<IdhhfHfff"),
+}
+_NO_STAGES = (math.nan,) * 3
+
+PositionReport = namedtuple(
+    "PositionReport",
+    ["seq", "timestamp", "x", "y", "confidence", "ball", "stages", "report_seq"],
+    defaults=[None, 0, None, None])
+
+
+class ReportFilter:
+    """
+    Drops reports that arrive after a newer one, for data channels that do not
+    preserve message order. Reports are ordered by frame sequence number, or
+    by report_seq for untagged frames; reports with neither, such as text
+    reports, cannot be ordered and are always accepted.
+    """
+
+    def __init__(self):
+        # Newest sequence number seen for each ball id and kind of number
+        self.last_seqs = {}
+        self.discarded = 0
+
+    def accept(self, report: PositionReport) -> bool:
+        if report.seq is not None:
+            key, seq = (report.ball, "frame"), report.seq
+        elif report.report_seq is not None:
+            key, seq = (report.ball, "report"), report.report_seq
+        else:
+            return True
+        last_seq = self.last_seqs.get(key)
+        if last_seq is not None and seq <= last_seq:
+            self.discarded += 1
+            return False
+        self.last_seqs[key] = seq
+        return True
+
+
+def encode_text(report: PositionReport) -> str:
+    return "(%d, %d)" % (report.x, report.y)
+
+
+def decode_text(message: str) -> PositionReport:
+    """
+    Parses a ``"(x, y)"`` report.
+
+    Raises:
+        ValueError: If the message is not a text position report.
+    """
+    message = message.strip()
+    if not (message.startswith("(") and message.endswith(")")):
+        raise ValueError("Not a position report: %r" % message)
+    x, y = message[1:-1].split(",")
+    return PositionReport(None, None, int(x), int(y))
+
+
+def encode_reports(reports) -> bytes:
+    """
+    Packs one or more reports into a single binary message.
+
+    Raises:
+        ValueError: If there are no reports or more than MAX_BATCH.
+    """
+    if not 0 < len(reports) <= MAX_BATCH:
+        raise ValueError("Cannot batch %d reports" % len(reports))
+    if any(report.stages is not None for report in reports):
+        version = 3
+    elif any(report.ball for report in reports):
+        version = 2
+    else:
+        version = 1
+    record = _REPORTS[version]
+
+    chunks = [_HEADER.pack(version, len(reports))]
+    for report in reports:
+        if report.seq is not None:
+            seq = report.seq
+        elif report.report_seq is not None:
+            seq = REPORT_SEQ_FLAG | report.report_seq
+        else:
+            seq = UNKNOWN_SEQ
+        fields = (
+            seq,
+            math.nan if report.timestamp is None else report.timestamp,
+            report.x, report.y,
+            math.nan if report.confidence is None else report.confidence)
+        if version >= 2:
+            fields += (report.ball,)
+        if version == 3:
+            fields += _NO_STAGES if report.stages is None else tuple(report.stages)
+        chunks.append(record.pack(*fields))
+    return b"".join(chunks)
+
+
+def _unknown_if_nan(value):
+    return None if math.isnan(value) else value
+
+
+def decode_reports(data: bytes) -> list:
+    """
+    Unpacks a binary message into a list of reports.
+
+    Raises:
+        ValueError: If the version is not supported or the length does not
+            match the number of reports.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("Truncated position message")
+    version, count = _HEADER.unpack_from(data)
+    if version not in _REPORTS:
+        raise ValueError("Unsupported position message version %d" % version)
+    record = _REPORTS[version]
+    if len(data) != _HEADER.size + count * record.size:
+        raise ValueError("Position message length does not match %d reports" % count)
+
+    reports = []
+    for fields in record.iter_unpack(data[_HEADER.size:]):
+        seq, timestamp, x, y, confidence = fields[:5]
+        stages = None
+        if version == 3 and not any(math.isnan(value) for value in fields[6:]):
+            stages = fields[6:]
+        report_seq = None
+        if seq == UNKNOWN_SEQ:
+            seq = None
+        elif seq & REPORT_SEQ_FLAG:
+            seq, report_seq = None, seq & ~REPORT_SEQ_FLAG
+        reports.append(PositionReport(
+            seq, _unknown_if_nan(timestamp), x, y, _unknown_if_nan(confidence),
+            fields[5] if version >= 2 else 0, stages, report_seq))
+    return reports
+
+
+def encode_message(reports, report_format="text"):
+    """
+    Encodes reports for the data channel. The text format carries a single
+    position, so only the last report is sent.
+    """
+    if report_format == "binary":
+        return encode_reports(reports)
+    return encode_text(reports[-1])
+
+
+def decode_message(message) -> list:
+    """
+    Decodes a data channel message in either format into a list of reports.
+
+    Raises:
+        ValueError: If the message is not a position report.
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return decode_reports(bytes(message))
+    return [decode_text(message)]
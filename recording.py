@@ -0,0 +1,336 @@
+"""
+Recordings of video frames with the actual ball positions, for benchmarking
+detectors offline, without a server, WebRTC or a display.
+
+A recording is a memory-mapped file: a fixed header followed by fixed-size
+records, each holding a frame sequence number, the time the frame was
+captured, the actual (x, y) of every ball, NaN where unknown, and the raw
+pixels of the frame, BGR or gray. There is no per-frame framing or
+compression, so a record is located by its index alone and replaying a frame
+reads it straight from the page cache.
+
+Usage:
+    python recording.py record PATH [--frames N] [--balls N] [--frame-format F]
+    python recording.py replay PATH [--detector D] [--tracking] [--truth PATH]
+"""
+import argparse
+import math
+import os
+import struct
+import time
+
+import numpy as np
+from frame_tags import TAG_ROWS
+from stats import ErrorStats
+
+RECORDING_FORMATS = ("bgr24", "gray")
+# Magic, version, height, width, channels, balls, tagged, record count
+_HEADER = struct.Struct("<8sHHHHHHQ")
+_HEADER_BYTES = 64
+_MAGIC = b"BBALLREC"
+_VERSION = 1
+
+
+def _record_dtype(height: int, width: int, channels: int, balls: int) -> np.dtype:
+    frame_shape = (height, width) if channels == 1 else (height, width, channels)
+    return np.dtype([
+        ("seq", "<i8"),
+        ("timestamp", "<f8"),
+        ("positions", "<f8", (balls, 2)),
+        ("frame", "u1", frame_shape),
+    ])
+
+
+def frame_to_array(frame, frame_format="bgr24") -> np.ndarray:
+    """
+    Returns the pixels of a VideoFrame in a recording format.
+    """
+    if frame_format == "gray" and frame.format.name in ("yuv420p", "yuvj420p"):
+        return frame.to_ndarray()[:frame.height]
+    return frame.to_ndarray(format=frame_format)
+
+
+class FrameRecorder:
+    """
+    Writes frames and ball positions to a recording.
+
+    The file is allocated for capacity frames up front and written through a
+    memory map, so recording a frame is a copy into the page cache. close()
+    trims the file to the frames recorded.
+    """
+
+    def __init__(self, path: str, shape, capacity: int, balls=1, tagged=False):
+        """
+        Args:
+            path (str): File to create, replacing any existing one.
+            shape (tuple): Shape of every frame: (height, width) for gray,
+                (height, width, 3) for BGR.
+            capacity (int): Most frames recorded; later ones are ignored.
+            balls (int): Number of balls whose positions are recorded.
+            tagged (bool): The frames carry a frame tag band below the picture.
+        """
+        if len(shape) not in (2, 3) or capacity < 1:
+            raise ValueError("Cannot record %d frames of shape %s" % (capacity, shape))
+        self.path = path
+        self.height, self.width = shape[:2]
+        self.channels = shape[2] if len(shape) == 3 else 1
+        self.balls = balls
+        self.tagged = tagged
+        self.capacity = capacity
+        self.count = 0
+
+        dtype = _record_dtype(self.height, self.width, self.channels, balls)
+        with open(path, "wb") as file:
+            file.truncate(_HEADER_BYTES + capacity * dtype.itemsize)
+        self._records = np.memmap(path, dtype=dtype, mode="r+",
+                                  offset=_HEADER_BYTES, shape=(capacity,))
+        self._write_header()
+
+    def _write_header(self) -> None:
+        header = _HEADER.pack(_MAGIC, _VERSION, self.height, self.width, self.channels,
+                              self.balls, self.tagged, self.count)
+        with open(self.path, "r+b") as file:
+            file.write(header.ljust(_HEADER_BYTES, b"\0"))
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def write(self, frame: np.ndarray, seq: int, positions=None, timestamp=None) -> bool:
+        """
+        Records a frame.
+
+        Args:
+            frame (ndarray): Pixels of the frame, of the recorder's shape.
+            seq (int): Frame sequence number.
+            positions (array_like): Actual (x, y) of every ball, a single
+                (x, y), or None if unknown.
+            timestamp (float): time.monotonic() of the capture; now when
+                omitted.
+        Returns:
+            bool: False if the recording is full.
+        """
+        if self.full:
+            return False
+        record = self._records[self.count]
+        record["seq"] = seq
+        record["timestamp"] = time.monotonic() if timestamp is None else timestamp
+        record["positions"] = math.nan if positions is None else \
+            np.reshape(positions, (-1, 2))
+        record["frame"] = frame
+        self.count += 1
+        return True
+
+    def close(self) -> None:
+        """
+        Flushes the recorded frames and trims the file to them.
+        """
+        if self._records is None:
+            return
+        self._records.flush()
+        itemsize = self._records.dtype.itemsize
+        self._records = None
+        self._write_header()
+        os.truncate(self.path, _HEADER_BYTES + self.count * itemsize)
+
+
+class Recording:
+    """
+    Read-only view of a recording, mapped into memory.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("%s is not a recording" % path)
+        magic, version, height, width, channels, balls, tagged, count = \
+            _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("%s is not a version %d recording" % (path, _VERSION))
+        self.path = path
+        self.balls = balls
+        self.tagged = bool(tagged)
+        dtype = _record_dtype(height, width, channels, balls)
+        self._records = np.memmap(path, dtype=dtype, mode="r",
+                                  offset=_HEADER_BYTES, shape=(count,)) \
+            if count else np.empty(0, dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    @property
+    def frames(self) -> np.ndarray:
+        return self._records["frame"]
+
+    @property
+    def seqs(self) -> np.ndarray:
+        return self._records["seq"]
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._records["timestamp"]
+
+    @property
+    def positions(self) -> np.ndarray:
+        """
+        (frames, balls, 2) actual positions, NaN where unknown.
+        """
+        return self._records["positions"]
+
+    def positions_by_seq(self, seqs) -> np.ndarray:
+        """
+        Returns the recorded positions of frames seqs, NaN for frames missing
+        from this recording, e.g. to score a recording of decoded frames
+        against the server's recording of the same session.
+        """
+        order = np.argsort(self.seqs)
+        sorted_seqs = self.seqs[order]
+        seqs = np.asarray(seqs)
+        index = np.clip(np.searchsorted(sorted_seqs, seqs), 0, max(len(order) - 1, 0))
+        positions = np.full((len(seqs), self.balls, 2), np.nan)
+        if len(order):
+            found = sorted_seqs[index] == seqs
+            positions[found] = self.positions[order[index[found]]]
+        return positions
+
+
+class ReplayResult:
+    """
+    Speed and accuracy of a detector on a recording.
+    """
+
+    def __init__(self, detector_name: str):
+        self.detector_name = detector_name
+        self.frames = 0
+        self.elapsed = 0.0
+        # Balls with a known position that were not detected
+        self.missed = 0
+        self.errors = ErrorStats()
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        return "%s: %d frames at %.1f fps, %d missed, %s" % (
+            self.detector_name, self.frames, self.fps, self.missed, self.errors.summary())
+
+
+def replay(recording: Recording, detector, truth=None) -> ReplayResult:
+    """
+    Feeds every frame of a recording to a detector as fast as it can take
+    them and scores the detections against the actual positions.
+
+    Args:
+        recording (Recording): Frames to detect on. Frame tag bands are
+            stripped first.
+        detector (Detector): Detector to benchmark; detect_all() is used for
+            recordings of several balls.
+        truth (Recording): Recording holding the actual positions by frame
+            sequence number, for recordings that lack them. Defaults to the
+            recording itself.
+    Returns:
+        ReplayResult: Frames per second of detection and its accuracy.
+    """
+    result = ReplayResult(getattr(detector, "name", type(detector).__name__))
+    if truth is None:
+        actual = recording.positions
+    else:
+        actual = truth.positions_by_seq(recording.seqs)
+    balls = actual.shape[1]
+
+    frames = recording.frames
+    if recording.tagged:
+        frames = frames[:, :-TAG_ROWS]
+    detected = np.full(actual.shape, np.nan)
+
+    started = time.perf_counter()
+    for index, frame in enumerate(frames):
+        if balls > 1:
+            detections = detector.detect_all(frame)
+        else:
+            detections = [detector.detect(frame)]
+        for detection in detections:
+            if detection is not None and detection.ball < balls:
+                detected[index, detection.ball] = detection.x, detection.y
+    result.elapsed = time.perf_counter() - started
+    result.frames = len(frames)
+
+    known = ~np.isnan(actual).any(axis=2)
+    found = ~np.isnan(detected).any(axis=2)
+    result.missed = int((known & ~found).sum())
+    result.errors.update(detected[known & found], actual[known & found])
+    return result
+
+
+def record_scene(path: str, frames: int, frame_format="bgr24", **options) -> None:
+    """
+    Renders frames with BouncingBallTrack, without pacing or a peer, and
+    records them with the ball positions.
+
+    Args:
+        path (str): Recording to create.
+        frames (int): Number of frames.
+        frame_format (str): One of RECORDING_FORMATS.
+        **options: Passed to BouncingBallTrack.
+    """
+    from server import BouncingBallTrack, ground_truth
+
+    track = BouncingBallTrack(**options)
+    recorder = None
+    try:
+        for _ in range(frames):
+            image = frame_to_array(track._render_frame(), frame_format)
+            if recorder is None:
+                balls = 1 if track.scene is None else len(track.scene.positions)
+                recorder = FrameRecorder(path, image.shape, frames, balls,
+                                         tagged=track.frame_tags)
+            recorder.write(image, track.frame_seq, ground_truth.positions(track.frame_seq),
+                           ground_truth.captured_at(track.frame_seq))
+    finally:
+        track.stop()
+        if recorder is not None:
+            recorder.close()
+
+
+if __name__ == "__main__":
+    from detection import DETECTORS, create_detector
+
+    parser = argparse.ArgumentParser(description="Record and replay bouncing ball frames")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser(
+        "record", help="Render frames with the server's track and record them")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--frames", type=int, default=1000)
+    record_parser.add_argument("--balls", type=int, default=1)
+    record_parser.add_argument("--width", type=int, default=640)
+    record_parser.add_argument("--height", type=int, default=480)
+    record_parser.add_argument("--frame-format", choices=RECORDING_FORMATS, default="bgr24")
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="Run a detector on a recording at full speed")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--detector", choices=DETECTORS, default=None,
+                               help="Detector to benchmark (default: every detector)")
+    replay_parser.add_argument("--tracking", action="store_true")
+    replay_parser.add_argument("--truth", default=None,
+                               help="Recording holding the actual positions, such as "
+                               "the server's recording of the session a client recorded")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        started = time.perf_counter()
+        record_scene(args.path, args.frames, args.frame_format, balls=args.balls,
+                     canvas_width=args.width, canvas_height=args.height)
+        print("Recorded %d frames to %s in %.1f s (%.1f MB)" % (
+            args.frames, args.path, time.perf_counter() - started,
+            os.path.getsize(args.path) / 1e6))
+    else:
+        recording = Recording(args.path)
+        truth = Recording(args.truth) if args.truth else None
+        names = [args.detector] if args.detector else list(DETECTORS)
+        for name in names:
+            detector = create_detector(name, args.tracking, recording.balls)
+            print(replay(recording, detector, truth).summary())
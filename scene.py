@@ -0,0 +1,18 @@
+"""
+Constants of the bouncing ball scene needed by both the server and the client.
+"""
+
+# Ball colours (BGR) by ball id, shared by the renderer and the detector so
+# that detected balls can be matched to ids. Ball i has colour
+# SCENE_PALETTE[i % len(SCENE_PALETTE)]. All colours are dark enough to stand
+# out from the white background.
+SCENE_PALETTE = (
+    (0, 0, 255),
+    (255, 0, 0),
+    (0, 160, 0),
+    (160, 0, 160),
+    (0, 0, 0),
+    (160, 160, 0),
+    (0, 100, 200),
+    (120, 120, 120),
+)
@@ -1,6 +1,9 @@
+import argparse
 import asyncio
 import fractions
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2 as cv
 from aiortc import (
@@ -9,18 +12,346 @@ from aiortc import (
     RTCSessionDescription,
     RTCIceCandidate,
 )
+from aiortc.contrib.media import MediaRelay
 from aiortc.contrib.signaling import TcpSocketSignaling, BYE
 from av import VideoFrame
+from frame_cache import FrameCache
+from frame_tags import TAG_ROWS, add_tag, add_tag_i420
+from latency import CLIENT_STAGES, LATENCY_STAGES, LatencyHistogram
 from logger import app_log
+from metrics import MetricsServer, Registry
+from pacing import LATE_POLICIES, FramePacer
+from protocol import REPORT_MODES, ReportFilter, decode_message
+from recording import FrameRecorder, frame_to_array
+from scene import SCENE_PALETTE
+from signaling_server import SignalingServer
+from stats import ErrorStats, relative_errors
 
 VIDEO_CLOCK_RATE = 90000
-VIDEO_PTIME = 1 / 30  # 30fps
+VIDEO_FPS = 30
+VIDEO_PTIME = 1 / VIDEO_FPS
 VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
 HOST_IP = '127.0.0.1'
 PORT_NO = 8080
+RENDER_MODES = ("full", "dirty")
+# Pixel format the scene is rendered in: BGR converted to YUV by the encoder,
+# or drawn straight into the encoder's yuv420p planes
+PIXEL_FORMATS = ("bgr24", "yuv420p")
+# Delivery of the position data channel: ordered and reliable, unordered
+# without retransmissions, or unordered with a retransmission deadline
+CHANNEL_MODES = ("reliable", "unreliable", "lifetime")
+# Default retransmission deadline of the "lifetime" channel mode in ms
+PACKET_LIFETIME = 100
 
-# Define queue to store ball positions
-locations_queue = asyncio.Queue()
+# Number of frames whose ball positions are kept for error computation
+GROUND_TRUTH_CAPACITY = 1024
+# Seconds between two logged summaries of a session's tracking errors
+SUMMARY_INTERVAL = 10
+
+# Metrics served by --metrics-port
+metrics_registry = Registry()
+frames_rendered = metrics_registry.counter(
+    "server_frames_rendered_total", "Frames drawn by the scene")
+frames_sent = metrics_registry.counter(
+    "server_frames_sent_total", "Frames handed to the video sender or relay")
+frames_skipped = metrics_registry.counter(
+    "server_frames_skipped_total", "Frame slots skipped by the pacer after a stall")
+render_time = metrics_registry.histogram(
+    "server_render_seconds", "Time to draw a frame and wrap it in a VideoFrame")
+encode_time = metrics_registry.histogram(
+    "server_encode_seconds", "Time from handing a frame to the sender until it asks for "
+    "the next one, mostly spent encoding")
+channel_messages = metrics_registry.counter(
+    "server_channel_messages_total", "Data channel messages", ["direction"])
+reports_received = metrics_registry.counter(
+    "server_reports_total", "Position reports accepted")
+reports_discarded = metrics_registry.counter(
+    "server_reports_discarded_total", "Position reports discarded as out of order")
+tracking_error = metrics_registry.histogram(
+    "server_tracking_error_percent", "Error of reported ball positions in percent",
+    ["axis"], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100))
+stage_latency = metrics_registry.histogram(
+    "server_latency_seconds", "End-to-end latency of tagged frames by stage", ["stage"])
+sessions_active = metrics_registry.gauge(
+    "server_sessions_active", "Peers currently connected")
+frame_cache_lookups = metrics_registry.counter(
+    "server_frame_cache_lookups_total", "Frame cache lookups by result", ["result"])
+frame_cache_bytes = metrics_registry.gauge(
+    "server_frame_cache_bytes", "Bytes of frames held by the frame cache")
+
+
+class GroundTruthStore:
+    """
+    Fixed-size ring of actual ball positions indexed by frame sequence number.
+
+    Frame seq is stored in slot seq % capacity, so recording and looking up a
+    position are O(1) and memory stays constant however long the server runs.
+    Positions older than capacity frames are forgotten. Every frame holds the
+    positions of the same number of balls, indexed by ball id.
+    """
+
+    def __init__(self, capacity=GROUND_TRUTH_CAPACITY, balls=1):
+        self.capacity = capacity
+        self._allocate(balls)
+
+    def _allocate(self, balls: int) -> None:
+        self.balls = balls
+        self._seqs = np.full(self.capacity, -1, dtype=np.int64)
+        self._positions = np.zeros((self.capacity, balls, 2), dtype=np.int32)
+        self._times = np.full(self.capacity, np.nan)
+        self.latest_seq = -1
+        # Frame last handed out by the track, which trails latest_seq when
+        # frames are rendered ahead; -1 until the track reports one
+        self.sent_seq = -1
+
+    def __len__(self) -> int:
+        return min(self.latest_seq + 1, self.capacity)
+
+    def record(self, seq: int, positions, timestamp=None) -> None:
+        """
+        Stores the ball positions of frame seq: a single (x, y) or an (N, 2)
+        array indexed by ball id, and the time.monotonic() at which the frame
+        was drawn. Recording a different number of balls than before clears
+        the store.
+        """
+        positions = np.reshape(positions, (-1, 2))
+        if len(positions) != self.balls:
+            self._allocate(len(positions))
+        slot = seq % self.capacity
+        self._seqs[slot] = seq
+        self._positions[slot] = positions
+        self._times[slot] = np.nan if timestamp is None else timestamp
+        self.latest_seq = max(self.latest_seq, seq)
+
+    @property
+    def current_seq(self) -> int:
+        """
+        The frame the client sees now: the one last sent if known, else the
+        most recently recorded.
+        """
+        return self.sent_seq if self.sent_seq >= 0 else self.latest_seq
+
+    def _slot(self, seq: int):
+        slot = seq % self.capacity
+        if seq < 0 or self._seqs[slot] != seq:
+            return None
+        return slot
+
+    def get(self, seq: int, default=None, ball=0):
+        """
+        Returns the position (x, y) of a ball in frame seq, or default if the
+        frame was never recorded or has been overwritten, or has no such ball.
+        """
+        slot = self._slot(seq)
+        if slot is None or not 0 <= ball < self.balls:
+            return default
+        x, y = self._positions[slot, ball]
+        return int(x), int(y)
+
+    def captured_at(self, seq: int):
+        """
+        Returns the time.monotonic() at which frame seq was drawn, or None if
+        the frame or its time is not known.
+        """
+        slot = self._slot(seq)
+        if slot is None or np.isnan(self._times[slot]):
+            return None
+        return float(self._times[slot])
+
+    def lookup(self, seqs, balls):
+        """
+        Looks up the positions of many (frame, ball) pairs at once.
+
+        Args:
+            seqs (array_like): Frame sequence numbers; -1 for the frame
+                last sent, see current_seq.
+            balls (array_like): Ball ids.
+        Returns:
+            tuple: (N, 2) positions and a boolean mask of the pairs that
+            are known; positions of unknown pairs are undefined.
+        """
+        seqs = np.asarray(seqs, dtype=np.int64)
+        balls = np.asarray(balls, dtype=np.int64)
+        seqs = np.where(seqs < 0, self.current_seq, seqs)
+        slots = seqs % self.capacity
+        known = (seqs >= 0) & (self._seqs[slots] == seqs) & (balls >= 0) & (balls < self.balls)
+        positions = self._positions[slots, np.where(known, balls, 0)]
+        return positions, known
+
+    def positions(self, seq: int):
+        """
+        Returns a copy of the (N, 2) positions of every ball in frame seq, or
+        None if the frame is not known.
+        """
+        slot = self._slot(seq)
+        if slot is None:
+            return None
+        return self._positions[slot].copy()
+
+    def __getitem__(self, seq: int) -> tuple:
+        position = self.get(seq)
+        if position is None:
+            raise KeyError(seq)
+        return position
+
+    def latest(self) -> tuple:
+        """
+        Returns (seq, (x, y)) of ball 0 in the frame last sent, see
+        current_seq.
+
+        Raises:
+            KeyError: If no position was recorded yet.
+        """
+        return self.current_seq, self[self.current_seq]
+
+
+class BallScene:
+    """
+    Several bouncing balls whose positions, velocities, radii and colours are
+    kept in NumPy arrays, so that moving, bouncing and drawing all the balls
+    takes a handful of array operations whatever their number.
+
+    Ball 0 starts like the single ball of BouncingBallTrack; the others start
+    at random positions and directions drawn from a seeded generator. Ball i
+    has colour SCENE_PALETTE[i % len(SCENE_PALETTE)].
+    """
+
+    def __init__(self, count, canvas_width, canvas_height, radius=10, speed=20, seed=0):
+        rng = np.random.default_rng(seed)
+        self.size = np.array([canvas_width, canvas_height])
+        self.radii = np.full(count, radius)
+
+        self.positions = rng.integers(
+            radius + 1, self.size - radius - 1, size=(count, 2))
+        self.positions[0] = self.size // 2
+        self.velocities = speed * rng.choice([-1, 1], size=(count, 2))
+        self.velocities[0] = speed
+
+        self.colors = np.array(
+            [SCENE_PALETTE[i % len(SCENE_PALETTE)] for i in range(count)], dtype=np.uint8)
+
+        # Pixel offsets of a filled disk, by radius
+        self._disks = {}
+        # Pixels drawn by the last draw(), erased by the next one
+        self._drawn = None
+
+    def step(self) -> None:
+        """
+        Moves every ball by its velocity and reverses the velocity components
+        of balls touching a wall, as BouncingBallTrack does for one ball.
+        """
+        self.positions += self.velocities
+        radii = self.radii[:, None]
+        hit = (self.positions + radii >= self.size) | (self.positions - radii <= 0)
+        self.velocities[hit] *= -1
+
+    def _disk(self, radius: int):
+        if radius not in self._disks:
+            dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+            inside = dx * dx + dy * dy <= radius * radius
+            self._disks[radius] = dx[inside], dy[inside]
+        return self._disks[radius]
+
+    def draw(self, canvas, erase=True) -> None:
+        """
+        Draws every ball into canvas with one fancy-indexed assignment per
+        distinct radius.
+
+        Args:
+            canvas (ndarray): BGR image to draw into.
+            erase (bool): First paint the pixels of the previous draw() white,
+                for canvases that are reused between frames.
+        """
+        if erase and self._drawn is not None:
+            for ys, xs in self._drawn:
+                canvas[ys, xs] = 255
+
+        height, width = canvas.shape[:2]
+        self._drawn = []
+        for radius in np.unique(self.radii):
+            balls = self.radii == radius
+            dx, dy = self._disk(int(radius))
+            xs = self.positions[balls, 0, None] + dx
+            ys = self.positions[balls, 1, None] + dy
+            colors = np.broadcast_to(
+                self.colors[balls, None, :], xs.shape + (3,))
+            visible = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+            ys, xs = ys[visible], xs[visible]
+            canvas[ys, xs] = colors[visible]
+            self._drawn.append((ys, xs))
+
+
+# Define store of actual ball positions by frame
+ground_truth = GroundTruthStore()
+
+
+def bgr_to_yuv(color) -> tuple:
+    """
+    Converts a BGR colour to limited range BT.601 (Y, U, V), as libav does
+    when converting bgr24 frames to yuv420p.
+    """
+    b, g, r = color
+    y = 16 + (65.481 * r + 128.553 * g + 24.966 * b) / 255
+    u = 128 + (-37.797 * r - 74.203 * g + 112.0 * b) / 255
+    v = 128 + (112.0 * r - 93.786 * g - 18.214 * b) / 255
+    return tuple(int(round(c)) for c in (y, u, v))
+
+
+class FrameLookahead:
+    """
+    Renders the next frames of a track ahead of time in a worker thread and
+    keeps up to depth of them ready.
+
+    Rendering and colour conversion run in NumPy, OpenCV and libav, which
+    release the GIL, so the event loop stays free while the next frames are
+    produced. A single thread renders the frames, in the order they are
+    requested, since each frame advances the track's state.
+    """
+
+    def __init__(self, render, depth):
+        """
+        Args:
+            render (callable): Produces the next frame.
+            depth (int): Number of frames rendered ahead.
+        """
+        if depth < 1:
+            raise ValueError("Lookahead depth must be at least 1: %s" % depth)
+        self.render = render
+        self.depth = depth
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+        self._pending = deque()
+        # Frames that were, or were not, ready when requested
+        self.hits = 0
+        self.misses = 0
+
+    def _fill(self, loop) -> None:
+        while len(self._pending) < self.depth:
+            self._pending.append(loop.run_in_executor(self._executor, self.render))
+
+    async def next(self):
+        """
+        Returns the oldest rendered frame, waiting for it if necessary, and
+        queues the rendering of another one.
+        """
+        self._fill(asyncio.get_running_loop())
+        future = self._pending.popleft()
+        if future.done():
+            self.hits += 1
+        else:
+            self.misses += 1
+        frame = await future
+        self._fill(asyncio.get_running_loop())
+        return frame
+
+    def close(self) -> None:
+        """
+        Cancels the frames not yet rendered and waits for the one being
+        rendered, if any, so that the track's state is left alone afterwards.
+        """
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True, cancel_futures=True)
 
 
 class BouncingBallTrack(MediaStreamTrack):
@@ -30,15 +361,55 @@ class BouncingBallTrack(MediaStreamTrack):
 
     kind = "video"
 
-    def __init__(self):
+    def __init__(self, render_mode="full", canvas_width=640, canvas_height=480, balls=1,
+                 fps=VIDEO_FPS, late_policy="skip", lookahead=0, pixel_format="bgr24",
+                 frame_tags=False, frame_cache=0):
+        """
+        Args:
+            render_mode (str): "full" redraws the whole canvas on every frame,
+                "dirty" keeps a persistent canvas and only repaints the previous
+                and current ball bounding boxes. Both produce identical frames.
+            canvas_width (int): Width of the generated frames in pixels.
+            canvas_height (int): Height of the generated frames in pixels.
+            balls (int): Number of balls. More than one ball switches to a
+                vectorized BallScene, whose ball 0 moves like the single ball.
+            fps (float): Frame rate of the track.
+            late_policy (str): What to do with frames produced after their
+                slot, one of LATE_POLICIES.
+            lookahead (int): Number of frames rendered ahead in a worker
+                thread; 0 renders each frame on the event loop in recv().
+            pixel_format (str): One of PIXEL_FORMATS. "yuv420p" draws the
+                ball into the planes handed to the encoder, saving a colour
+                conversion per frame; it needs an even canvas size and a
+                single ball.
+            frame_tags (bool): Append a band encoding the frame sequence
+                number below every frame sent, see frame_tags.py, so the
+                client can report which frame a position was detected in.
+            frame_cache (int): Keep up to this many bytes of rendered frames,
+                see FrameCache, and reuse them when the ball comes back to
+                the same place; 0 renders every frame.
+        """
         super().__init__()
+        if render_mode not in RENDER_MODES:
+            raise ValueError("Unknown render mode: %s" % render_mode)
+        self.render_mode = render_mode
+        if pixel_format not in PIXEL_FORMATS:
+            raise ValueError("Unknown pixel format: %s" % pixel_format)
+        if pixel_format == "yuv420p" and (balls > 1 or canvas_width % 2 or canvas_height % 2):
+            raise ValueError("yuv420p rendering needs a single ball and an even canvas size")
+        self.pixel_format = pixel_format
+        self.frame_tags = frame_tags
+
         self.ball_radius = 10
         self.ball_color = (0, 0, 255)
         self.ball_speed = 20
 
         # Define canvas properties
-        self.canvas_width = 640
-        self.canvas_height = 480
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+
+        # Sequence number of the last generated frame
+        self.frame_seq = -1
 
         # Initialize ball position and velocity
         self.ball_x = self.canvas_width // 2
@@ -46,76 +417,393 @@ class BouncingBallTrack(MediaStreamTrack):
         self.ball_dx = self.ball_speed
         self.ball_dy = self.ball_speed
 
+        # Persistent canvas and last drawn ball box for the "dirty" render mode
+        self._canvas = None
+        self._dirty_box = None
+        # Persistent I420 buffer of the "dirty" render mode in yuv420p
+        self._yuv = None
+
+        self.pacer = FramePacer(fps, late_policy, VIDEO_CLOCK_RATE)
+        # When the last frame was returned by recv()
+        self._handed_at = None
+        self.lookahead = FrameLookahead(self._render_numbered, lookahead) if lookahead else None
+
+        self.scene = None
+        if balls > 1:
+            self.scene = BallScene(balls, canvas_width, canvas_height,
+                                   self.ball_radius, self.ball_speed)
+        self.frame_cache = FrameCache(frame_cache) if frame_cache else None
+        # FrameRecorder of the frames rendered and their ball positions
+        self.recorder = None
+
+    def _update_ball(self):
+        # Update ball position
+        self.ball_x += self.ball_dx
+        self.ball_y += self.ball_dy
+
+        # Check if the ball hits the boundaries
+        if self.ball_x + self.ball_radius >= self.canvas_width or self.ball_x - self.ball_radius <= 0:
+            self.ball_dx *= -1  # Reverse horizontal velocity
+        if self.ball_y + self.ball_radius >= self.canvas_height or self.ball_y - self.ball_radius <= 0:
+            self.ball_dy *= -1  # Reverse vertical velocity
+
+        self.frame_seq += 1
+        ground_truth.record(self.frame_seq, (self.ball_x, self.ball_y), time.monotonic())
+
+    def _ball_box(self):
+        """
+        Returns the ball's bounding box as (x0, y0, x1, y1), clipped to the canvas.
+        """
+        x0 = max(self.ball_x - self.ball_radius, 0)
+        y0 = max(self.ball_y - self.ball_radius, 0)
+        x1 = min(self.ball_x + self.ball_radius + 1, self.canvas_width)
+        y1 = min(self.ball_y + self.ball_radius + 1, self.canvas_height)
+        return x0, y0, x1, y1
+
+    def _render_full(self):
+        # Create a blank canvas
+        canvas = np.zeros(
+            (self.canvas_height, self.canvas_width, 3), dtype=np.uint8)
+        canvas.fill(255)
+
+        # Draw the ball on the canvas
+        cv.circle(canvas, (self.ball_x, self.ball_y),
+                  self.ball_radius, self.ball_color, -1)
+
+        return canvas
+
+    def _render_dirty(self):
+        if self._canvas is None:
+            self._canvas = np.full(
+                (self.canvas_height, self.canvas_width, 3), 255, dtype=np.uint8)
+        elif self._dirty_box is not None:
+            # Erase the ball drawn on the previous frame
+            x0, y0, x1, y1 = self._dirty_box
+            self._canvas[y0:y1, x0:x1] = 255
+
+        cv.circle(self._canvas, (self.ball_x, self.ball_y),
+                  self.ball_radius, self.ball_color, -1)
+        self._dirty_box = self._ball_box()
+
+        return self._canvas
+
+    def _step_scene(self):
+        self.scene.step()
+        self.ball_x, self.ball_y = (int(v) for v in self.scene.positions[0])
+        self.frame_seq += 1
+        ground_truth.record(self.frame_seq, self.scene.positions, time.monotonic())
+
+    def _render_scene(self):
+        if self.render_mode == "dirty":
+            if self._canvas is None:
+                self._canvas = np.full(
+                    (self.canvas_height, self.canvas_width, 3), 255, dtype=np.uint8)
+            self.scene.draw(self._canvas)
+            return self._canvas
+
+        canvas = np.full(
+            (self.canvas_height, self.canvas_width, 3), 255, dtype=np.uint8)
+        self.scene.draw(canvas, erase=False)
+        return canvas
+
     def generate_moving_ball(self):
-        while True:
-            # Create a blank canvas
-            canvas = np.zeros(
-                (self.canvas_height, self.canvas_width, 3), dtype=np.uint8)
-            canvas.fill(255)
+        """
+        Advances the ball by one step and renders it.
 
-            # Update ball position
-            self.ball_x += self.ball_dx
-            self.ball_y += self.ball_dy
+        In "dirty" render mode the returned array is the track's persistent
+        canvas, which is overwritten by the next call; copy it if it has to
+        outlive the current frame.
+        """
+        self._advance()
+        return self._render_bgr()
 
-            # Check if the ball hits the boundaries
-            if self.ball_x + self.ball_radius >= self.canvas_width or self.ball_x - self.ball_radius <= 0:
-                self.ball_dx *= -1  # Reverse horizontal velocity
-            if self.ball_y + self.ball_radius >= self.canvas_height or self.ball_y - self.ball_radius <= 0:
-                self.ball_dy *= -1  # Reverse vertical velocity
+    def _advance(self):
+        if self.scene is not None:
+            self._step_scene()
+        else:
+            self._update_ball()
+
+    def _render_bgr(self):
+        if self.scene is not None:
+            return self._render_scene()
+        if self.render_mode == "dirty":
+            return self._render_dirty()
+        return self._render_full()
+
+    def _yuv_planes(self, buffer):
+        """
+        Returns the Y, U and V planes of an I420 buffer of shape
+        (height * 3 / 2, width), as laid out by VideoFrame.from_ndarray().
+        """
+        width, height = self.canvas_width, self.canvas_height
+        chroma = buffer[height:].reshape(2, height // 2, width // 2)
+        return buffer[:height], chroma[0], chroma[1]
+
+    def generate_yuv_frame(self):
+        """
+        Advances the ball by one step and renders it into an I420 buffer of
+        shape (height * 3 / 2, width), without going through BGR.
+
+        In "dirty" render mode the buffer is reused by the next call.
+        """
+        self._update_ball()
+        return self._render_yuv()
+
+    def _render_yuv(self):
+        width, height = self.canvas_width, self.canvas_height
+        ball_y, ball_u, ball_v = bgr_to_yuv(self.ball_color)
+        white_y, white_u, white_v = bgr_to_yuv((255, 255, 255))
+
+        if self.render_mode == "dirty" and self._yuv is not None:
+            buffer = self._yuv
+            y_plane, u_plane, v_plane = self._yuv_planes(buffer)
+            if self._dirty_box is not None:
+                # Erase the ball drawn on the previous frame
+                x0, y0, x1, y1 = self._dirty_box
+                y_plane[y0:y1, x0:x1] = white_y
+                u_plane[y0 // 2:(y1 + 1) // 2, x0 // 2:(x1 + 1) // 2] = white_u
+                v_plane[y0 // 2:(y1 + 1) // 2, x0 // 2:(x1 + 1) // 2] = white_v
+        else:
+            buffer = np.empty((height * 3 // 2, width), dtype=np.uint8)
+            y_plane, u_plane, v_plane = self._yuv_planes(buffer)
+            y_plane.fill(white_y)
+            u_plane.fill(white_u)
+            v_plane.fill(white_v)
+            if self.render_mode == "dirty":
+                self._yuv = buffer
+
+        center = (self.ball_x, self.ball_y)
+        cv.circle(y_plane, center, self.ball_radius, ball_y, -1)
+        chroma_center = (self.ball_x // 2, self.ball_y // 2)
+        cv.circle(u_plane, chroma_center, self.ball_radius // 2, ball_u, -1)
+        cv.circle(v_plane, chroma_center, self.ball_radius // 2, ball_v, -1)
+        self._dirty_box = self._ball_box()
+        return buffer
 
-            server_ball_position = [self.ball_x, self.ball_y]
-            locations_queue.put_nowait(server_ball_position)
+    def _picture_key(self):
+        """
+        Returns what the picture of the current frame depends on: the ball
+        positions.
+        """
+        if self.scene is not None:
+            return self.scene.positions.tobytes()
+        return self.ball_x, self.ball_y
 
-            # Draw the ball on the canvas
-            cv.circle(canvas, (self.ball_x, self.ball_y),
-                      self.ball_radius, self.ball_color, -1)
+    def _state_key(self):
+        """
+        Returns the state that determines all the following frames: the ball
+        positions and velocities.
+        """
+        if self.scene is not None:
+            return self.scene.positions.tobytes() + self.scene.velocities.tobytes()
+        return self.ball_x, self.ball_y, self.ball_dx, self.ball_dy
 
-            return canvas
+    def _cached_frame(self):
+        """
+        Advances the scene and returns its frame from the frame cache, rendering
+        and storing it on a miss.
+
+        Without frame tags the cache holds VideoFrame objects, which are handed
+        out again with a new pts one or more periods later. With frame tags it
+        holds the untagged pictures, since every frame gets its own tag.
+        """
+        self._advance()
+        cache = self.frame_cache
+        cache.observe(self._state_key())
+        key = self._picture_key()
+        picture = cache.get(key)
+        frame_cache_lookups.labels("miss" if picture is None else "hit").inc()
+
+        if picture is None:
+            if self.pixel_format == "yuv420p":
+                picture = self._render_yuv()
+            else:
+                picture = self._render_bgr()
+            if self.frame_tags:
+                # The "dirty" render mode reuses its canvas
+                picture = picture.copy()
+                size = picture.nbytes
+            else:
+                picture = VideoFrame.from_ndarray(picture, format=self.pixel_format)
+                size = sum(plane.buffer_size for plane in picture.planes)
+            cache.put(key, picture, size)
+            frame_cache_bytes.set(cache.resident_bytes)
+
+        if not self.frame_tags:
+            return picture
+        if self.pixel_format == "yuv420p":
+            picture = add_tag_i420(picture, self.frame_seq)
+        else:
+            picture = add_tag(picture, self.frame_seq)
+        return VideoFrame.from_ndarray(picture, format=self.pixel_format)
+
+    def _render_frame(self):
+        started = time.monotonic()
+        if self.frame_cache is not None:
+            frame = self._cached_frame()
+        elif self.pixel_format == "yuv420p":
+            buffer = self.generate_yuv_frame()
+            if self.frame_tags:
+                buffer = add_tag_i420(buffer, self.frame_seq)
+            frame = VideoFrame.from_ndarray(buffer, format="yuv420p")
+        else:
+            canvas = self.generate_moving_ball()
+            if self.frame_tags:
+                canvas = add_tag(canvas, self.frame_seq)
+            frame = VideoFrame.from_ndarray(canvas, format="bgr24")
+        render_time.observe(time.monotonic() - started)
+        frames_rendered.inc()
+        if self.recorder is not None and not self.recorder.full:
+            self.recorder.write(
+                frame_to_array(frame, "bgr24" if self.recorder.channels == 3 else "gray"),
+                self.frame_seq, ground_truth.positions(self.frame_seq),
+                ground_truth.captured_at(self.frame_seq))
+        return frame
+
+    def _render_numbered(self):
+        frame = self._render_frame()
+        return frame, self.frame_seq
 
     async def recv(self):
-        ball_canvas = self.generate_moving_ball()
-        frame = VideoFrame.from_ndarray(ball_canvas, format="bgr24")
+        if self._handed_at is not None:
+            encode_time.observe(time.monotonic() - self._handed_at)
+        if self.lookahead is None:
+            frame, seq = self._render_numbered()
+        else:
+            # The frames rendered ahead are already recorded as ground truth
+            frame, seq = await self.lookahead.next()
+        ground_truth.sent_seq = seq
 
         pts, time_base = await self.next_timestamp()
         frame.pts = pts
         frame.time_base = time_base
+        frames_sent.inc()
+        self._handed_at = time.monotonic()
         return frame
 
+    def stop(self):
+        super().stop()
+        if self.lookahead is not None:
+            self.lookahead.close()
+
     async def next_timestamp(self):
-        if hasattr(self, "_timestamp"):
-            self._timestamp += int(VIDEO_PTIME * VIDEO_CLOCK_RATE)
-            wait = self._start + (self._timestamp /
-                                  VIDEO_CLOCK_RATE) - time.time()
-            await asyncio.sleep(wait)
-        else:
-            self._start = time.time()
-            self._timestamp = 0
-        return self._timestamp, VIDEO_TIME_BASE
+        """
+        Waits for the next frame slot of the pacer and returns its
+        presentation timestamp and time base.
+        """
+        skipped = self.pacer.stats.skipped_frames
+        pts = await self.pacer.wait()
+        frames_skipped.inc(self.pacer.stats.skipped_frames - skipped)
+        return pts, VIDEO_TIME_BASE
 
 
-def compute_errors(reported_location: tuple, server_queue: asyncio.Queue) -> float:
-    """
-    Computes the percentage error between the reported ball location and actual ball location.
+# Tracking errors of every session together
+global_errors = ErrorStats()
 
-    Args:
-        reported_location (tuple): The reported ball location as (x, y) coordinates.
-        server_queue (asyncio.Queue): The queue storing the actual ball locations.
 
-    Returns:
-        float: The percentage error.
+class Session:
     """
-    actual_location = server_queue.get_nowait()
-    print('Actual location:', tuple(actual_location))
+    Per-peer state of the server: how ball positions are exchanged with the
+    peer and the tracking errors of the positions it reported.
+    """
+
+    def __init__(self, name="peer", report_mode="poll", channel_config=None,
+                 started_at=None):
+        """
+        Args:
+            name (str): Label of the peer in logs.
+            report_mode (str): One of REPORT_MODES.
+            channel_config (dict): createDataChannel keyword arguments, see
+                channel_options.
+            started_at (float): time.monotonic() at which the peer's signaling
+                connection was accepted; defaults to now.
+        """
+        self.name = name
+        self.started_at = time.monotonic() if started_at is None else started_at
+        # Seconds from started_at until the peer connection was established
+        self.time_to_connected = None
+        self.report_mode = report_mode
+        self.channel_config = channel_config or {}
+        # Unordered channels may deliver a report after a newer one
+        self.report_filter = ReportFilter()
+        self.reports = 0
+        # Reports for frames or balls missing from the ground truth store
+        self.unmatched = 0
+        self.errors = ErrorStats()
+        self.latency = {stage: LatencyHistogram() for stage in LATENCY_STAGES}
 
-    percentage_error_x = abs(
-        actual_location[0] - reported_location[0]) / actual_location[0] * 100
-    percentage_error_y = abs(
-        actual_location[1] - reported_location[1]) / actual_location[1] * 100
+    def record_reports(self, reports, store, errors=None) -> None:
+        """
+        Compares a batch of accepted reports to the actual ball positions
+        and adds their errors to the session's and to errors, in one
+        vectorized update.
 
-    print("Error in ball's x coordinate: %.2f" % percentage_error_x, "%")
-    print("Error in ball's y coordinate: %.2f" % percentage_error_y, "%")
+        Args:
+            reports (list): PositionReport objects.
+            store (GroundTruthStore): Actual positions by frame.
+            errors (ErrorStats): Other statistics to update, e.g. the
+                global ones.
+        """
+        if not reports:
+            return
+        self.reports += len(reports)
+        reported = np.array([(report.x, report.y) for report in reports], dtype=np.float64)
+        seqs = [-1 if report.seq is None else report.seq for report in reports]
+        actual, known = store.lookup(seqs, [report.ball for report in reports])
+        self.unmatched += int((~known).sum())
+        if not known.any():
+            return
+        reported, actual = reported[known], actual[known]
+        self.errors.update(reported, actual)
+        if errors is not None:
+            errors.update(reported, actual)
 
-    return round(percentage_error_x, 2), round(percentage_error_y, 2)
+        for x, y in relative_errors(reported, actual):
+            tracking_error.labels("x").observe(x)
+            tracking_error.labels("y").observe(y)
+
+    def summary(self) -> str:
+        text = "%s: %s" % (self.name, self.errors.summary())
+        if self.unmatched:
+            text += ", %d without ground truth" % self.unmatched
+        return text
+
+    def log_summary(self) -> None:
+        app_log.info(self.summary())
+        app_log.info("all sessions: %s" % global_errors.summary())
+
+    async def summarize_every(self, interval: float) -> None:
+        """
+        Logs the error summary every interval seconds until cancelled, so
+        that a peer that stops reporting still shows up in the logs.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.log_summary()
+
+    def record_latency(self, report, captured_at: float, arrived_at: float) -> None:
+        """
+        Adds the stage latencies of one report about a frame drawn at
+        captured_at and received at arrived_at, both time.monotonic().
+        """
+        total = arrived_at - captured_at
+        samples = [("total", total)]
+        if report.stages is not None:
+            samples += zip(CLIENT_STAGES, report.stages)
+            samples.append(("transport", max(total - sum(report.stages), 0.0)))
+        for stage, seconds in samples:
+            self.latency[stage].record(seconds)
+            stage_latency.labels(stage).observe(seconds)
+
+    def latency_summary(self) -> str:
+        return "\n".join("  %-9s %s" % (stage, histogram.summary())
+                         for stage, histogram in self.latency.items() if histogram.count)
+
+    def mean_errors(self) -> tuple:
+        """
+        Returns the mean (x, y) percentage errors of all reports, or None.
+        """
+        return self.errors.mean_relative()
 
 
 async def consume_signaling(pc, signaling):
@@ -143,73 +831,272 @@ async def consume_signaling(pc, signaling):
                 await signaling.send(pc.localDescription)
         elif isinstance(obj, RTCIceCandidate):
             await pc.addIceCandidate(obj)
-        elif obj is BYE:
+        elif obj is BYE or obj is None:
+            # None means the signaling connection was closed
             print("Exiting")
             break
 
 
-async def run_offer(pc, signaling):
+def channel_options(mode="reliable", packet_lifetime=PACKET_LIFETIME) -> dict:
+    """
+    Returns the createDataChannel keyword arguments for a channel mode.
+
+    Args:
+        mode (str): One of CHANNEL_MODES.
+        packet_lifetime (int): Retransmission deadline in ms for "lifetime".
+    """
+    if mode == "reliable":
+        return {}
+    if mode == "unreliable":
+        return {"ordered": False, "maxRetransmits": 0}
+    if mode == "lifetime":
+        return {"ordered": False, "maxPacketLifeTime": packet_lifetime}
+    raise ValueError("Unknown channel mode: %s" % mode)
+
+
+async def run_offer(pc, signaling, session=None):
     app_log.info("Receiving live ball locations from client...")
     await signaling.connect()
+    if session is None:
+        session = Session()
 
-    channel = pc.createDataChannel("live ball locations")
+    channel = pc.createDataChannel(
+        "live ball locations", **session.channel_config)
 
     async def wait_for_ball_location():
         while True:
             channel.send("Server is waiting for live ball locations...")
+            channel_messages.labels("sent").inc()
             await asyncio.sleep(1)
 
     @channel.on("open")
     def on_open():
-        asyncio.ensure_future(wait_for_ball_location())
+        # In push mode the client reports without being prompted
+        if session.report_mode == "poll":
+            asyncio.ensure_future(wait_for_ball_location())
 
     @channel.on("message")
     def on_message(message):
-        print(f"channel({channel.label}): {message}")
-        if isinstance(message, str) and message:
-            app_log.info(
-                "Current ball location sent by client\n %s " % message)
-            client_ball_position_x, client_ball_position_y = int(
-                message.split(',')[0][1:]), int(message.split(',')[1][:-1])
+        arrived_at = time.monotonic()
+        channel_messages.labels("received").inc()
+        if not message:
+            return
+        try:
+            reports = decode_message(message)
+        except ValueError as exc:
+            app_log.warning("Ignoring message from client: %s" % exc)
+            return
+
+        accepted = [report for report in reports if session.report_filter.accept(report)]
+        reports_discarded.inc(len(reports) - len(accepted))
+        reports_received.inc(len(accepted))
+
+        for report in accepted:
+            if report.seq is not None:
+                captured_at = ground_truth.captured_at(report.seq)
+                if captured_at is not None:
+                    session.record_latency(report, captured_at, arrived_at)
 
-            # compute error to the actual location of the ball
-            compute_errors(
-                (client_ball_position_x, client_ball_position_y), locations_queue)
+        # compute errors to the actual locations of the balls
+        session.record_reports(accepted, ground_truth, global_errors)
 
     # send offer
     await pc.setLocalDescription(await pc.createOffer())
     await signaling.send(pc.localDescription)
 
-    await consume_signaling(pc, signaling)
+    sessions_active.inc()
+    summaries = asyncio.ensure_future(session.summarize_every(SUMMARY_INTERVAL))
+    try:
+        await consume_signaling(pc, signaling)
+    finally:
+        summaries.cancel()
+        sessions_active.dec()
+    app_log.info(session.summary())
+    if session.latency["total"].count:
+        app_log.info("%s latency:\n%s" % (session.name, session.latency_summary()))
 
 
-async def run_signaling(pc, signaling):
+async def run_signaling(pc, signaling, bouncing_ball=None, session=None):
     app_log.info("Signaling path on server...")
 
     # connect signaling
     await signaling.connect()
-    bouncing_ball = BouncingBallTrack()
+    if bouncing_ball is None:
+        bouncing_ball = BouncingBallTrack()
 
     # add bouncing ball media track
     pc.addTrack(bouncing_ball)
 
     # Send pings
-    await run_offer(pc, signaling)
+    await run_offer(pc, signaling, session)
     offer = await pc.createOffer()
     app_log.info('Offer was created and sent to client')
     await pc.setLocalDescription(offer)
     await signaling.send(pc.localDescription)
 
 
+async def run_session(scene, signaling, session) -> None:
+    """
+    Runs one peer of a multi-session server: a new peer connection that
+    receives the relayed scene, until the peer says BYE or disconnects.
+
+    Args:
+        scene (MediaStreamTrack): Track to send, usually a MediaRelay proxy of
+            the shared scene.
+        signaling: Signaling connected to the peer.
+        session (Session): State of the peer.
+    """
+    pc = RTCPeerConnection()
+
+    @pc.on("connectionstatechange")
+    def on_connectionstatechange():
+        if pc.connectionState == "connected" and session.time_to_connected is None:
+            session.time_to_connected = time.monotonic() - session.started_at
+            app_log.info("%s connected in %.3f s" %
+                         (session.name, session.time_to_connected))
+
+    try:
+        pc.addTrack(scene)
+        await run_offer(pc, signaling, session)
+    finally:
+        scene.stop()
+        await pc.close()
+
+
+async def run_multi_session(scene, host=HOST_IP, port=PORT_NO, max_sessions=0,
+                            **session_options):
+    """
+    Serves one scene to every client that connects to a SignalingServer. The
+    scene is rendered once and its frames are relayed to every peer, which
+    gets its own peer connection, encoder and error accounting.
+
+    Args:
+        scene (MediaStreamTrack): The rendered scene, e.g. a BouncingBallTrack.
+        host (str): Signaling address.
+        port (int): Signaling port.
+        max_sessions (int): Most concurrent peers; 0 for no limit.
+        session_options: Keyword arguments for every Session.
+    """
+    relay = MediaRelay()
+
+    async def handle(signaling, session_id, accepted_at):
+        session = Session("peer-%d" % session_id, started_at=accepted_at,
+                          **session_options)
+        # Late peers get the newest frame rather than a backlog
+        await run_session(relay.subscribe(scene, buffered=False), signaling, session)
+
+    server = SignalingServer(handle, host, port, max_sessions)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def finish_track(track) -> None:
+    """
+    Stops a track that is done sending, logs its frame pacing and frame
+    cache statistics, and closes its recorder.
+    """
+    # Stopping waits for the lookahead thread, which writes to the recorder
+    track.stop()
+    app_log.info("Frame pacing: %s" % track.pacer.stats.summary())
+    if track.frame_cache is not None:
+        app_log.info("Frame cache: %s" % track.frame_cache.summary())
+    if track.recorder is not None:
+        track.recorder.close()
+        app_log.info("Recorded %d frames to %s" % (track.recorder.count, track.recorder.path))
+
+
 if __name__ == "__main__":
-    signaling = TcpSocketSignaling(HOST_IP, PORT_NO)
-    peer_connection = RTCPeerConnection()
+    parser = argparse.ArgumentParser(
+        description="Bouncing ball server")
+    parser.add_argument("--render-mode", choices=RENDER_MODES, default="full",
+                        help="Frame rendering strategy (default: full)")
+    parser.add_argument("--balls", type=int, default=1,
+                        help="Number of bouncing balls in the scene (default: 1)")
+    parser.add_argument("--fps", type=float, default=VIDEO_FPS,
+                        help="Frame rate of the scene (default: %d)" % VIDEO_FPS)
+    parser.add_argument("--late-policy", choices=LATE_POLICIES, default="skip",
+                        help="Frames produced after their slot skip the missed slots, "
+                        "or are sent back to back until caught up (default: skip)")
+    parser.add_argument("--lookahead", type=int, default=0,
+                        help="Number of frames rendered ahead in a worker thread "
+                        "(default: 0, render on the event loop)")
+    parser.add_argument("--pixel-format", choices=PIXEL_FORMATS, default="bgr24",
+                        help="Render in BGR, or directly into the encoder's yuv420p "
+                        "planes (default: bgr24)")
+    parser.add_argument("--frame-tags", action="store_true",
+                        help="Embed the frame sequence number below every frame, for "
+                        "end-to-end latency measurement; the client needs --frame-tags too")
+    parser.add_argument("--frame-cache", type=float, default=0,
+                        help="Reuse up to this many MB of rendered frames when the "
+                        "balls come back to the same places (default: 0, disabled)")
+    parser.add_argument("--record", default=None, metavar="PATH",
+                        help="Record the frames sent and the ball positions to PATH, "
+                        "for recording.py replay (default: disabled)")
+    parser.add_argument("--record-frames", type=int, default=1000,
+                        help="Most frames recorded with --record (default: 1000)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics "
+                        "(default: disabled)")
+    parser.add_argument("--report-mode", choices=REPORT_MODES, default="poll",
+                        help="Prompt the client for positions every second, or consume "
+                        "the positions it pushes (default: poll)")
+    parser.add_argument("--channel-mode", choices=CHANNEL_MODES, default="reliable",
+                        help="Delivery of the position data channel: reliable and ordered, "
+                        "unordered without retransmissions, or unordered with a "
+                        "retransmission deadline (default: reliable)")
+    parser.add_argument("--packet-lifetime", type=int, default=PACKET_LIFETIME,
+                        help="Retransmission deadline in ms of the lifetime channel mode "
+                        "(default: %d)" % PACKET_LIFETIME)
+    parser.add_argument("--multi-session", action="store_true",
+                        help="Accept any number of concurrent clients on the signaling "
+                        "port and relay one rendered scene to all of them")
+    parser.add_argument("--max-sessions", type=int, default=0,
+                        help="Most concurrent clients in multi-session mode "
+                        "(default: 0, no limit)")
+    args = parser.parse_args()
+
     loop = asyncio.get_event_loop()
+    bouncing_ball = BouncingBallTrack(render_mode=args.render_mode, balls=args.balls,
+                                      fps=args.fps, late_policy=args.late_policy,
+                                      lookahead=args.lookahead,
+                                      pixel_format=args.pixel_format,
+                                      frame_tags=args.frame_tags,
+                                      frame_cache=int(args.frame_cache * 1e6))
+    if args.record:
+        # yuv420p frames are recorded as their luma plane
+        shape = (bouncing_ball.canvas_height + (TAG_ROWS if args.frame_tags else 0),
+                 bouncing_ball.canvas_width)
+        if args.pixel_format == "bgr24":
+            shape += (3,)
+        bouncing_ball.recorder = FrameRecorder(
+            args.record, shape, args.record_frames, args.balls, tagged=args.frame_tags)
+    session_options = {
+        "report_mode": args.report_mode,
+        "channel_config": channel_options(args.channel_mode, args.packet_lifetime),
+    }
 
+    if args.metrics_port is not None:
+        loop.run_until_complete(
+            MetricsServer(metrics_registry, port=args.metrics_port).start())
+
+    signaling = peer_connection = None
     try:
-        loop.run_until_complete(run_signaling(peer_connection, signaling))
+        if args.multi_session:
+            loop.run_until_complete(
+                run_multi_session(bouncing_ball, max_sessions=args.max_sessions,
+                                  **session_options))
+        else:
+            signaling = TcpSocketSignaling(HOST_IP, PORT_NO)
+            peer_connection = RTCPeerConnection()
+            loop.run_until_complete(
+                run_signaling(peer_connection, signaling, bouncing_ball,
+                              Session(**session_options)))
     except KeyboardInterrupt:
         pass
     finally:
-        loop.run_until_complete(signaling.close())
-        loop.run_until_complete(peer_connection.close())
+        if signaling is not None:
+            loop.run_until_complete(signaling.close())
+            loop.run_until_complete(peer_connection.close())
+        finish_track(bouncing_ball)
@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+import time
+
+from aiortc.contrib.signaling import BYE, BaseSignaling, object_from_string, object_to_string
+from logger import app_log
+
+
+class StreamSignaling(BaseSignaling):
+    """
+    Signaling over one accepted TCP connection, using the same newline
+    delimited JSON messages as aiortc's TcpSocketSignaling, so unmodified
+    clients can connect.
+
+    receive() returns None once the peer has disconnected.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    async def connect(self) -> None:
+        pass
+
+    @property
+    def closed(self) -> bool:
+        return self._writer.is_closing()
+
+    async def send(self, descr) -> None:
+        # Messages for a peer that already left are dropped
+        if self.closed:
+            return
+        self._writer.write(object_to_string(descr).encode("utf8") + b"\n")
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+    async def receive(self):
+        try:
+            data = await self._reader.readuntil()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return object_from_string(data.decode("utf8"))
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        await self.send(BYE)
+        self._writer.close()
+
+
+class LoopbackSignaling(BaseSignaling):
+    """
+    Signaling between two peers in the same process, through a pair of
+    queues. Messages are serialized as TcpSocketSignaling does, so both peers
+    see exactly what they would over TCP. Create both ends with pair().
+
+    receive() returns None once this end has been closed.
+    """
+
+    def __init__(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        self._inbox = inbox
+        self._outbox = outbox
+        self.closed = False
+
+    @classmethod
+    def pair(cls):
+        """
+        Returns two connected ends.
+        """
+        first, second = asyncio.Queue(), asyncio.Queue()
+        return cls(first, second), cls(second, first)
+
+    async def connect(self) -> None:
+        pass
+
+    async def send(self, descr) -> None:
+        if not self.closed:
+            await self._outbox.put(object_to_string(descr))
+
+    async def receive(self):
+        data = await self._inbox.get()
+        return None if data is None else object_from_string(data)
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        await self.send(BYE)
+        self.closed = True
+        await self._inbox.put(None)
+
+
+class SignalingServer:
+    """
+    TCP signaling service that accepts many clients at once and runs a
+    session handler for each connection.
+
+    The handler is a coroutine function called with (signaling, session_id,
+    accepted_at), where accepted_at is the time.monotonic() at which the
+    connection was accepted. When it returns, or the client disconnects, the
+    connection is closed and the session forgotten.
+    """
+
+    def __init__(self, handler, host: str, port: int, max_sessions=0):
+        """
+        Args:
+            handler (callable): Coroutine function run for every connection.
+            host (str): Address to listen on.
+            port (int): Port to listen on; 0 picks a free port.
+            max_sessions (int): Connections beyond this many concurrent
+                sessions are refused; 0 for no limit.
+        """
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.refused = 0
+        self._ids = itertools.count()
+        self._server = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._on_connection, host=self.host, port=self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        app_log.info("Signaling server listening on %s:%d" % (self.host, self.port))
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def _on_connection(self, reader, writer) -> None:
+        accepted_at = time.monotonic()
+        signaling = StreamSignaling(reader, writer)
+        if self.max_sessions and len(self.sessions) >= self.max_sessions:
+            self.refused += 1
+            app_log.warning("Refusing signaling connection: %d sessions active" %
+                            len(self.sessions))
+            await signaling.close()
+            return
+
+        session_id = next(self._ids)
+        self.sessions[session_id] = asyncio.current_task()
+        try:
+            await self.handler(signaling, session_id, accepted_at)
+        except Exception:
+            app_log.exception("Session %d failed" % session_id)
+        finally:
+            del self.sessions[session_id]
+            await signaling.close()
+
+    async def close(self) -> None:
+        """
+        Stops accepting connections and cancels the running sessions.
+        """
+        if self._server is not None:
+            self._server.close()
+        tasks = list(self.sessions.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,179 @@
+"""
+Online statistics that are updated one value or one batch at a time, in
+constant memory.
+"""
+import numpy as np
+
+
+class RunningStats:
+    """
+    Count, mean, variance, minimum and maximum of a stream of values, with
+    Welford's algorithm. Batches are merged with the parallel form of the
+    algorithm (Chan et al.), so a batch costs a few NumPy reductions rather
+    than a Python loop.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def update(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def update_batch(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not values.size:
+            return
+        count = self.count + values.size
+        batch_mean = values.mean()
+        delta = batch_mean - self.mean
+        self._m2 += ((values - batch_mean) ** 2).sum() + \
+            delta * delta * self.count * values.size / count
+        self.mean += delta * values.size / count
+        self.count = count
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return self.variance ** 0.5
+
+
+class LogHistogram:
+    """
+    Histogram with logarithmic buckets, so percentiles are reported within
+    the bucket ratio of their true value in constant memory. Values below
+    the first bound share the first bucket.
+    """
+
+    def __init__(self, low: float, high: float, ratio=1.05):
+        """
+        Args:
+            low (float): Upper bound of the first bucket.
+            high (float): Upper bound of the last bucket; larger values are
+                counted in an overflow bucket.
+            ratio (float): Ratio between consecutive bucket bounds.
+        """
+        self.bounds = np.geomspace(low, high, int(np.log(high / low) / np.log(ratio)) + 1)
+        self.counts = np.zeros(len(self.bounds) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        self.counts[np.searchsorted(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def record_many(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not values.size:
+            return
+        self.counts += np.bincount(np.searchsorted(self.bounds, values),
+                                   minlength=len(self.counts))
+        self.count += values.size
+        self.total += float(values.sum())
+        self.max = max(self.max, float(values.max()))
+
+    def percentile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket holding the q-th percentile, or
+        NaN if nothing was recorded.
+        """
+        if not self.count:
+            return float("nan")
+        rank = np.searchsorted(np.cumsum(self.counts), q / 100 * self.count)
+        if rank >= len(self.bounds):
+            return self.max
+        return min(float(self.bounds[rank]), self.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else float("nan")
+
+
+def relative_errors(reported, actual) -> np.ndarray:
+    """
+    Returns the error of reported positions in percent of the actual
+    coordinates, per axis. A coordinate of 0 counts as 1 pixel, so a ball
+    touching the edge does not divide by zero.
+
+    Args:
+        reported (ndarray): (N, 2) reported positions.
+        actual (ndarray): (N, 2) actual positions.
+    """
+    return np.abs(reported - actual) / np.maximum(np.abs(actual), 1) * 100
+
+
+class ErrorStats:
+    """
+    Tracking error of reported ball positions against the actual ones.
+
+    For each axis, it keeps the absolute error in pixels and the relative
+    error in percent of the actual coordinate, see relative_errors(). It also
+    keeps the distance in pixels between reported and actual centres, with
+    its percentiles.
+    """
+
+    def __init__(self):
+        self.pixels = {"x": RunningStats(), "y": RunningStats()}
+        self.relative = {"x": RunningStats(), "y": RunningStats()}
+        self.distance = RunningStats()
+        self.distance_histogram = LogHistogram(0.1, 10000)
+
+    @property
+    def count(self) -> int:
+        return self.distance.count
+
+    def update(self, reported, actual) -> None:
+        """
+        Adds a batch of reports.
+
+        Args:
+            reported (array_like): (N, 2) reported positions, or one (x, y).
+            actual (array_like): (N, 2) actual positions, or one (x, y).
+        """
+        reported = np.reshape(np.asarray(reported, dtype=np.float64), (-1, 2))
+        actual = np.reshape(np.asarray(actual, dtype=np.float64), (-1, 2))
+        errors = np.abs(reported - actual)
+        relative = relative_errors(reported, actual)
+        for axis, column in (("x", 0), ("y", 1)):
+            self.pixels[axis].update_batch(errors[:, column])
+            self.relative[axis].update_batch(relative[:, column])
+        distances = np.hypot(errors[:, 0], errors[:, 1])
+        self.distance.update_batch(distances)
+        self.distance_histogram.record_many(distances)
+
+    def mean_relative(self):
+        """
+        Returns the mean (x, y) relative errors in percent, or None.
+        """
+        if not self.count:
+            return None
+        return round(self.relative["x"].mean, 2), round(self.relative["y"].mean, 2)
+
+    def summary(self) -> str:
+        if not self.count:
+            return "no reports"
+        return ("%d reports, error x %.2f px (%.2f%%) y %.2f px (%.2f%%), "
+                "distance mean %.2f px std %.2f px p50 %.1f p95 %.1f p99 %.1f max %.1f px" % (
+                    self.count,
+                    self.pixels["x"].mean, self.relative["x"].mean,
+                    self.pixels["y"].mean, self.relative["y"].mean,
+                    self.distance.mean, self.distance.std,
+                    self.distance_histogram.percentile(50),
+                    self.distance_histogram.percentile(95),
+                    self.distance_histogram.percentile(99), self.distance.max))
@@ -1,10 +1,35 @@
 from aiortc import RTCSessionDescription, RTCIceCandidate
 from unittest.mock import AsyncMock, MagicMock
 import asyncio
+import queue
+import time
 import cv2 as cv
+import numpy as np
 import pytest
 from aiortc.contrib.signaling import BYE
+from aiortc.mediastreams import MediaStreamError
 from pytest_mock import mocker
+from multiprocessing import Pipe
+from av import VideoFrame
+import client
+from client import (
+    FrameDisplay,
+    FrameHandoff,
+    ImageDisplayReceiver,
+    PipelineReceiver,
+    PositionStreamer,
+    ReceiptLog,
+    build_pipeline,
+    detect_frame,
+    luma_plane,
+    process_frame,
+    report_detections,
+)
+from detection import ContourDetector, Detection
+from frame_ring import SharedFrameRing
+from position_record import SharedPosition
+from protocol import ReportFilter, decode_message
+from recording import FrameRecorder, Recording
 
 
 @pytest.fixture
@@ -109,6 +134,15 @@ async def test_consume_signaling(mocker):
     assert signaling.send.call_count == 0
 
 
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_consume_signaling_ends_when_signaling_closes():
+    signaling = MagicMock()
+    signaling.receive = AsyncMock(return_value=None)
+    await client.consume_signaling(MagicMock(), signaling)
+    assert signaling.receive.call_count == 1
+
+
 # Helper functions to create RTCSessionDescription and RTCIceCandidate objects
 
 async def create_offer():
@@ -173,3 +207,362 @@ async def test_run_signaling(mocker):
     assert signaling.connect.call_count == 0
     assert pc.on.call_count == 0
     assert pc.addTrack.call_count == 0
+
+
+def drain(frames):
+    items = []
+    while not frames.empty():
+        items.append(frames.get_nowait())
+    return items
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy, expected, dropped", [
+    ("drop-newest", [0, 1], 3),
+    ("drop-oldest", [3, 4], 3),
+    ("keep-latest", [4], 4),
+])
+async def test_FrameHandoff_policies(policy, expected, dropped):
+    frames = queue.Queue(2)
+    handoff = FrameHandoff(frames, policy)
+
+    for image in range(5):
+        await handoff.put(image)
+
+    assert drain(frames) == expected
+    assert handoff.dropped == dropped
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_FrameHandoff_block_does_not_block_event_loop():
+    frames = queue.Queue(1)
+    handoff = FrameHandoff(frames, "block")
+    await handoff.put(0)
+
+    put_task = asyncio.ensure_future(handoff.put(1))
+    await asyncio.sleep(0.05)
+    # The loop kept running while put() waits for room
+    assert not put_task.done()
+
+    assert frames.get_nowait() == 0
+    await put_task
+    assert frames.get_nowait() == 1
+    assert handoff.dropped == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy, dropped", [
+    ("drop-oldest", 3), ("keep-latest", 4), ("drop-newest", 3)])
+async def test_FrameHandoff_with_SharedFrameRing(policy, dropped):
+    ring = SharedFrameRing((2, 2, 3), slots=3, latest=policy == "keep-latest")
+    handoff = FrameHandoff(ring, policy)
+    try:
+        for value in range(5):
+            await handoff.put(np.full((2, 2, 3), value, dtype=np.uint8))
+        frames_read = [ring.get(timeout=1)[0, 0, 0]]
+        handoff.collect_ring_drops()
+        assert handoff.dropped == dropped
+        # Each frame is either read or dropped
+        while not ring.empty():
+            frames_read.append(ring.get(timeout=1)[0, 0, 0])
+        handoff.collect_ring_drops()
+        assert len(frames_read) + handoff.dropped == 5
+    finally:
+        ring.close()
+
+
+@pytest.mark.asyncio
+async def test_FrameHandoff_drop_oldest_ring_reads_in_order():
+    ring = SharedFrameRing((2, 2, 3), slots=8, latest=False)
+    handoff = FrameHandoff(ring, "drop-oldest")
+    try:
+        for value in range(5):
+            await handoff.put(np.full((2, 2, 3), value, dtype=np.uint8))
+        assert ring.get(timeout=1)[0, 0, 0] == 0
+        handoff.collect_ring_drops()
+        assert handoff.dropped == 0
+        assert ring.skipped == 0
+    finally:
+        ring.close()
+
+
+def test_FrameHandoff_unknown_policy():
+    with pytest.raises(ValueError):
+        FrameHandoff(queue.Queue(), "drop-all")
+
+
+class FakeChannel:
+    readyState = "open"
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+def test_PositionStreamer_pushes_every_detection():
+    streamer = PositionStreamer()
+    streamer.publish(Detection(1, 2, None))
+    # Nothing is lost before the channel opens
+    streamer.channel = FakeChannel()
+    streamer.publish(Detection(3, 4, None))
+    streamer.publish(Detection(5, 6, None))
+    assert streamer.channel.sent == ["(3, 4)", "(5, 6)"]
+
+
+def test_PositionStreamer_numbers_untagged_reports_for_ordering():
+    streamer = PositionStreamer("binary")
+    streamer.channel = FakeChannel()
+    for x in range(4):
+        streamer.publish(Detection(x, x, None))
+    streamer.publish(Detection(9, 9, None, seq=42))
+
+    reports = [decode_message(message)[0] for message in streamer.channel.sent]
+    assert [report.report_seq for report in reports] == [0, 1, 2, 3, None]
+    assert [report.seq for report in reports] == [None] * 4 + [42]
+
+    # An unordered channel delivers the second report last: the server's
+    # filter discards it as stale
+    report_filter = ReportFilter()
+    delivered = [reports[0], reports[2], reports[3], reports[1]]
+    accepted = [report.x for report in delivered if report_filter.accept(report)]
+    assert accepted == [0, 2, 3]
+    assert report_filter.discarded == 1
+
+
+def test_PositionStreamer_rate_limit_batches_binary_reports():
+    streamer = PositionStreamer("binary", rate=1)
+    streamer.channel = FakeChannel()
+    for x in range(4):
+        streamer.publish(Detection(x, x, None))
+
+    assert len(streamer.channel.sent) == 1
+    streamer._last_sent -= 1
+    streamer.flush()
+    assert len(streamer.channel.sent) == 2
+    assert [report.x for report in decode_message(streamer.channel.sent[1])] == [1, 2, 3]
+
+
+def test_PositionStreamer_reports_client_stages():
+    receipts = ReceiptLog(capacity=2)
+    receipts.record(5, 10.0)
+    receipts.record(6, 10.5)
+    streamer = PositionStreamer("binary", receipts=receipts)
+    streamer.channel = FakeChannel()
+
+    now = time.monotonic()
+    streamer.publish(Detection(1, 2, None, seq=6, timing=(now - 0.1, now - 0.05)))
+    report, = decode_message(streamer.channel.sent[0])
+    assert report.seq == 6
+    queue_stage, detect_stage, report_stage = report.stages
+    assert queue_stage == pytest.approx(now - 0.1 - 10.5)
+    assert detect_stage == pytest.approx(0.05, abs=1e-6)
+    assert 0.05 <= report_stage < 1
+
+    # Frames whose decoding time is forgotten report no stages
+    receipts.record(7, 11.0)
+    streamer.publish(Detection(1, 2, None, seq=5, timing=(now, now)))
+    assert decode_message(streamer.channel.sent[1])[0].stages is None
+
+
+class StopDetection(Exception):
+    pass
+
+
+def test_process_frame_discards_detections_in_overwritten_frames():
+    ring = SharedFrameRing((48, 64, 3), slots=4, latest=False)
+    ball_location = SharedPosition()
+    image = np.full((48, 64, 3), 255, dtype=np.uint8)
+    image[20:30, 30:40] = 0
+    calls = []
+
+    class OverwritingDetector(ContourDetector):
+        def detect(self, frame):
+            calls.append(ring.last_read)
+            if len(calls) > 1:
+                raise StopDetection
+            # The receiver publishes a full ring of frames meanwhile
+            for _ in range(ring.slots):
+                ring.publish(image)
+            return super().detect(frame)
+
+    try:
+        ring.publish(image)
+        with pytest.raises(StopDetection):
+            process_frame(ring, ball_location, OverwritingDetector())
+        assert ball_location.read() is None
+        # Frame 1 was discarded and frame 2 overwritten before it was read
+        assert calls == [1, 3]
+        assert ring.skipped == 2
+    finally:
+        ball_location.close()
+        ring.close()
+
+
+def test_detections_report_detection_time_and_confidence():
+    image = np.full((48, 64, 3), 255, dtype=np.uint8)
+    cv.circle(image, (35, 25), 10, (0, 0, 255), -1)
+    before = time.monotonic()
+    detections = detect_frame(image, ContourDetector())
+    started, finished = detections[0].timing
+    assert before <= started <= finished <= time.monotonic()
+
+    ball_location = SharedPosition()
+    streamer = PositionStreamer("binary")
+    streamer.channel = FakeChannel()
+    try:
+        report_detections(detections, ball_location, streamer)
+        # The poll reply and the pushed report carry the same fields
+        for report in (ball_location.read(), decode_message(streamer.channel.sent[0])[0]):
+            assert (report.x, report.y) == (35, 25)
+            assert report.timestamp == pytest.approx(finished)
+            assert 0.85 < report.confidence <= 1
+    finally:
+        ball_location.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_PositionStreamer_follows_pipe():
+    streamer = PositionStreamer()
+    streamer.channel = FakeChannel()
+    receiver, sender = Pipe(duplex=False)
+    streamer.follow(receiver, asyncio.get_running_loop())
+
+    sender.send(Detection(7, 8, (0, 0, 1, 1)))
+    while not streamer.channel.sent:
+        await asyncio.sleep(0.01)
+    assert streamer.channel.sent == ["(7, 8)"]
+    sender.close()
+
+
+@pytest.mark.parametrize("width, height", [(640, 480), (330, 210)])
+def test_luma_plane_is_the_frame_y_plane(width, height):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    frame = VideoFrame.from_ndarray(image, format="bgr24").reformat(format="yuv420p")
+
+    plane = luma_plane(frame)
+    assert plane.shape == (height, width)
+    assert np.array_equal(plane, frame.to_ndarray()[:height])
+
+
+@pytest.fixture
+def highgui(mocker):
+    calls = {}
+    for name in ("namedWindow", "resizeWindow", "imshow", "destroyWindow"):
+        calls[name] = mocker.patch("cv2." + name)
+    calls["waitKey"] = mocker.patch("cv2.waitKey", return_value=-1)
+    return calls
+
+
+def test_FrameDisplay_shows_latest_frame_only(highgui):
+    display = FrameDisplay(rate=20)
+    for n in range(10):
+        display.show(n)
+    display.start()
+    try:
+        deadline = time.monotonic() + 2
+        while display.shown < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        display.close()
+
+    assert display.replaced == 9
+    highgui["imshow"].assert_called_once_with("Bouncing Ball", 9)
+    highgui["destroyWindow"].assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_ImageDisplayReceiver_headless_makes_no_highgui_calls(highgui, mocker):
+    frames = [VideoFrame.from_ndarray(np.zeros((48, 64, 3), dtype=np.uint8), format="bgr24")] * 3
+    track = mocker.Mock()
+    track.recv = AsyncMock(side_effect=frames + [RuntimeError("ended")])
+    frames_out = queue.Queue(8)
+
+    receiver = ImageDisplayReceiver(track, frames_out)
+    with pytest.raises(RuntimeError):
+        await receiver.recv()
+
+    assert frames_out.qsize() == 3
+    for call in highgui.values():
+        call.assert_not_called()
+
+
+def test_build_pipeline_checks_the_stages():
+    position = SharedPosition()
+    try:
+        pipeline = build_pipeline("convert:thread,detect:process:2:keep-latest,report",
+                                  position)
+        assert [stage.name for stage in pipeline.stages] == ["convert", "detect", "report"]
+        assert pipeline.stages[1].concurrency == "process"
+        for spec in ("detect,convert", "convert,report", "detect", "convert,decode",
+                     "convert,convert", "convert,display"):
+            with pytest.raises(ValueError):
+                build_pipeline(spec, position)
+        with pytest.raises(ValueError):
+            build_pipeline("convert,detect,report:thread", position,
+                           streamer=PositionStreamer())
+    finally:
+        position.close()
+
+
+class FrameTrack:
+    def __init__(self, frames):
+        self.frames = list(frames)
+
+    async def recv(self):
+        if not self.frames:
+            raise MediaStreamError
+        return self.frames.pop(0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(20)
+@pytest.mark.parametrize("spec", ["convert,detect,report",
+                                  "convert:thread,detect:process,report"])
+async def test_PipelineReceiver_detects_and_reports(spec):
+    image = np.full((48, 64, 3), 255, dtype=np.uint8)
+    cv.circle(image, (20, 30), 5, (0, 0, 255), -1)
+    frames = [VideoFrame.from_ndarray(image, format="bgr24")] * 5
+    position = SharedPosition()
+    streamer = PositionStreamer()
+    streamer.channel = FakeChannel()
+    try:
+        pipeline = build_pipeline(spec, position, streamer=streamer)
+        receiver = PipelineReceiver(FrameTrack(frames), pipeline)
+        # Every frame is passed through; the pipeline has handled them all
+        # once the track ends
+        for frame in frames:
+            assert await receiver.recv() is frame
+        with pytest.raises(MediaStreamError):
+            await receiver.recv()
+
+        report = position.read()
+        assert (report.x, report.y) == (20, 30)
+        assert streamer.channel.sent == ["(20, 30)"] * 5
+        assert pipeline.stats["detect"].items == 5
+        assert pipeline.bottleneck() in ("convert", "detect", "report")
+    finally:
+        position.close()
+
+
+@pytest.mark.asyncio
+async def test_ImageDisplayReceiver_records_frames(tmp_path, mocker):
+    images = [np.full((48, 64, 3), value, dtype=np.uint8) for value in (10, 20, 30)]
+    track = mocker.Mock()
+    track.recv = AsyncMock(side_effect=[VideoFrame.from_ndarray(image, format="bgr24")
+                                        for image in images] + [RuntimeError("ended")])
+    recorder = FrameRecorder(str(tmp_path / "client.rec"), (48, 64, 3), capacity=2)
+
+    receiver = ImageDisplayReceiver(track, queue.Queue(8), recorder=recorder)
+    with pytest.raises(RuntimeError):
+        await receiver.recv()
+    recorder.close()
+
+    recording = Recording(recorder.path)
+    assert recording.seqs.tolist() == [0, 1]
+    assert np.array_equal(recording.frames, images[:2])
+    assert np.isnan(recording.positions).all()
@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+from detection import (
+    DETECTORS,
+    BallMatcher,
+    BallTracker,
+    ContourDetector,
+    MomentsDetector,
+    PyramidDetector,
+    TaggedDetector,
+    ball_confidence,
+    box_center,
+    create_detector,
+    find_ball_box,
+)
+from frame_tags import add_tag
+from scene import SCENE_PALETTE
+from server import BouncingBallTrack
+
+
+def rendered_scenes(count, balls):
+    track = BouncingBallTrack(balls=balls)
+    for _ in range(count):
+        frame = track.generate_moving_ball()
+        yield frame, track.scene.positions.copy()
+
+
+def rendered_frames(count, width=640, height=480):
+    track = BouncingBallTrack(canvas_width=width, canvas_height=height)
+    for _ in range(count):
+        frame = track.generate_moving_ball()
+        yield frame, (track.ball_x, track.ball_y)
+
+
+def test_find_ball_box():
+    frame, position = next(rendered_frames(1))
+    assert box_center(find_ball_box(frame)) == position
+
+
+def test_find_ball_box_empty_frame():
+    assert find_ball_box(np.full((48, 64, 3), 255, dtype=np.uint8)) is None
+
+
+@pytest.mark.parametrize("name", DETECTORS)
+def test_detectors_find_ball(name):
+    detector = create_detector(name)
+    for frame, position in rendered_frames(100):
+        detection = detector.detect(frame)
+        assert detection.box == find_ball_box(frame)
+        # Clipped balls at the canvas edges are off-centre in the image
+        if detection.box[2] == detection.box[3]:
+            assert (detection.x, detection.y) == position
+
+
+def disc_frame(cx, cy, radius=10, width=64, height=48):
+    ys, xs = np.mgrid[:height, :width]
+    frame = np.full((height, width, 3), 255, dtype=np.uint8)
+    frame[(xs - cx) ** 2 + (ys - cy) ** 2 <= radius ** 2] = (0, 0, 255)
+    return frame
+
+
+@pytest.mark.parametrize("name", DETECTORS)
+def test_detectors_confidence(name):
+    detector = create_detector(name)
+    whole = detector.detect(disc_frame(32, 24)).confidence
+    # Half of the ball is outside the frame
+    half = detector.detect(disc_frame(0, 24)).confidence
+    assert 0.85 < whole <= 1
+    assert 0.4 < half < 0.6
+    assert ball_confidence((0, 0, 0, 5), 0) == 0
+
+
+@pytest.mark.parametrize("name", DETECTORS)
+def test_detectors_empty_frame(name):
+    blank = np.full((48, 64, 3), 255, dtype=np.uint8)
+    assert create_detector(name).detect(blank) is None
+
+
+@pytest.mark.parametrize("name", DETECTORS)
+def test_detectors_find_ball_in_luma_plane(name):
+    detector = create_detector(name)
+    track = BouncingBallTrack(pixel_format="yuv420p")
+    for frame, _ in rendered_frames(100):
+        luma = track.generate_yuv_frame()[:track.canvas_height]
+        assert detector.detect(luma) == detector.detect(frame)
+
+
+def test_MomentsDetector_centroid():
+    image = np.full((40, 60, 3), 255, dtype=np.uint8)
+    # An L shape: centroid differs from the bounding-box centre
+    image[10:20, 10:30] = 0
+    image[20:30, 10:20] = 0
+    detection = MomentsDetector().detect(image)
+    assert detection.box == (10, 10, 20, 20)
+    assert (detection.x, detection.y) == (18, 18)
+
+
+def test_PyramidDetector_small_ball_falls_back_to_full_search():
+    image = np.full((40, 60, 3), 255, dtype=np.uint8)
+    image[13, 21] = 0
+    detection = PyramidDetector(factor=4).detect(image)
+    assert detection.box == (21, 13, 1, 1)
+
+
+def test_create_detector_unknown_name():
+    with pytest.raises(ValueError):
+        create_detector("hough")
+
+
+@pytest.mark.parametrize("width, height", [(640, 480), (1280, 720)])
+@pytest.mark.parametrize("name", DETECTORS)
+def test_BallTracker_matches_full_frame_search(name, width, height):
+    tracker = create_detector(name, tracking=True)
+    full = DETECTORS[name]()
+    for frame, _ in rendered_frames(300, width, height):
+        assert tracker.detect(frame) == full.detect(frame)
+
+    # Full scans are only needed until the velocity is known
+    assert tracker.full_scans == 2
+
+
+def test_BallTracker_recovers_lost_ball():
+    tracker = BallTracker(ContourDetector())
+    frames = [frame.copy() for frame, _ in rendered_frames(3)]
+    tracker.detect(frames[0])
+
+    # Ball jumps far away from the predicted position
+    jumped = np.full_like(frames[0], 255)
+    jumped[10:31, 10:31] = (0, 0, 255)
+    assert tracker.detect(jumped).box == find_ball_box(jumped)
+    assert tracker.full_scans == 2
+
+    blank = np.full_like(frames[0], 255)
+    assert tracker.detect(blank) is None
+    assert tracker.box is None
+
+
+@pytest.mark.parametrize("balls", [4, 12])
+def test_BallMatcher_assigns_scene_ids(balls):
+    matcher = create_detector(balls=balls)
+    assert isinstance(matcher, BallMatcher)
+    checked = 0
+    for frame, positions in rendered_scenes(100, balls):
+        detections = matcher.detect_all(frame)
+        # Overlapping balls merge into one contour; only check clean frames
+        gaps = np.abs(positions[:, None, :] - positions[None, :, :]).max(axis=2)
+        if (gaps + 100 * np.eye(balls) <= 2 * 10 + 2).any():
+            continue
+        assert sorted(d.ball for d in detections) == list(range(balls))
+        for detection in detections:
+            true_ball = np.abs(positions - (detection.x, detection.y)).sum(axis=1).argmin()
+            # Balls of the same colour can only be told apart by their history,
+            # and are interchangeable in the first frame
+            assert true_ball % len(SCENE_PALETTE) == detection.ball % len(SCENE_PALETTE)
+            if balls <= len(SCENE_PALETTE):
+                assert detection.ball == true_ball
+        checked += 1
+    assert checked > 20
+
+
+def test_BallMatcher_needs_multi_ball_detector():
+    with pytest.raises(ValueError):
+        create_detector("moments", balls=3)
+    with pytest.raises(ValueError):
+        create_detector(tracking=True, balls=3)
+
+
+def test_TaggedDetector_reads_frame_seq():
+    detector = TaggedDetector(create_detector(tracking=True))
+    for seq, (frame, position) in enumerate(rendered_frames(30)):
+        detection = detector.detect(add_tag(frame, 1000 + seq))
+        assert detection.seq == 1000 + seq
+        assert detection == create_detector().detect(frame)._replace(
+            seq=detection.seq, timing=detection.timing)
+        started, finished = detection.timing
+        assert started <= finished
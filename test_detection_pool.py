@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import pytest
+from detection import MomentsDetector
+from detection_pool import DetectionPool
+
+SHAPE = (48, 64, 3)
+
+
+def make_frame(x):
+    frame = np.full(SHAPE, 255, dtype=np.uint8)
+    frame[20:25, x:x + 5] = 0
+    return frame
+
+
+class Results:
+    def __init__(self):
+        self.items = []
+        self.event = threading.Event()
+        self.expected = 0
+
+    def __call__(self, seq, detection):
+        self.items.append((seq, detection))
+        if len(self.items) >= self.expected:
+            self.event.set()
+
+
+def run_pool(ordering, count):
+    results = Results()
+    results.expected = count
+    pool = DetectionPool(SHAPE, results, MomentsDetector(), workers=2,
+                         ordering=ordering, backlog=count)
+    pool.start()
+    try:
+        for x in range(count):
+            pool.put(make_frame(x))
+        results.event.wait(5)
+    finally:
+        pool.close()
+    return pool, results.items
+
+
+@pytest.mark.timeout(10)
+def test_DetectionPool_ordered_results():
+    pool, items = run_pool("ordered", 8)
+    assert [seq for seq, _ in items] == list(range(1, 9))
+    assert [detection.x for _, detection in items] == [x + 2 for x in range(8)]
+    assert pool.missed == 0
+
+
+@pytest.mark.timeout(10)
+def test_DetectionPool_latest_results_are_increasing():
+    pool, items = run_pool("latest", 8)
+    seqs = [seq for seq, _ in items]
+    assert seqs == sorted(seqs)
+    assert pool.delivered + pool.missed == seqs[-1]
+
+
+@pytest.mark.timeout(10)
+def test_DetectionPool_ordered_skips_removed_frames():
+    results = Results()
+    results.expected = 2
+    pool = DetectionPool(SHAPE, results, MomentsDetector(), workers=2, backlog=2)
+    # Queue frames before the workers start so they can be removed
+    pool.put(make_frame(1))
+    pool.put(make_frame(2))
+    with pytest.raises(queue.Full):
+        pool.put_nowait(make_frame(3))
+    # Give the queue's feeder thread time to flush the tasks
+    time.sleep(0.1)
+    assert pool.get_nowait() == 1
+    pool.put(make_frame(4))
+    pool.start()
+    try:
+        results.event.wait(5)
+        # Let the collector account for everything it has received
+        time.sleep(0.05)
+    finally:
+        pool.close()
+    assert [seq for seq, _ in results.items] == [2, 3]
+    assert pool.missed == 1
+
+
+def test_DetectionPool_unknown_ordering():
+    with pytest.raises(ValueError):
+        DetectionPool(SHAPE, print, ordering="random")
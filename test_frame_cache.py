@@ -0,0 +1,44 @@
+import pytest
+from frame_cache import FrameCache
+
+
+def test_FrameCache_evicts_least_recently_used():
+    cache = FrameCache(max_bytes=30)
+    for key in "abc":
+        assert cache.put(key, key.upper(), 10)
+    assert cache.get("a") == "A"
+    cache.put("d", "D", 10)
+
+    # "b" was the least recently used
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.resident_bytes == 30
+    assert cache.evictions == 1
+    assert cache.hit_rate == pytest.approx(4 / 5)
+    # Frames larger than the cache are not stored
+    assert not cache.put("e", "E", 31)
+
+
+@pytest.mark.parametrize("tail, period", [(0, 1), (0, 7), (5, 12), (100, 3)])
+def test_FrameCache_detects_period(tail, period):
+    cache = FrameCache(max_bytes=1)
+    states = list(range(-tail, 0)) + list(range(period)) * (4 * (tail + period))
+    for state in states:
+        cache.observe(state)
+    assert cache.period == period
+
+
+def test_FrameCache_stops_admitting_when_a_cycle_does_not_fit():
+    cache = FrameCache(max_bytes=2)
+    hits = 0
+    for _ in range(5):
+        for state in range(4):
+            cache.observe(state)
+            if cache.get(state) is None:
+                cache.put(state, state, 1)
+            else:
+                hits += 1
+    assert cache.period == 4
+    assert not cache.admitting
+    # The two frames kept are hit on every later cycle
+    assert hits >= 2 * 3
@@ -0,0 +1,86 @@
+import queue
+from multiprocessing import Process, Queue
+
+import numpy as np
+import pytest
+from frame_ring import SharedFrameRing
+
+
+@pytest.fixture
+def ring():
+    frame_ring = SharedFrameRing((4, 6, 3), slots=4)
+    yield frame_ring
+    frame_ring.close()
+
+
+def make_frame(value):
+    return np.full((4, 6, 3), value, dtype=np.uint8)
+
+
+def test_SharedFrameRing_latest_frame_wins(ring):
+    for value in range(3):
+        ring.publish(make_frame(value))
+
+    frame = ring.get(timeout=1)
+    assert np.array_equal(frame, make_frame(2))
+    assert ring.last_read == 3
+    assert ring.skipped == 2
+    assert ring.qsize() == 0
+
+    with pytest.raises(queue.Empty):
+        ring.get(block=False)
+
+
+def test_SharedFrameRing_in_order_read_skips_overwritten_frames(ring):
+    for value in range(10):
+        ring.publish(make_frame(value))
+
+    # Slots hold frames 7..10, but the slot after the newest one may be in
+    # the middle of a write, so in-order reads start at frame 8.
+    seqs = []
+    while (item := ring.read(latest=False)) is not None:
+        seqs.append(item[0])
+        assert np.array_equal(item[1], make_frame(item[0] - 1))
+    assert seqs == [8, 9, 10]
+    assert ring.skipped == 7
+
+
+def test_SharedFrameRing_is_current(ring):
+    seq = ring.publish(make_frame(1))
+    assert ring.is_current(seq)
+    for value in range(ring.slots):
+        ring.publish(make_frame(value))
+    assert not ring.is_current(seq)
+
+
+def test_SharedFrameRing_put_respects_capacity(ring):
+    for value in range(ring.maxsize):
+        ring.put_nowait(make_frame(value))
+    assert ring.full()
+
+    with pytest.raises(queue.Full):
+        ring.put_nowait(make_frame(0))
+    with pytest.raises(queue.Full):
+        ring.put(make_frame(0), timeout=0.01)
+
+    ring.get_nowait()
+    ring.put_nowait(make_frame(0))
+
+
+def test_SharedFrameRing_rejects_wrong_shape(ring):
+    with pytest.raises(ValueError):
+        ring.put(np.zeros((2, 2, 3), dtype=np.uint8))
+
+
+def read_one_frame(frame_ring, results):
+    results.put(frame_ring.get(timeout=5, copy=True).sum())
+
+
+@pytest.mark.timeout(10)
+def test_SharedFrameRing_across_processes(ring):
+    results = Queue()
+    reader = Process(target=read_one_frame, args=(ring, results))
+    reader.start()
+    ring.put(make_frame(7))
+    assert results.get(timeout=5) == make_frame(7).sum()
+    reader.join()
@@ -0,0 +1,56 @@
+import fractions
+
+import av
+import numpy as np
+import pytest
+from frame_tags import TAG_ROWS, add_tag, add_tag_i420, read_tag, strip_tag
+from server import BouncingBallTrack
+
+
+@pytest.mark.parametrize("seq", [0, 1, 123456789, 0xFFFFFFFF])
+def test_tag_round_trip(seq):
+    image = np.full((48, 640, 3), 255, dtype=np.uint8)
+    tagged = add_tag(image, seq)
+    assert tagged.shape == (48 + TAG_ROWS, 640, 3)
+    assert np.array_equal(strip_tag(tagged), image)
+    assert read_tag(tagged) == seq
+    assert read_tag(tagged[..., 0]) == seq
+
+
+def test_read_tag_rejects_untagged_frames():
+    assert read_tag(np.full((64, 640), 255, dtype=np.uint8)) is None
+    assert read_tag(np.zeros((64, 640), dtype=np.uint8)) is None
+
+
+def test_add_tag_i420_matches_frame_layout():
+    track = BouncingBallTrack(pixel_format="yuv420p")
+    buffer = track.generate_yuv_frame()
+    frame = av.VideoFrame.from_ndarray(add_tag_i420(buffer, 42), format="yuv420p")
+
+    assert (frame.width, frame.height) == (640, 480 + TAG_ROWS)
+    assert read_tag(frame.to_ndarray(format="bgr24")) == 42
+    untagged = av.VideoFrame.from_ndarray(buffer, format="yuv420p").to_ndarray(format="bgr24")
+    assert np.array_equal(strip_tag(frame.to_ndarray(format="bgr24")), untagged)
+
+
+def test_tag_survives_vp8_coding():
+    encoder = av.CodecContext.create("libvpx", "w")
+    encoder.width, encoder.height = 640, 480 + TAG_ROWS
+    encoder.pix_fmt = "yuv420p"
+    encoder.bit_rate = 500000
+    encoder.time_base = fractions.Fraction(1, 30)
+    decoder = av.CodecContext.create("libvpx", "r")
+
+    track = BouncingBallTrack()
+    sent, received = [], []
+    for n in range(30):
+        seq = 1000003 * n
+        frame = av.VideoFrame.from_ndarray(
+            add_tag(track.generate_moving_ball(), seq), format="bgr24")
+        frame.pts = n
+        sent.append(seq)
+        for packet in encoder.encode(frame.reformat(format="yuv420p")):
+            for decoded in decoder.decode(packet):
+                received.append(read_tag(decoded.to_ndarray()[:decoded.height]))
+    assert received == sent[:len(received)]
+    assert len(received) > 20
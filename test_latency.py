@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from latency import LatencyHistogram
+
+
+def test_LatencyHistogram_percentiles():
+    histogram = LatencyHistogram()
+    samples = np.random.default_rng(0).lognormal(np.log(0.03), 0.5, 10000)
+    for sample in samples:
+        histogram.record(sample)
+
+    assert histogram.count == 10000
+    assert histogram.mean == pytest.approx(samples.mean())
+    for q in (50, 95, 99):
+        # Percentiles are reported as the upper bound of a 5% wide bucket
+        expected = np.percentile(samples, q)
+        assert expected <= histogram.percentile(q) <= expected * 1.06
+    assert histogram.percentile(100) == samples.max()
+
+
+def test_LatencyHistogram_empty():
+    histogram = LatencyHistogram()
+    assert np.isnan(histogram.percentile(50))
+    assert "0 samples" in histogram.summary()
@@ -0,0 +1,47 @@
+import pytest
+from loopback import LoopbackResult, regressions, run_loopback, sweep
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(60)
+async def test_run_loopback_streams_frames_to_detection():
+    result = await run_loopback(320, 240, fps=15, codec="VP8", duration=1.0, warmup=0.5)
+    assert result.sent > 0
+    assert result.received > 0
+    assert result.detected > 0
+    assert result.reports > 0
+    assert result.bottleneck is not None
+
+
+@pytest.mark.asyncio
+async def test_sweep_stops_at_first_rate_not_sustained():
+    runs = []
+
+    async def measure(width, height, fps, codec, duration=1.0):
+        runs.append((width, codec, fps))
+        result = LoopbackResult(width, height, fps, codec, duration)
+        # 640 wide sustains up to 30 fps with VP8 and 15 fps with H264
+        limit = 30 if codec == "VP8" else 15
+        result.detected = int(min(fps, limit if width == 640 else 0) * duration)
+        return result
+
+    results = await sweep([(640, 480), (1280, 720)], [15, 30, 60], ["VP8", "H264"], measure)
+    assert results == {"640x480/VP8": 30, "640x480/H264": 15,
+                       "1280x720/VP8": 0, "1280x720/H264": 0}
+    # Rates above the first failure are not tried
+    assert (640, "VP8", 60) in runs and (640, "H264", 60) not in runs
+    assert (1280, "VP8", 30) not in runs
+
+
+def test_LoopbackResult_sustained_tolerates_a_few_lost_frames():
+    result = LoopbackResult(640, 480, 30, "VP8", 2.0)
+    result.detected = 57
+    assert result.sustained
+    result.detected = 56
+    assert not result.sustained
+
+
+def test_regressions_lists_lower_rates():
+    baseline = {"640x480/VP8": 30, "640x480/H264": 30, "1280x720/VP8": 15}
+    results = {"640x480/VP8": 60, "640x480/H264": 15}
+    assert regressions(results, baseline) == [("640x480/H264", 30, 15)]
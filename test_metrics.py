@@ -0,0 +1,98 @@
+from multiprocessing import Process
+
+import aiohttp
+import pytest
+from metrics import CONTENT_TYPE, MetricsServer, Registry
+
+
+def test_Registry_exposition_format():
+    registry = Registry()
+    frames = registry.counter("frames_total", "Frames")
+    depth = registry.gauge("queue_depth", "Queue depth", function=lambda: 3)
+    messages = registry.counter("messages_total", "Messages", ["direction"])
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+
+    frames.inc()
+    frames.inc(2)
+    messages.labels("sent").inc()
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert registry.expose() == "\n".join([
+        "# HELP frames_total Frames",
+        "# TYPE frames_total counter",
+        "frames_total 3",
+        "# HELP queue_depth Queue depth",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3",
+        "# HELP messages_total Messages",
+        "# TYPE messages_total counter",
+        'messages_total{direction="sent"} 1',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_count 3",
+        "latency_seconds_sum 5.55",
+    ]) + "\n"
+
+
+def test_Registry_rejects_duplicates_and_bad_labels():
+    registry = Registry()
+    counter = registry.counter("frames_total", "Frames", ["kind"])
+    with pytest.raises(ValueError):
+        registry.gauge("frames_total", "Frames")
+    with pytest.raises(ValueError):
+        counter.labels("a", "b")
+
+
+def test_failing_gauge_function_is_exposed_as_nan():
+    registry = Registry()
+
+    def qsize():
+        raise NotImplementedError
+
+    registry.gauge("queue_depth", "Queue depth", function=qsize)
+    registry.counter("frames_total", "Frames").inc()
+
+    # The other metrics are still exposed
+    assert registry.expose().splitlines()[2:] == [
+        "queue_depth NaN",
+        "# HELP frames_total Frames",
+        "# TYPE frames_total counter",
+        "frames_total 1",
+    ]
+
+
+def observe_many(histogram, count):
+    for _ in range(count):
+        histogram.observe(0.001)
+
+
+def test_shared_histogram_is_updated_by_other_processes():
+    histogram = Registry().histogram("detection_seconds", "Detection", shared=True)
+    processes = [Process(target=observe_many, args=(histogram, 500)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert histogram.count == 1000
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_MetricsServer_serves_registry():
+    registry = Registry()
+    registry.counter("frames_total", "Frames").inc()
+    server = MetricsServer(registry, "127.0.0.1", 0)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get("http://127.0.0.1:%d/metrics" % server.port) as response:
+                assert response.status == 200
+                assert response.headers["Content-Type"] == CONTENT_TYPE
+                assert "frames_total 1" in await response.text()
+    finally:
+        await server.close()
@@ -0,0 +1,76 @@
+import pytest
+from pacing import FramePacer
+
+
+class FakeClock:
+    """
+    Monotonic clock that only moves when slept on or advanced by the test.
+    """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.now += delay
+
+
+def pacer(fps=30, late_policy="skip"):
+    clock = FakeClock()
+    return FramePacer(fps, late_policy, clock=clock, sleep=clock.sleep), clock
+
+
+@pytest.mark.asyncio
+async def test_FramePacer_is_drift_free():
+    frame_pacer, clock = pacer(fps=29.97)
+    for _ in range(1000):
+        timestamp = await frame_pacer.wait()
+        emitted_at = clock.now
+        # Work of varying length between frames
+        clock.now += 0.01 * (frame_pacer.slot % 3)
+
+    assert timestamp == round(999 * 90000 / 29.97)
+    assert emitted_at == pytest.approx(100.0 + 999 / 29.97)
+    assert frame_pacer.stats.late_frames == 0
+    assert frame_pacer.stats.jitter == pytest.approx(0, abs=1e-9)
+
+
+@pytest.mark.asyncio
+async def test_FramePacer_skip_policy_drops_missed_slots():
+    frame_pacer, clock = pacer(fps=10, late_policy="skip")
+    assert await frame_pacer.wait() == 0
+    await frame_pacer.wait()
+
+    # A 350 ms stall misses slots 2 to 4
+    clock.now += 0.35
+    assert await frame_pacer.wait() == 5 * 9000
+    assert clock.now == pytest.approx(100.5)
+    assert await frame_pacer.wait() == 6 * 9000
+    assert frame_pacer.stats.late_frames == 1
+    assert frame_pacer.stats.skipped_frames == 3
+    assert frame_pacer.stats.max_lateness == 0
+
+
+@pytest.mark.asyncio
+async def test_FramePacer_burst_policy_catches_up():
+    frame_pacer, clock = pacer(fps=10, late_policy="burst")
+    await frame_pacer.wait()
+    clock.now += 0.35
+
+    timestamps = [await frame_pacer.wait() for _ in range(5)]
+    assert timestamps == [9000 * n for n in range(1, 6)]
+    # Slots 1 to 3 are sent immediately, the schedule holds from slot 4 on
+    assert clock.now == pytest.approx(100.5)
+    assert frame_pacer.stats.late_frames == 3
+    assert frame_pacer.stats.skipped_frames == 0
+    assert frame_pacer.stats.max_lateness == pytest.approx(0.25)
+    assert frame_pacer.stats.jitter > 0
+
+
+def test_FramePacer_rejects_invalid_settings():
+    with pytest.raises(ValueError):
+        FramePacer(fps=0)
+    with pytest.raises(ValueError):
+        FramePacer(late_policy="drop")
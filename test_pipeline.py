@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+from metrics import Registry
+from pipeline import Pipeline, Stage, parse_spec
+
+
+async def items(values):
+    for value in values:
+        yield value
+
+
+def double(value):
+    return 2 * value
+
+
+def keep_odd(value):
+    return value if value % 2 else None
+
+
+def test_parse_spec():
+    assert parse_spec("convert, detect:process:2:keep-latest,report::8") == [
+        {"name": "convert", "concurrency": "inline", "queue_size": 4, "policy": "block"},
+        {"name": "detect", "concurrency": "process", "queue_size": 2,
+         "policy": "keep-latest"},
+        {"name": "report", "concurrency": "inline", "queue_size": 8, "policy": "block"},
+    ]
+    with pytest.raises(ValueError):
+        parse_spec("convert,,detect")
+    with pytest.raises(ValueError):
+        parse_spec("detect:thread:2:block:extra")
+
+
+def test_Stage_rejects_unknown_settings():
+    with pytest.raises(ValueError):
+        Stage("detect", double, concurrency="fiber")
+    with pytest.raises(ValueError):
+        Stage("detect", double, policy="drop-all")
+    with pytest.raises(ValueError):
+        Pipeline([Stage("detect", double), Stage("detect", double)])
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(20)
+@pytest.mark.parametrize("concurrency", ["inline", "thread", "process"])
+async def test_Pipeline_runs_every_item_through_the_stages_in_order(concurrency):
+    results = []
+    pipeline = Pipeline([Stage("odd", keep_odd, concurrency),
+                         Stage("double", double, concurrency, queue_size=1),
+                         Stage("collect", results.append)])
+    await pipeline.run(items(range(20)))
+
+    # Stages returning None end the item's way
+    assert results == [2 * value for value in range(1, 20, 2)]
+    assert pipeline.stats["receive"].items == 20
+    assert pipeline.stats["odd"].items == 20
+    assert pipeline.stats["double"].items == 10
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy, expected, dropped", [
+    ("drop-newest", [0, 1], 3),
+    ("drop-oldest", [3, 4], 3),
+    ("keep-latest", [4], 4),
+])
+async def test_Stage_queue_policies(policy, expected, dropped):
+    stage = Stage("detect", double, queue_size=2, policy=policy)
+    stage.start()
+    for value in range(5):
+        await stage.put(value)
+    queued = [stage.queue.get_nowait() for _ in range(stage.qsize())]
+    assert queued == expected
+    assert stage.stats.dropped == dropped
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_Pipeline_finds_the_bottleneck_and_exports_metrics():
+    registry = Registry()
+    stage_time = registry.histogram("stage_seconds", "Stage time", ["stage"])
+    stage_dropped = registry.counter("stage_dropped_total", "Dropped", ["stage"])
+
+    def slow(value):
+        time.sleep(0.01)
+        return value
+
+    results = []
+    pipeline = Pipeline([Stage("fast", double),
+                         Stage("slow", slow, "thread", queue_size=2, policy="drop-oldest"),
+                         Stage("collect", results.append)], stage_time, stage_dropped)
+
+    async def bursts():
+        for value in range(30):
+            yield value
+            await asyncio.sleep(0.002)
+
+    await pipeline.run(bursts())
+    assert pipeline.bottleneck() == "slow"
+    slow_stats = pipeline.stats["slow"]
+    assert slow_stats.dropped > 0
+    assert slow_stats.items + slow_stats.dropped == 30
+    assert len(results) == slow_stats.items
+    assert results == sorted(results)
+    assert stage_time.labels("slow").count == slow_stats.items
+    assert stage_dropped.labels("slow").value == slow_stats.dropped
+    assert "bottleneck: slow" in pipeline.summary()
+
+
+@pytest.mark.asyncio
+async def test_Pipeline_survives_failing_items():
+    results = []
+    pipeline = Pipeline([Stage("invert", lambda value: 1 / value),
+                         Stage("collect", results.append)])
+    await pipeline.run(items([1, 0, 2]))
+    assert results == [1.0, 0.5]
+    assert pipeline.stats["invert"].errors == 1
@@ -0,0 +1,75 @@
+import pickle
+from multiprocessing import Process
+
+import pytest
+from position_record import SharedPosition
+
+
+@pytest.fixture
+def position():
+    record = SharedPosition()
+    yield record
+    record.close()
+
+
+def test_SharedPosition_read_before_publish(position):
+    assert position.read() is None
+    assert position.published == 0
+
+
+def test_SharedPosition_round_trip(position):
+    position.publish(10, 20, seq=7, timestamp=1.5, confidence=0.9)
+    report = position.read()
+    assert (report.seq, report.timestamp, report.x, report.y) == (7, 1.5, 10, 20)
+    assert report.confidence == pytest.approx(0.9)
+
+    position.publish(11, 21)
+    report = position.read()
+    assert (report.seq, report.x, report.y, report.confidence) == (None, 11, 21, None)
+    assert report.timestamp > 0
+    assert position.published == 2
+
+
+def publish_diagonal(record, count):
+    for n in range(count):
+        record.publish(n, n, seq=n, timestamp=n)
+
+
+@pytest.mark.timeout(20)
+def test_SharedPosition_reads_are_consistent_across_processes(position):
+    count = 200000
+    writer = Process(target=publish_diagonal, args=(position, count))
+    writer.start()
+    reads = 0
+    while writer.is_alive() or reads == 0:
+        report = position.read()
+        if report is None:
+            continue
+        reads += 1
+        # Every field of a read comes from the same publish()
+        assert report.x == report.y == report.seq == report.timestamp
+    writer.join()
+    assert position.read().seq == count - 1
+
+
+def test_SharedPosition_attaches_by_name(position):
+    attached = pickle.loads(pickle.dumps(position))
+    try:
+        attached.publish(3, 4)
+        assert position.read().x == 3
+    finally:
+        attached.close()
+    # Only the creator removes the record
+    assert position.read().y == 4
+
+
+@pytest.mark.timeout(5)
+def test_SharedPosition_read_gives_up_on_a_dead_writer(position):
+    position.publish(1, 2, seq=3)
+    assert position.read().x == 1
+    # The writer died after making the version odd
+    position._version[0] += 1
+    report = position.read()
+    assert (report.x, report.y, report.seq) == (1, 2, 3)
+    assert position.timeouts == 1
+    assert position.retries > 0
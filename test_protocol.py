@@ -0,0 +1,85 @@
+import struct
+
+import pytest
+from protocol import (
+    BINARY_VERSION,
+    REPORT_SEQ_LIMIT,
+    PositionReport,
+    decode_message,
+    decode_reports,
+    encode_message,
+    encode_reports,
+)
+
+
+def test_text_round_trip():
+    message = encode_message([PositionReport(7, 1.5, 120, 45, 0.9)])
+    assert message == "(120, 45)"
+    assert decode_message(message) == [PositionReport(None, None, 120, 45)]
+
+
+def test_binary_round_trip_batch():
+    reports = [
+        PositionReport(1, 1000.25, 10, 20, 0.5),
+        PositionReport(2, 1000.5, 30, 40, 1.0),
+        PositionReport(None, None, 3000, 2000),
+    ]
+    message = encode_message(reports, "binary")
+    assert isinstance(message, bytes)
+    # 3 header bytes and 20 bytes per report, against ~10 bytes per text report
+    assert len(message) == 3 + 3 * 20
+    assert decode_message(message) == reports
+
+
+def test_binary_round_trip_ball_ids():
+    reports = [
+        PositionReport(4, 2.0, 10, 20, 1.0),
+        PositionReport(4, 2.0, 50, 60, 1.0, ball=3),
+    ]
+    message = encode_message(reports, "binary")
+    # Version 2 records carry a 2-byte ball id
+    assert message[0] == 2
+    assert len(message) == 3 + 2 * 22
+    assert decode_message(message) == reports
+
+
+def test_binary_round_trip_stages():
+    reports = [
+        PositionReport(4, None, 10, 20, stages=(0.25, 0.5, 0.125)),
+        PositionReport(5, None, 30, 40, ball=1),
+    ]
+    message = encode_message(reports, "binary")
+    assert message[0] == 3
+    assert decode_message(message) == reports
+
+
+def test_binary_round_trip_report_seq():
+    reports = [
+        PositionReport(None, None, 10, 20, report_seq=0),
+        PositionReport(None, None, 30, 40, report_seq=REPORT_SEQ_LIMIT - 1),
+        PositionReport(7, None, 50, 60),
+    ]
+    message = encode_message(reports, "binary")
+    # report_seq takes the place of the frame sequence number
+    assert message[0] == 1
+    assert decode_message(message) == reports
+
+
+@pytest.mark.parametrize("message", [
+    "Server is waiting for live ball locations...",
+    "(1, 2, 3)",
+    "(a, b)",
+    b"",
+    struct.pack("<BH", BINARY_VERSION + 1, 0),
+    encode_reports([PositionReport(1, 0.0, 1, 2, 1.0)])[:-1],
+])
+def test_decode_message_rejects_invalid(message):
+    with pytest.raises(ValueError):
+        decode_message(message)
+
+
+def test_encode_reports_batch_limits():
+    with pytest.raises(ValueError):
+        encode_reports([])
+    assert decode_reports(bytearray(encode_reports([PositionReport(1, 0.0, -5, 7)]))) == [
+        PositionReport(1, 0.0, -5, 7)]
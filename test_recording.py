@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from detection import create_detector
+from recording import FrameRecorder, Recording, record_scene, replay
+
+
+def test_FrameRecorder_round_trip(tmp_path):
+    path = str(tmp_path / "frames.rec")
+    recorder = FrameRecorder(path, (4, 6, 3), capacity=5, balls=2)
+    for seq in range(3):
+        assert recorder.write(np.full((4, 6, 3), seq, dtype=np.uint8), seq + 10,
+                              [(seq, 1), (2, seq)], timestamp=seq / 10)
+    recorder.write(np.zeros((4, 6, 3), dtype=np.uint8), 20)
+    recorder.close()
+
+    recording = Recording(path)
+    assert len(recording) == 4
+    assert recording.seqs.tolist() == [10, 11, 12, 20]
+    assert recording.timestamps[:3].tolist() == [0, 0.1, 0.2]
+    assert recording.positions[2].tolist() == [[2, 1], [2, 2]]
+    assert np.isnan(recording.positions[3]).all()
+    assert (recording.frames[1] == 1).all()
+
+    positions = recording.positions_by_seq([12, 13])
+    assert positions[0].tolist() == [[2, 1], [2, 2]]
+    assert np.isnan(positions[1]).all()
+
+
+def test_FrameRecorder_is_bounded(tmp_path):
+    path = str(tmp_path / "frames.rec")
+    recorder = FrameRecorder(path, (2, 2), capacity=2)
+    assert recorder.write(np.zeros((2, 2), dtype=np.uint8), 0)
+    assert recorder.write(np.zeros((2, 2), dtype=np.uint8), 1)
+    assert recorder.full
+    assert not recorder.write(np.zeros((2, 2), dtype=np.uint8), 2)
+    recorder.close()
+    assert len(Recording(path)) == 2
+
+
+def test_Recording_rejects_other_files(tmp_path):
+    path = tmp_path / "frames.rec"
+    path.write_bytes(b"not a recording" * 10)
+    with pytest.raises(ValueError):
+        Recording(str(path))
+
+
+@pytest.mark.parametrize("frame_format, options", [
+    ("bgr24", {}),
+    ("gray", {"pixel_format": "yuv420p", "frame_tags": True}),
+    ("bgr24", {"balls": 3}),
+])
+def test_replay_scores_detectors_on_recorded_scenes(tmp_path, frame_format, options):
+    path = str(tmp_path / "scene.rec")
+    record_scene(path, 50, frame_format, **options)
+    recording = Recording(path)
+    assert len(recording) == 50
+
+    detector = create_detector("contour", balls=options.get("balls", 1))
+    result = replay(recording, detector)
+    assert result.frames == 50
+    assert result.fps > 0
+    assert result.errors.count + result.missed == 50 * options.get("balls", 1)
+    assert result.errors.distance_histogram.percentile(50) <= 1
+
+
+def test_replay_against_another_recording(tmp_path):
+    server_path, client_path = str(tmp_path / "server.rec"), str(tmp_path / "client.rec")
+    record_scene(server_path, 20)
+    server = Recording(server_path)
+
+    # A client recording of every other frame, without positions
+    recorder = FrameRecorder(client_path, server.frames.shape[1:], capacity=10)
+    for index in range(0, 20, 2):
+        recorder.write(server.frames[index], int(server.seqs[index]))
+    recorder.close()
+
+    result = replay(Recording(client_path), create_detector(), truth=server)
+    assert result.frames == 10
+    assert result.errors.count == 10
@@ -1,10 +1,17 @@
 import asyncio
 import fractions
+import random
+import time
 import numpy as np
 import pytest
-from server import compute_errors, BouncingBallTrack, consume_signaling, run_offer, run_signaling, RTCPeerConnection
+from av import VideoFrame
+from frame_tags import read_tag
+from server import frames_rendered, frames_sent, metrics_registry, BallScene, BouncingBallTrack, GroundTruthStore, Session, channel_options, consume_signaling, ground_truth, run_offer, run_signaling, finish_track, RTCPeerConnection
+from protocol import PositionReport, ReportFilter, decode_message, encode_reports
+from recording import FrameRecorder, Recording
 from aiortc import RTCSessionDescription
 from aiortc import MediaStreamTrack
+from aiortc.contrib.media import MediaRelay
 from pytest_mock import mocker
 from unittest.mock import AsyncMock
 
@@ -118,30 +125,106 @@ def event_loop():
     loop.close()
 
 
-@pytest.mark.asyncio
-async def test_compute_errors():
-    server_queue = asyncio.Queue()
-    server_queue.put_nowait((100, 100))
-    reported_location = (90, 90)
+def report_errors(store, x, y, seq=None, ball=0):
+    """
+    Returns the (x, y) percentage errors the server records for one report,
+    or None if the ball's actual position is not known.
+    """
+    session = Session()
+    session.record_reports([PositionReport(seq, None, x, y, ball=ball)], store)
+    return session.mean_errors()
+
+
+def test_Session_record_reports_errors():
+    store = GroundTruthStore()
+    store.record(0, (100, 100))
+    assert report_errors(store, 90, 90) == (10.0, 10.0)
+
+    store.record(1, (200, 200))
+    assert report_errors(store, 180, 220) == (10.0, 10.0)
+
+    store.record(2, (300, 300))
+    assert report_errors(store, 350, 270) == (16.67, 10.0)
+
+    # Reports for an earlier frame are compared to that frame
+    assert report_errors(store, 110, 90, seq=0) == (10.0, 10.0)
+
+    # A coordinate of 0 counts as 1 pixel
+    store.record(4, (0, 40))
+    assert report_errors(store, 2, 40) == (200.0, 0.0)
+
+    # Test when the frame is unknown
+    assert report_errors(store, 350, 270, seq=3) is None
+    assert report_errors(GroundTruthStore(), 350, 270) is None
+
+
+def test_GroundTruthStore_is_bounded():
+    store = GroundTruthStore(capacity=4)
+    for seq in range(10):
+        store.record(seq, (seq, 2 * seq))
+
+    assert len(store) == 4
+    assert store.latest() == (9, (9, 18))
+    assert store[6] == (6, 12)
+    assert store.get(5) is None
+    assert store.get(10) is None
+
+
+def test_GroundTruthStore_several_balls():
+    store = GroundTruthStore()
+    store.record(0, [(1, 2), (3, 4), (5, 6)])
+
+    assert store.balls == 3
+    assert store.get(0, ball=2) == (5, 6)
+    assert store.get(0, ball=3) is None
+    assert store.positions(0).tolist() == [[1, 2], [3, 4], [5, 6]]
+    assert report_errors(store, 3, 4, seq=0, ball=1) == (0, 0)
 
-    percentage_error = compute_errors(reported_location, server_queue)
-    assert percentage_error == (10.0, 10.0)
+    # A different number of balls starts over
+    store.record(1, (7, 8))
+    assert store.balls == 1
+    assert store.get(0) is None
+    assert store[1] == (7, 8)
 
-    server_queue.put_nowait((200, 200))
-    reported_location = (180, 220)
 
-    percentage_error = compute_errors(reported_location, server_queue)
-    assert percentage_error == (10.0, 10.0)
+def test_BallScene_bounces_like_single_ball():
+    track = BouncingBallTrack(canvas_width=333, canvas_height=211)
+    scene = BallScene(50, 333, 211)
+    for _ in range(200):
+        track.generate_moving_ball()
+        scene.step()
+        assert tuple(scene.positions[0]) == (track.ball_x, track.ball_y)
+        # Every ball stays within one step of the canvas
+        assert (scene.positions >= -scene.radii[:, None] - 20).all()
+        assert (scene.positions <= scene.size + 20).all()
 
-    server_queue.put_nowait((300, 300))
-    reported_location = (350, 270)
 
-    percentage_error = compute_errors(reported_location, server_queue)
-    assert percentage_error == (16.67, 10.0)
+@pytest.mark.parametrize("render_mode", ["full", "dirty"])
+def test_BouncingBallTrack_several_balls(render_mode):
+    track = BouncingBallTrack(render_mode=render_mode, balls=5)
+    for _ in range(100):
+        frame = track.generate_moving_ball()
+    positions = ground_truth.positions(track.frame_seq)
+    assert positions.shape == (5, 2)
+    assert tuple(positions[0]) == (track.ball_x, track.ball_y)
+    x, y = positions[0]
+    assert (frame[y, x] != 255).any()
+    assert (frame != 255).any(axis=2).sum() <= 5 * np.pi * (track.ball_radius + 1) ** 2
 
-    # Test when server_queue is empty
-    with pytest.raises(asyncio.QueueEmpty):
-        compute_errors(reported_location, server_queue)
+
+def test_BouncingBallTrack_several_balls_dirty_render_matches_full():
+    full_track = BouncingBallTrack(balls=8)
+    dirty_track = BouncingBallTrack(render_mode="dirty", balls=8)
+    for _ in range(100):
+        assert np.array_equal(full_track.generate_moving_ball(),
+                              dirty_track.generate_moving_ball())
+
+
+def test_BouncingBallTrack_records_ground_truth():
+    track = BouncingBallTrack()
+    track.generate_moving_ball()
+    track.generate_moving_ball()
+    assert ground_truth[track.frame_seq] == (track.ball_x, track.ball_y)
 
 
 @pytest.mark.asyncio
@@ -151,6 +234,46 @@ async def test_BouncingBallTrack_generate_moving_ball():
     assert isinstance(ball_canvas, np.ndarray)
 
 
+@pytest.mark.parametrize("width, height", [(640, 480), (333, 211)])
+def test_BouncingBallTrack_dirty_render_matches_full(width, height):
+    full_track = BouncingBallTrack(canvas_width=width, canvas_height=height)
+    dirty_track = BouncingBallTrack(
+        render_mode="dirty", canvas_width=width, canvas_height=height)
+
+    # Run long enough for the ball to bounce off every wall
+    for _ in range(200):
+        expected = full_track.generate_moving_ball()
+        actual = dirty_track.generate_moving_ball()
+        assert np.array_equal(expected, actual)
+
+
+@pytest.mark.parametrize("render_mode", ["full", "dirty"])
+def test_BouncingBallTrack_yuv_render_matches_converted_bgr(render_mode):
+    bgr_track = BouncingBallTrack()
+    yuv_track = BouncingBallTrack(render_mode=render_mode, pixel_format="yuv420p")
+    for _ in range(200):
+        expected = VideoFrame.from_ndarray(
+            bgr_track.generate_moving_ball(), format="bgr24").reformat(format="yuv420p")
+        actual = yuv_track.generate_yuv_frame()
+        # The luma plane matches up to rounding; chroma only differs along
+        # the ball's edge, where libav averages the subsampled pixels
+        difference = np.abs(expected.to_ndarray().astype(int) - actual)
+        assert difference[:480].max() <= 1
+        assert (difference[480:] > 2).sum() <= 64
+
+
+def test_BouncingBallTrack_yuv_needs_single_ball_and_even_size():
+    with pytest.raises(ValueError):
+        BouncingBallTrack(pixel_format="yuv420p", balls=2)
+    with pytest.raises(ValueError):
+        BouncingBallTrack(pixel_format="yuv420p", canvas_width=333)
+
+
+def test_BouncingBallTrack_unknown_render_mode():
+    with pytest.raises(ValueError):
+        BouncingBallTrack(render_mode="partial")
+
+
 @pytest.mark.asyncio
 async def test_BouncingBallTrack_recv():
     track = BouncingBallTrack()
@@ -161,6 +284,52 @@ async def test_BouncingBallTrack_recv():
     assert isinstance(frame.time_base, fractions.Fraction)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("render_mode", ["full", "dirty"])
+async def test_BouncingBallTrack_lookahead_matches_inline_rendering(render_mode):
+    inline = BouncingBallTrack(render_mode=render_mode, fps=1000, late_policy="burst")
+    ahead = BouncingBallTrack(render_mode=render_mode, fps=1000, late_policy="burst",
+                              lookahead=3)
+    try:
+        for _ in range(30):
+            expected, actual = await inline.recv(), await ahead.recv()
+            assert actual.pts == expected.pts
+            assert np.array_equal(actual.to_ndarray(format="bgr24"),
+                                  expected.to_ndarray(format="bgr24"))
+        # Three frames are rendered ahead of the one just sent
+        assert ahead.frame_seq - inline.frame_seq in range(0, 4)
+        assert ahead.lookahead.hits + ahead.lookahead.misses == 30
+    finally:
+        ahead.stop()
+    assert not ahead.lookahead._pending
+
+
+@pytest.mark.asyncio
+async def test_untagged_report_with_lookahead_is_scored_against_the_sent_frame():
+    track = BouncingBallTrack(fps=1000, late_policy="burst", lookahead=4)
+    start = track.frame_seq
+    try:
+        for _ in range(10):
+            await track.recv()
+        # Frames are rendered, and recorded, ahead of the tenth one sent
+        assert ground_truth.latest_seq > start + 10
+        x, y = ground_truth[start + 10]
+        assert report_errors(ground_truth, x, y) == (0, 0)
+    finally:
+        track.stop()
+
+
+@pytest.mark.asyncio
+async def test_BouncingBallTrack_updates_metrics():
+    rendered, sent = frames_rendered.value, frames_sent.value
+    track = BouncingBallTrack(fps=1000)
+    await track.recv()
+    await track.recv()
+    assert frames_rendered.value == rendered + 2
+    assert frames_sent.value == sent + 2
+    assert "server_encode_seconds_count" in metrics_registry.expose()
+
+
 @pytest.mark.asyncio
 @pytest.mark.timeout(3)
 async def test_BouncingBallTrack_next_timestamp():
@@ -291,3 +460,236 @@ async def test_run_signaling(mocker):
     assert pc.DataChannel is not None
     assert pc.DataChannel.label == "live ball locations"
     assert pc.DataChannel.on_called
+
+
+def test_Session_error_accounting():
+    store = GroundTruthStore(balls=2)
+    store.record(0, [(100, 100), (50, 0)])
+    session = Session("peer-0")
+    assert session.mean_errors() is None
+    session.record_reports([PositionReport(0, None, 90, 80),
+                            PositionReport(0, None, 60, 0, ball=1),
+                            # Unknown frame and unknown ball
+                            PositionReport(9, None, 1, 1),
+                            PositionReport(0, None, 1, 1, ball=5)], store)
+    assert session.reports == 4
+    assert session.unmatched == 2
+    assert session.errors.count == 2
+    # A coordinate of 0 counts as 1 pixel
+    assert session.mean_errors() == (15.0, 10.0)
+    assert "2 without ground truth" in session.summary()
+    # Sessions do not share filters or errors
+    assert Session("peer-1").report_filter is not session.report_filter
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_Session_summarize_every_runs_without_reports(mocker):
+    log_summary = mocker.patch.object(Session, "log_summary")
+    summaries = asyncio.ensure_future(Session().summarize_every(0.01))
+    # No report arrives, yet the summary is logged on schedule
+    while log_summary.call_count < 3:
+        await asyncio.sleep(0.01)
+    summaries.cancel()
+
+
+def test_GroundTruthStore_lookup():
+    store = GroundTruthStore(capacity=4, balls=2)
+    for seq in range(6):
+        store.record(seq, [(seq, 10 * seq), (-seq, 0)])
+    positions, known = store.lookup([5, 2, 1, 4, -1], [1, 0, 0, 2, 0])
+    # Frame 1 was overwritten, there is no ball 2, -1 is the latest frame
+    assert known.tolist() == [True, True, False, False, True]
+    assert positions[known].tolist() == [[-5, 0], [2, 20], [5, 50]]
+
+
+def test_Session_latency_accounting():
+    session = Session()
+    session.record_latency(PositionReport(3, None, 1, 2, stages=(0.01, 0.02, 0.005)),
+                           captured_at=100.0, arrived_at=100.1)
+    # Reports without stages only give the total
+    session.record_latency(PositionReport(4, None, 1, 2), captured_at=100.0, arrived_at=100.2)
+
+    assert session.latency["total"].count == 2
+    assert session.latency["detect"].count == 1
+    assert session.latency["transport"].percentile(50) == pytest.approx(0.065, rel=0.05)
+    assert "transport" in session.latency_summary()
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"render_mode": "dirty"},
+    {"pixel_format": "yuv420p", "frame_tags": True},
+    {"render_mode": "dirty", "balls": 3, "frame_tags": True},
+])
+def test_BouncingBallTrack_frame_cache_matches_rendering(options):
+    size = {"canvas_width": 320, "canvas_height": 240}
+    rendered = BouncingBallTrack(**size, **options)
+    cached = BouncingBallTrack(**size, **options, frame_cache=10 ** 8)
+    for _ in range(300):
+        expected, actual = rendered._render_frame(), cached._render_frame()
+        assert np.array_equal(actual.to_ndarray(), expected.to_ndarray())
+
+    cache = cached.frame_cache
+    assert cache.period is not None and cache.period < 300
+    assert cache.hit_rate > 0.5
+    assert 0 < cache.resident_bytes <= len(cache) * 320 * 256 * 3
+
+
+def test_BouncingBallTrack_frame_cache_cap():
+    track = BouncingBallTrack(canvas_width=160, canvas_height=120,
+                              frame_cache=10 * 160 * 120 * 3)
+    for _ in range(500):
+        track._render_frame()
+    cache = track.frame_cache
+    assert len(cache) == 10
+    assert cache.resident_bytes <= cache.max_bytes
+    assert not cache.admitting
+    assert cache.hits > 0
+
+
+@pytest.mark.asyncio
+async def test_finish_track_stops_lookahead_before_closing_recorder(tmp_path):
+    path = str(tmp_path / "server.rec")
+    track = BouncingBallTrack(fps=1000, late_policy="burst", lookahead=4)
+    track.recorder = FrameRecorder(path, (480, 640, 3), capacity=100)
+    for _ in range(5):
+        await track.recv()
+    finish_track(track)
+
+    # No frame is rendered, or recorded, once the recorder is closed
+    rendered = frames_rendered.value
+    await asyncio.sleep(0.05)
+    assert frames_rendered.value == rendered
+    # Every frame rendered ahead is in the recording
+    assert Recording(path).seqs[-1] == track.frame_seq
+
+
+def test_BouncingBallTrack_records_frames(tmp_path):
+    path = str(tmp_path / "server.rec")
+    track = BouncingBallTrack()
+    track.recorder = FrameRecorder(path, (480, 640, 3), capacity=3)
+    frames = [track._render_frame() for _ in range(5)]
+    # Closes the recorder once the track is done
+    finish_track(track)
+
+    recording = Recording(path)
+    assert recording.seqs.tolist() == list(range(track.frame_seq - 4, track.frame_seq - 1))
+    assert np.array_equal(recording.frames[2], frames[2].to_ndarray(format="bgr24"))
+    assert recording.positions[2, 0].tolist() == list(ground_truth[recording.seqs[2]])
+
+
+def test_BouncingBallTrack_frame_tags():
+    track = BouncingBallTrack(frame_tags=True)
+    before = time.monotonic()
+    frame = track._render_frame()
+    assert frame.height == track.canvas_height + 16
+    assert read_tag(frame.to_ndarray(format="bgr24")) == track.frame_seq
+    assert before <= ground_truth.captured_at(track.frame_seq) <= time.monotonic()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_relayed_scene_is_rendered_once_for_all_peers():
+    scene = BouncingBallTrack()
+    relay = MediaRelay()
+    peers = [relay.subscribe(scene, buffered=False) for _ in range(3)]
+
+    for _ in range(3):
+        frames = await asyncio.gather(*(peer.recv() for peer in peers))
+        assert len({frame.pts for frame in frames}) == 1
+
+    # Three frames for three peers, not nine
+    assert scene.frame_seq < 5
+    for peer in peers:
+        peer.stop()
+
+
+def test_channel_options():
+    assert channel_options("reliable") == {}
+    assert channel_options("unreliable") == {"ordered": False, "maxRetransmits": 0}
+    assert channel_options("lifetime", 50) == {"ordered": False, "maxPacketLifeTime": 50}
+    with pytest.raises(ValueError):
+        channel_options("best-effort")
+
+
+def test_ReportFilter_discards_out_of_order_reports():
+    report_filter = ReportFilter()
+    accepted = [seq for seq in (1, 3, 2, 4, 4, None)
+                if report_filter.accept(PositionReport(seq, None, 0, 0))]
+    assert accepted == [1, 3, 4, None]
+    assert report_filter.discarded == 2
+
+
+def test_ReportFilter_orders_untagged_reports_by_report_seq():
+    report_filter = ReportFilter()
+    reports = [PositionReport(None, None, 0, 0, report_seq=seq) for seq in (5, 7, 6, 8)]
+    # Frame and report sequence numbers are not compared with each other
+    reports.append(PositionReport(1, None, 0, 0))
+    accepted = [report for report in reports if report_filter.accept(report)]
+    assert [report.report_seq for report in accepted] == [5, 7, 8, None]
+
+
+async def report_latencies(channel_config, loss, count=150, interval=0.01):
+    """
+    Sends timestamped binary reports between two local peer connections while
+    dropping a fraction of the sender's SCTP packets, and returns the sorted
+    delivery latencies of the reports the receiver accepted.
+    """
+    sender_pc, receiver_pc = RTCPeerConnection(), RTCPeerConnection()
+    channel = sender_pc.createDataChannel("live ball locations", **channel_config)
+    opened = asyncio.Event()
+    channel.on("open", opened.set)
+    latencies = []
+    report_filter = ReportFilter()
+
+    @receiver_pc.on("datachannel")
+    def on_datachannel(remote_channel):
+        @remote_channel.on("message")
+        def on_message(message):
+            for report in decode_message(message):
+                if report_filter.accept(report):
+                    latencies.append(time.monotonic() - report.timestamp)
+
+    await sender_pc.setLocalDescription(await sender_pc.createOffer())
+    await receiver_pc.setRemoteDescription(sender_pc.localDescription)
+    await receiver_pc.setLocalDescription(await receiver_pc.createAnswer())
+    await sender_pc.setRemoteDescription(receiver_pc.localDescription)
+    await asyncio.wait_for(opened.wait(), 10)
+
+    # Inject loss below SCTP once the channel is up
+    transport = sender_pc.sctp.transport
+    send_data = transport._send_data
+    rng = random.Random(1)
+
+    async def lossy_send_data(data):
+        if rng.random() >= loss:
+            await send_data(data)
+
+    transport._send_data = lossy_send_data
+    for seq in range(count):
+        channel.send(encode_reports(
+            [PositionReport(seq, time.monotonic(), seq, seq, 1.0)]))
+        await asyncio.sleep(interval)
+    # Leave time for retransmissions
+    await asyncio.sleep(1.5)
+
+    await sender_pc.close()
+    await receiver_pc.close()
+    return sorted(latencies)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(60)
+async def test_unreliable_channel_improves_tail_latency_under_loss():
+    reliable = await report_latencies(channel_options("reliable"), loss=0.1)
+    unreliable = await report_latencies(channel_options("unreliable"), loss=0.1)
+
+    def p99(latencies):
+        return latencies[int(len(latencies) * 0.99) - 1]
+
+    # The reliable channel delivers everything, but retransmitted reports hold
+    # back the ones queued behind them
+    assert len(reliable) == 150
+    assert len(unreliable) < 150
+    assert p99(unreliable) < p99(reliable) / 5
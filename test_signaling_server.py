@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+from aiortc.contrib.signaling import BYE, TcpSocketSignaling
+from signaling_server import LoopbackSignaling, SignalingServer
+from server import BouncingBallTrack, Session, run_session
+import client
+
+
+async def wait_until(predicate, timeout=5):
+    async def poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_SignalingServer_runs_concurrent_sessions():
+    received = {}
+
+    async def handler(signaling, session_id, accepted_at):
+        await signaling.send(RTCSessionDescription(sdp="offer %d" % session_id, type="offer"))
+        while True:
+            obj = await signaling.receive()
+            if obj is BYE or obj is None:
+                break
+            received[session_id] = obj.sdp
+
+    server = SignalingServer(handler, "127.0.0.1", 0)
+    await server.start()
+    clients = [TcpSocketSignaling("127.0.0.1", server.port) for _ in range(5)]
+    try:
+        offers = await asyncio.gather(*(signaling.receive() for signaling in clients))
+        assert len({offer.sdp for offer in offers}) == 5
+        await wait_until(lambda: len(server.sessions) == 5)
+
+        for signaling, offer in zip(clients, offers):
+            await signaling.send(RTCSessionDescription(
+                sdp=offer.sdp.replace("offer", "answer"), type="answer"))
+        await wait_until(lambda: len(received) == 5)
+        assert received == {i: "answer %d" % i for i in range(5)}
+    finally:
+        for signaling in clients:
+            await signaling.close()
+
+    # Sessions end on BYE and are cleaned up
+    await wait_until(lambda: not server.sessions)
+    await server.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_SignalingServer_refuses_sessions_over_limit():
+    release = asyncio.Event()
+
+    async def handler(signaling, session_id, accepted_at):
+        await signaling.send(RTCSessionDescription(sdp="offer", type="offer"))
+        await release.wait()
+
+    server = SignalingServer(handler, "127.0.0.1", 0, max_sessions=1)
+    await server.start()
+    first = TcpSocketSignaling("127.0.0.1", server.port)
+    second = TcpSocketSignaling("127.0.0.1", server.port)
+    try:
+        assert (await first.receive()).type == "offer"
+        assert await second.receive() is BYE
+        assert server.refused == 1
+    finally:
+        release.set()
+        await server.close()
+        assert not server.sessions
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(30)
+async def test_run_session_reports_time_to_connected():
+    scene = BouncingBallTrack()
+    relay = MediaRelay()
+    sessions = []
+
+    async def handler(signaling, session_id, accepted_at):
+        session = Session("peer-%d" % session_id, started_at=accepted_at)
+        sessions.append(session)
+        await run_session(relay.subscribe(scene, buffered=False), signaling, session)
+
+    server = SignalingServer(handler, "127.0.0.1", 0)
+    await server.start()
+    peers = [(RTCPeerConnection(), TcpSocketSignaling("127.0.0.1", server.port))
+             for _ in range(2)]
+    tasks = [asyncio.ensure_future(client.consume_signaling(pc, signaling))
+             for pc, signaling in peers]
+    try:
+        await wait_until(lambda: len(sessions) == 2 and all(
+            session.time_to_connected is not None for session in sessions), timeout=20)
+        assert all(session.time_to_connected > 0 for session in sessions)
+    finally:
+        for pc, signaling in peers:
+            await signaling.close()
+            await pc.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_LoopbackSignaling_delivers_messages_between_ends():
+    first, second = LoopbackSignaling.pair()
+    await first.send(RTCSessionDescription(sdp="offer", type="offer"))
+    received = await second.receive()
+    assert isinstance(received, RTCSessionDescription)
+    assert (received.type, received.sdp) == ("offer", "offer")
+
+    await second.send(RTCSessionDescription(sdp="answer", type="answer"))
+    assert (await first.receive()).sdp == "answer"
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_LoopbackSignaling_close_sends_bye():
+    first, second = LoopbackSignaling.pair()
+    await first.close()
+    assert await second.receive() is BYE
+    # The closed end stops receiving and sending
+    assert await first.receive() is None
+    await first.send(RTCSessionDescription(sdp="late", type="offer"))
+    await first.close()
+    assert second._inbox.empty()
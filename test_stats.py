@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from stats import ErrorStats, LogHistogram, RunningStats
+
+
+def test_RunningStats_matches_numpy():
+    values = np.random.default_rng(0).normal(5, 2, 1000)
+    one_by_one, batched = RunningStats(), RunningStats()
+    for value in values:
+        one_by_one.update(value)
+    for batch in np.array_split(values, 7):
+        batched.update_batch(batch)
+
+    for stats in (one_by_one, batched):
+        assert stats.count == 1000
+        assert stats.mean == pytest.approx(values.mean())
+        assert stats.variance == pytest.approx(values.var(ddof=1))
+        assert stats.min == values.min()
+        assert stats.max == values.max()
+
+
+def test_LogHistogram_percentiles():
+    values = np.random.default_rng(1).uniform(1, 100, 10000)
+    histogram, batched = LogHistogram(0.1, 1000), LogHistogram(0.1, 1000)
+    for value in values:
+        histogram.record(value)
+    batched.record_many(values)
+
+    assert np.array_equal(histogram.counts, batched.counts)
+    for q in (50, 95, 99):
+        assert batched.percentile(q) == pytest.approx(np.percentile(values, q), rel=0.05)
+    assert batched.mean == pytest.approx(values.mean())
+    assert np.isnan(LogHistogram(1, 10).percentile(50))
+
+
+def test_ErrorStats():
+    errors = ErrorStats()
+    assert errors.mean_relative() is None
+    assert errors.summary() == "no reports"
+
+    errors.update([(90, 80), (3, 0)], [(100, 100), (0, 4)])
+    errors.update((100, 100), (100, 100))
+    assert errors.count == 3
+    assert errors.pixels["x"].mean == pytest.approx(13 / 3)
+    # Relative to the actual coordinate, 0 counting as 1 pixel
+    assert errors.mean_relative() == (103.33, 40.0)
+    assert errors.distance.max == pytest.approx(np.hypot(10, 20))
+    assert errors.summary().startswith("3 reports")